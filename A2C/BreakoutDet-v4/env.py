@@ -25,8 +25,8 @@ def preprocess(frame):
     frame = frame.convert("L")
     frame = frame.crop((0, 20, 160, 210))
     frame = frame.resize((84, 84))
-    frame = np.array(frame, dtype=np.float32)
-    frame = frame / 255
+    #: [0, 1]へのスケーリングはネットワークの中で行う
+    frame = np.array(frame, dtype=np.uint8)
 
     return frame
 
@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 
 from env import SubProcVecEnv, preprocess
 from models import ActorCriticNet
+from mixed_precision import enable_mixed_precision
 
 
 def envfunc_proto(env_id):
@@ -28,10 +29,14 @@ class A2CAgent:
 
     ACTION_SPACE = 4
 
-    def __init__(self, n_procs, gamma=0.99, weights=None):
+    def __init__(self, n_procs, gamma=0.99, weights=None,
+                 envfunc=envfunc_proto, mixed_precision=False):
 
         self.n_procs = n_procs
 
+        if mixed_precision:
+            enable_mixed_precision()
+
         self.ACNet = ActorCriticNet(action_space=self.ACTION_SPACE)
 
         if weights:
@@ -40,7 +45,7 @@ class A2CAgent:
         self.gamma = gamma
 
         self.vecenv = SubProcVecEnv(
-            [functools.partial(envfunc_proto, env_id=i)
+            [functools.partial(envfunc, env_id=i)
              for i in range(self.n_procs)])
 
         self.states = None
@@ -7,6 +7,8 @@ import tensorflow.keras.layers as kl
 import tensorflow_probability as tfp
 import numpy as np
 
+from mixed_precision import wrap_optimizer, scale_loss, unscale_gradients
+
 
 class ActorCriticNet(tf.keras.Model):
 
@@ -36,16 +38,21 @@ class ActorCriticNet(tf.keras.Model):
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.logits = kl.Dense(self.action_space,
+        #: mixed precisionでもsoftmax/log-probはfloat32で計算する
+        self.logits = kl.Dense(self.action_space, dtype="float32",
                                kernel_initializer="he_normal")
 
-        self.values = kl.Dense(1, kernel_initializer="he_normal")
+        self.values = kl.Dense(1, dtype="float32",
+                               kernel_initializer="he_normal")
 
-        self.optimizer = tf.keras.optimizers.Adam(lr=lr)
+        self.optimizer = wrap_optimizer(tf.keras.optimizers.Adam(lr=lr))
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
 
         x = self.conv2(x)
@@ -64,7 +71,7 @@ class ActorCriticNet(tf.keras.Model):
 
     def sample_action(self, states):
 
-        states = tf.convert_to_tensor(np.atleast_2d(states), dtype=tf.float32)
+        states = tf.convert_to_tensor(np.atleast_2d(states))
 
         _, logits = self(states)
 
@@ -78,7 +85,7 @@ class ActorCriticNet(tf.keras.Model):
 
     def predict(self, states):
 
-        states = tf.convert_to_tensor(np.atleast_2d(states), dtype=tf.float32)
+        states = tf.convert_to_tensor(np.atleast_2d(states))
 
         values, logits = self(states)
 
@@ -112,8 +119,10 @@ class ActorCriticNet(tf.keras.Model):
             policy_loss *= -1
 
             total_loss = tf.reduce_mean(policy_loss + self.VALUE_COEF * value_loss)
+            scaled_loss = scale_loss(self.optimizer, total_loss)
 
-        grads = tape.gradient(total_loss, self.trainable_variables)
+        grads = tape.gradient(scaled_loss, self.trainable_variables)
+        grads = unscale_gradients(self.optimizer, grads)
         grads, grad_norm = tf.clip_by_global_norm(grads, self.MAX_GRAD_NORM)
         self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
 
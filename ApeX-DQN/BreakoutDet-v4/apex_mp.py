@@ -0,0 +1,422 @@
+import os
+import collections
+import multiprocessing
+import pickle
+import queue
+import time
+import shutil
+from pathlib import Path
+
+import gym
+import numpy as np
+import tensorflow as tf
+
+from model import DuelingQNetwork
+from buffer import GlobalReplayBuffer, RateLimiter
+from shm import SharedRing, SharedWeights
+from util import preprocess_frame
+from profiler import Profiler
+from layer_stats import StatsWriter
+
+
+""" rayを使わない単一マシン用のApe-X
+
+    apex.pyと同じActor / Learner / TestActor をそれぞれOSのプロセスとして動かし、
+    global bufferはこの(driver)プロセスが持つ.
+    rolloutとミニバッチは共有メモリのリングバッファ(SharedRing)で、
+    重みは共有メモリ(SharedWeights)で受け渡すのでobject storeを経由しない
+"""
+
+
+def _actor_worker(actor_kwargs, ring, notify, weights, stop_event):
+
+    from remote_actor import Actor
+
+    actor = Actor(**actor_kwargs)
+
+    #: learnerが最初の重みを書くまで待つ
+    current_weights, version = weights.read()
+    while current_weights is None:
+        if stop_event.wait(0.1):
+            return
+        current_weights, version = weights.read()
+
+    while not stop_event.is_set():
+
+        new_weights, version = weights.read(version)
+        if new_weights is not None:
+            current_weights = new_weights
+
+        priorities, experiences, pid = actor.rollout(current_weights)
+
+        payload = pickle.dumps(
+            (priorities, experiences, pid), protocol=pickle.HIGHEST_PROTOCOL)
+
+        #: ringが満杯ならdriverが取り出すまで待つ(RateLimiterで止められている間も)
+        while not ring.put(payload, timeout=1.):
+            if stop_event.is_set():
+                return
+
+        notify.release()
+
+
+def _learner_worker(learner_kwargs, minibatch_ring, result_ring, weights,
+                    stop_event):
+
+    from learner import Learner
+
+    learner = Learner(**learner_kwargs)
+
+    weights.publish(learner.define_network())
+
+    while not stop_event.is_set():
+
+        payload = minibatch_ring.get(timeout=1.)
+        if payload is None:
+            continue
+
+        command, *args = pickle.loads(payload)
+
+        if command == "save":
+            learner.save(*args)
+            continue
+
+        (current_weights, indices, generations,
+         td_errors, loss_mean, cache_stats, layer_stats) = learner.update_qnetwork(*args)
+
+        weights.publish(current_weights)
+
+        result = pickle.dumps(
+            (indices, generations, td_errors, loss_mean, cache_stats, layer_stats),
+            protocol=pickle.HIGHEST_PROTOCOL)
+
+        while not result_ring.put(result, timeout=1.):
+            if stop_event.is_set():
+                return
+
+
+def _tester_worker(env_name, requests, results, weights, n_eval_episodes,
+                   stop_event):
+
+    from remote_actor import TestActor
+
+    tester = TestActor(env_name=env_name)
+
+    while True:
+
+        request = requests.get()
+        if request is None:
+            break
+
+        #: 最初の評価の依頼はlearnerが重みを書く前に届きうるので待つ
+        current_weights, _ = weights.read()
+        while current_weights is None:
+            if stop_event.wait(0.1):
+                return
+            current_weights, _ = weights.read()
+
+        results.put(tester.play_batched(
+            current_weights, n_episodes=n_eval_episodes, epsilon=0.01))
+
+
+def _receive_rollouts(rings, notify, timeout):
+    """ actorからの通知を待ち、届いているrolloutをすべて取り出す
+    """
+    if not notify.acquire(timeout=timeout):
+        return []
+
+    rollouts = []
+    for ring in rings:
+        payload = ring.get(timeout=0)
+        while payload is not None:
+            rollouts.append(pickle.loads(payload))
+            payload = ring.get(timeout=0)
+
+    #: 1件分の通知はacquire済み. 残りを消費しておく
+    #: (putとreleaseの間に取り出した分は次の空振りで消費される)
+    for _ in range(len(rollouts) - 1):
+        notify.acquire(False)
+
+    return rollouts
+
+
+def _check_workers(processes):
+    """ 落ちたworkerがあればdriverも止める(待ち続けないように)
+    """
+    for process in processes:
+        if process.exitcode is not None:
+            raise RuntimeError(
+                f"worker {process.name} exited with code {process.exitcode}")
+
+
+def _put(ring, payload, processes):
+    """ ringが空くまで待つ. 待っている間に相手が落ちていないか確かめる
+    """
+    while not ring.put(payload, timeout=1.):
+        _check_workers(processes)
+
+
+def max_rollout_bytes(n_experiences, n_frames):
+    """ rollout一回分をpickleしたときの大きさの上限
+
+        経験はzlib圧縮されるが、圧縮できなかった場合(state, next_stateの
+        uint8フレームそのまま + 余白)で見積もる
+    """
+    per_experience = 2 * 84 * 84 * n_frames + 1024
+
+    return n_experiences * per_experience + 2**16
+
+
+def weight_shapes(env_name, n_frames):
+    """ SharedWeightsを確保するための重みのshape. driverのGPUは隠しておくこと
+    """
+    action_space = gym.make(env_name).action_space.n
+
+    with tf.device("/CPU:0"):
+        qnet = DuelingQNetwork(action_space=action_space)
+
+        frame = preprocess_frame(gym.make(env_name).reset())
+        qnet(np.stack([frame] * n_frames, axis=2)[np.newaxis, ...])
+
+    return [w.shape for w in qnet.get_weights()]
+
+
+def main(num_actors, env_name="BreakoutDeterministic-v4",
+         gamma=0.99, batch_size=512,
+         n_frames=4, epsilon=0.5, eps_alpha=7.,
+         target_update_period=2400, num_minibatchs=16,
+         reward_clip=True, nstep=3, alpha=0.6, beta=0.4,
+         global_buffer_size=2**21,
+         local_buffer_size=100, profile=True,
+         mixed_precision=False, n_eval_episodes=8, use_target_cache=False,
+         fused_learner=False, n_envs_per_actor=1,
+         samples_per_insert=None, rate_error_buffer=None,
+         cpu_only=True, rollout_slot_size=None, minibatch_slot_size=2**27):
+    """ apex.mainと同じ学習をrayなしで行う
+
+    Args:
+        cpu_only: GPUを使わない(ローカルでのテスト用)
+        rollout_slot_size: actorごとのリングの1スロットのバイト数.
+            Noneならrollout一回分の上限(max_rollout_bytes)にする
+        minibatch_slot_size: learnerに渡すミニバッチ(num_minibatchs個分)の
+            リングの1スロットのバイト数
+    """
+
+    #: 大きすぎるrolloutはactorのputで落ちるので、始める前に確かめる
+    rollout_bytes = max_rollout_bytes(local_buffer_size * n_envs_per_actor, n_frames)
+    if rollout_slot_size is None:
+        rollout_slot_size = rollout_bytes
+    elif rollout_slot_size < rollout_bytes:
+        raise ValueError(
+            f"rollout_slot_size={rollout_slot_size} is smaller than a rollout of "
+            f"{local_buffer_size} x {n_envs_per_actor} experiences can be "
+            f"({rollout_bytes} bytes)")
+
+    if cpu_only:
+        #: spawnした子プロセスにも引き継がれる
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    #: driverはGPUを使わない. 先にGPUのメモリを確保してlearnerの分がなくならないように,
+    #: TFのランタイムを初期化する(summary writerやweight_shapes)より前に隠す
+    tf.config.set_visible_devices([], "GPU")
+
+    ctx = multiprocessing.get_context("spawn")
+
+    logdir = Path(__file__).parent / "log"
+    if logdir.exists():
+        shutil.rmtree(logdir)
+    summary_writer = tf.summary.create_file_writer(str(logdir))
+
+    profiler = Profiler(logdir=logdir, summary_writer=summary_writer,
+                        enabled=profile)
+
+    stats_writer = StatsWriter(summary_writer)
+
+    global_buffer = GlobalReplayBuffer(
+        capacity=global_buffer_size,
+        alpha=alpha, beta=beta, track_overwrites=use_target_cache)
+
+    stop_event = ctx.Event()
+
+    weights = SharedWeights(ctx, weight_shapes(env_name, n_frames))
+
+    #: actorごとにリングを持ち、届いたことはnotifyで知らせる
+    rollout_rings = [SharedRing(ctx, n_slots=2, slot_size=rollout_slot_size)
+                     for _ in range(num_actors)]
+    notify = ctx.Semaphore(0)
+
+    #: learnerは1つ学習している間に次の1つを受け取れるように2スロット
+    minibatch_ring = SharedRing(ctx, n_slots=2, slot_size=minibatch_slot_size)
+    result_ring = SharedRing(ctx, n_slots=2, slot_size=minibatch_slot_size // 16)
+
+    eval_requests, eval_results = ctx.Queue(), ctx.Queue()
+
+    #: εはenvごとに割り当てる
+    num_envs = num_actors * n_envs_per_actor
+    epsilons = [epsilon ** (1 + eps_alpha * i / (num_envs - 1)) for i in range(num_envs)]
+    epsilons = [max(0.01, eps) for eps in epsilons]
+
+    processes = [ctx.Process(
+        target=_actor_worker,
+        args=(dict(pid=i, env_name=env_name,
+                   epsilon=epsilons[i::num_actors],
+                   buffer_size=local_buffer_size,
+                   gamma=gamma, n_frames=n_frames, alpha=alpha,
+                   reward_clip=reward_clip, nstep=nstep,
+                   n_envs=n_envs_per_actor),
+              rollout_rings[i], notify, weights, stop_event))
+        for i in range(num_actors)]
+
+    processes.append(ctx.Process(
+        target=_learner_worker,
+        args=(dict(env_name=env_name, gamma=gamma, nstep=nstep,
+                   target_update_period=target_update_period,
+                   n_frames=n_frames, mixed_precision=mixed_precision,
+                   target_cache_size=global_buffer_size if use_target_cache else None,
+                   fused=fused_learner),
+              minibatch_ring, result_ring, weights, stop_event)))
+
+    processes.append(ctx.Process(
+        target=_tester_worker,
+        args=(env_name, eval_requests, eval_results, weights, n_eval_episodes,
+              stop_event)))
+
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    MIN_EXPERIENCES = 50000
+    samples_per_cycle = num_minibatchs * batch_size
+    if samples_per_insert is not None and rate_error_buffer is None:
+        rate_error_buffer = (samples_per_cycle
+                             + samples_per_insert * local_buffer_size * n_envs_per_actor)
+    rate_limiter = RateLimiter(
+        samples_per_insert, min_size=MIN_EXPERIENCES, error_buffer=rate_error_buffer)
+
+    held_rollouts = collections.deque()
+
+    #: learnerに渡してまだ結果が返ってきていない数
+    n_inflight = 0
+
+    eval_requests.put(True)
+
+    learner_count = 0
+    s = time.time()
+    count = 0
+    try:
+        while learner_count <= 5000:
+
+            _check_workers(processes)
+
+            #: 保留中のrolloutがあるあいだはringから取り出さない(actorはringが満杯になると止まる)
+            if not held_rollouts:
+                with profiler.span("actor_wait"):
+                    held_rollouts.extend(_receive_rollouts(rollout_rings, notify, timeout=0.01))
+
+            while held_rollouts and rate_limiter.can_insert(len(held_rollouts[0][1])):
+                priorities, experiences, pid = held_rollouts.popleft()
+                profiler.count("env_steps", len(experiences))
+                with profiler.span("replay_push"):
+                    global_buffer.push(priorities, experiences)
+                rate_limiter.insert(len(experiences))
+                count += 1
+
+            while n_inflight < 2 and rate_limiter.can_sample(samples_per_cycle):
+                with profiler.span("replay_sample"):
+                    minibatchs = [global_buffer.sample_batch(batch_size) for _ in range(num_minibatchs)]
+                    overwritten = global_buffer.pop_overwritten()
+                    payload = pickle.dumps(
+                        ("update", minibatchs, overwritten), protocol=pickle.HIGHEST_PROTOCOL)
+                rate_limiter.sample(samples_per_cycle)
+                _put(minibatch_ring, payload, processes)
+                n_inflight += 1
+
+            #: 挿入もサンプルもできず、learnerの結果も待っていなければ先に進めない
+            if (held_rollouts and n_inflight == 0
+                    and not rate_limiter.can_sample(samples_per_cycle)):
+                raise RuntimeError(
+                    "RateLimiter blocked both actors and learner, increase rate_error_buffer")
+
+            payload = result_ring.get(timeout=0.01 if held_rollouts else 0)
+            if payload is None:
+                profiler.step(learner_count)
+                continue
+
+            (indices, generations, td_errors,
+             loss_mean, cache_stats, layer_stats) = pickle.loads(payload)
+            n_inflight -= 1
+
+            print("Actor cycle", count)
+            print("Leaner", learner_count)
+            profiler.count("updates", num_minibatchs)
+            profiler.count("samples", samples_per_cycle)
+
+            with profiler.span("replay_update_priority"):
+                global_buffer.update_priorities(indices, td_errors, generations)
+
+            learner_count += 1
+            count = 0
+            with profiler.span("summary"):
+                with summary_writer.as_default():
+                    tf.summary.scalar("learner_loss", loss_mean, step=learner_count)
+                    if cache_stats is not None:
+                        tf.summary.scalar("target_cache_hit_rate",
+                                          cache_stats["hit_rate"], step=learner_count)
+
+            if layer_stats is not None:
+                stats_writer.write(learner_count, layer_stats)
+
+            #: 評価が終わっていれば記録して最新の重みで次の評価を始める(待たない)
+            try:
+                result = eval_results.get_nowait()
+            except queue.Empty:
+                result = None
+
+            if result is not None:
+                print("TEST:", result["mean"], result["median"], result["iqm"])
+                eval_requests.put(True)
+
+                with summary_writer.as_default():
+                    tf.summary.scalar(
+                        "test_steps", np.mean(result["steps"]), step=learner_count)
+                    for key in ("mean", "median", "iqm"):
+                        tf.summary.scalar(
+                            f"test_rewards/{key}", result[key], step=learner_count)
+
+            if learner_count % 10 == 0:
+                elapsed_time = (time.time() - s) / 10
+
+                with summary_writer.as_default():
+                    tf.summary.scalar("buffer_size", len(global_buffer), step=learner_count)
+                    tf.summary.scalar("Elapsed time", elapsed_time, step=learner_count)
+                    tf.summary.scalar("replay/stale_priority_updates",
+                                      global_buffer.pop_stale_updates(), step=learner_count)
+
+                    for key, value in rate_limiter.stats().items():
+                        tf.summary.scalar(f"replay/{key}", value, step=learner_count)
+
+                s = time.time()
+
+            if learner_count % 500 == 0:
+                print("Model Saved")
+                _put(minibatch_ring, pickle.dumps(("save", "checkpoints/qnet")), processes)
+
+            profiler.step(learner_count)
+
+    finally:
+        #: workerが落ちて例外で抜けた場合も残りのworkerを止める
+        stop_event.set()
+        eval_requests.put(None)
+        for process in processes:
+            process.join(timeout=10.)
+            if process.is_alive():
+                process.terminate()
+
+        stats_writer.close()
+        profiler.close()
+
+
+if __name__ == "__main__":
+    start = time.time()
+    main(num_actors=4)
+    print("Finished:", time.time() - start)
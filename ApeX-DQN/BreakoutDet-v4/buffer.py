@@ -74,9 +74,101 @@ class LocalReplayBuffer:
         return experiences
 
 
+class RateLimiter:
+    """ global bufferへの挿入数とサンプル数の比(samples per insert)を制御する
+
+        min_size個挿入したあとは
+        |samples_per_insert * (inserts - min_size) - samples| <= error_buffer
+        を保つように、挿入(actor)とサンプル(learner)のうち先行している側を止める.
+        止めている間にもう一方が進めば再開できるよう、error_bufferは
+        一回の挿入量 * samples_per_insert と一回のサンプル量の和の半分以上にすること
+
+    Args:
+        samples_per_insert (float): 目標の比. Noneなら制限しない
+        min_size (int): これだけ挿入するまではサンプルさせない
+        error_buffer (float): 許容するずれ(サンプル数単位)
+    """
+
+    def __init__(self, samples_per_insert, min_size, error_buffer):
+
+        self.samples_per_insert = samples_per_insert
+
+        self.min_size = min_size
+
+        self.error_buffer = error_buffer
+
+        self.inserts = 0
+
+        self.samples = 0
+
+        #: stats()で区間ごとの比を出すための前回の値. min_sizeまでの挿入は数えない
+        self.last_inserts, self.last_samples = min_size, 0
+
+        self.insert_throttled = 0
+
+        self.sample_throttled = 0
+
+    @property
+    def enabled(self):
+        return self.samples_per_insert is not None
+
+    def diff(self, inserts=0, samples=0):
+        """ 目標に対してサンプルが足りていない量(負ならサンプルしすぎ)
+        """
+        expected = self.samples_per_insert * (self.inserts + inserts - self.min_size)
+        return expected - (self.samples + samples)
+
+    def can_insert(self, n):
+
+        if not self.enabled or self.inserts + n <= self.min_size:
+            return True
+
+        if self.diff(inserts=n) <= self.error_buffer:
+            return True
+
+        self.insert_throttled += 1
+        return False
+
+    def can_sample(self, n):
+
+        if self.inserts < self.min_size:
+            return False
+
+        if not self.enabled or self.diff(samples=n) >= -self.error_buffer:
+            return True
+
+        self.sample_throttled += 1
+        return False
+
+    def insert(self, n):
+        self.inserts += n
+
+    def sample(self, n):
+        self.samples += n
+
+    def stats(self):
+        """ 前回呼んでからの samples per insert と止めた回数
+        """
+        inserts = self.inserts - self.last_inserts
+        samples = self.samples - self.last_samples
+        self.last_inserts, self.last_samples = self.inserts, self.samples
+
+        stats = {"samples_per_insert": samples / inserts if inserts > 0 else 0.,
+                 "insert_throttled": self.insert_throttled,
+                 "sample_throttled": self.sample_throttled}
+        self.insert_throttled, self.sample_throttled = 0, 0
+
+        return stats
+
+
 class GlobalReplayBuffer:
 
-    def __init__(self, capacity, alpha, beta):
+    def __init__(self, capacity, alpha, beta, track_overwrites=False):
+        """
+        Args:
+            track_overwrites (bool): 上書きしたスロットを記録する.
+                learner側のtarget出力のメモ(TargetCache)を無効にするのに使う
+        """
 
         assert capacity & (capacity - 1) == 0
 
@@ -94,6 +186,16 @@ class GlobalReplayBuffer:
 
         self.full = False
 
+        self.track_overwrites = track_overwrites
+
+        self.overwritten = []
+
+        #: スロットごとの世代. 上書きするたびに1増やす.
+        #: サンプル時の世代と一致しないpriorityの更新は古い遷移のものなので捨てる
+        self.generations = np.zeros(capacity, dtype=np.int64)
+
+        self.stale_updates = 0
+
     def __len__(self):
 
         return len(self.buffer) if self.full else self.next_idx
@@ -103,14 +205,23 @@ class GlobalReplayBuffer:
         assert len(priorities) == len(experiences)
 
         for priority, exp in zip(priorities, experiences):
+            if self.track_overwrites and self.full:
+                self.overwritten.append(self.next_idx)
             self.sumtree[self.next_idx] = priority
             self.buffer[self.next_idx] = exp
+            self.generations[self.next_idx] += 1
             self.next_idx += 1
             if self.next_idx == self.capacity:
                 self.full = True
                 self.next_idx = 0
 
     def sample_batch(self, batch_size):
+        """
+        Returns:
+            indices, weights, experiences, generations:
+                generationsはサンプルした時点のスロットの世代.
+                update_prioritiesにそのまま渡す
+        """
 
         indices = [self.sumtree.sample() for _ in range(batch_size)]
 
@@ -123,13 +234,39 @@ class GlobalReplayBuffer:
 
         experiences = [self.buffer[idx] for idx in indices]
 
-        return indices, weights, experiences
+        generations = self.generations[indices]
+
+        return indices, weights, experiences, generations
+
+    def pop_stale_updates(self):
+        """ 前回呼んでから捨てたpriorityの更新の数
+        """
+        stale_updates, self.stale_updates = self.stale_updates, 0
+
+        return stale_updates
 
-    def update_priorities(self, indices, td_errors):
+    def pop_overwritten(self):
+        """ 前回呼んでから上書きされたスロット番号
+        """
+        overwritten, self.overwritten = self.overwritten, []
+
+        return overwritten
+
+    def update_priorities(self, indices, td_errors, generations=None):
         """ Update priorities of sampled transitions.
+
+        Args:
+            generations: sample_batchで返した世代. 指定するとサンプルしてから
+                上書きされたスロットへの更新を捨てる
         """
         assert len(indices) == len(td_errors)
 
+        if generations is not None:
+            indices, td_errors = np.asarray(indices), np.asarray(td_errors)
+            is_fresh = self.generations[indices] == np.asarray(generations)
+            self.stale_updates += len(indices) - int(is_fresh.sum())
+            indices, td_errors = indices[is_fresh], td_errors[is_fresh]
+
         for idx, td_error in zip(indices, td_errors):
             priority = (abs(td_error) + 0.001) ** self.alpha
             self.sumtree[idx] = priority**self.alpha
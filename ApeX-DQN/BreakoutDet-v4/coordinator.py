@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import time
+from concurrent import futures
+
+import ray
+import tensorflow as tf
+import numpy as np
+
+
+class Coordinator:
+    """ actor / learner / tester / replay bufferの間の受け渡しをasyncioのタスクで行う
+
+        - ingest_rollouts: 終わったrolloutを起きるたびにすべて回収し、
+          挿入してよいactorにはすぐ次のrolloutを出す
+        - sample_minibatchs: RateLimiterが許せばミニバッチを用意してキューに入れる
+        - train: キューのミニバッチをlearnerに渡し、結果を記録する
+        - update_priorities: learnerが返したTD誤差でpriorityを更新する
+        - evaluate: 最新の重みで評価を繰り返す
+
+        replay bufferへの操作(push / sample / update_priorities)は
+        1スレッドのexecutorで順に行うので、ミニバッチのサンプル中も
+        イベントループは止まらずactorへの指示を出せる.
+        RateLimiterの勘定はイベントループ側で、操作を投げる時点で行う
+    """
+
+    def __init__(self, actors, learner, test_actor, global_buffer, rate_limiter,
+                 summary_writer, stats_writer, profiler, batch_size, num_minibatchs,
+                 n_eval_episodes, max_learner_count=5000):
+
+        self.actors = actors
+
+        self.learner = learner
+
+        self.test_actor = test_actor
+
+        self.global_buffer = global_buffer
+
+        self.rate_limiter = rate_limiter
+
+        self.summary_writer = summary_writer
+
+        self.stats_writer = stats_writer
+
+        self.profiler = profiler
+
+        self.batch_size = batch_size
+
+        self.num_minibatchs = num_minibatchs
+
+        self.samples_per_cycle = num_minibatchs * batch_size
+
+        self.n_eval_episodes = n_eval_episodes
+
+        self.max_learner_count = max_learner_count
+
+        self.replay_executor = futures.ThreadPoolExecutor(max_workers=1)
+
+        self.current_weights = None
+
+        self.learner_count = 0
+
+        #: 前回learnerの結果を受け取ってから挿入したrolloutの数
+        self.actor_count = 0
+
+    async def replay(self, fn, *args):
+        """ replay bufferへの操作をexecutorで行う. 投げた順に実行される
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.replay_executor, fn, *args)
+
+    async def run(self, current_weights):
+
+        self.current_weights = current_weights
+
+        #: 挿入/サンプルでRateLimiterの状態が変わったことを知らせる
+        self.inserted = asyncio.Event()
+
+        self.sampled = asyncio.Event()
+
+        #: サンプル済みで渡す前のミニバッチ. learnerが1つ学習している間に1つ用意しておく
+        self.minibatch_queue = asyncio.Queue(maxsize=1)
+
+        self.priority_queue = asyncio.Queue()
+
+        trainer = asyncio.create_task(self.train())
+        tasks = [asyncio.create_task(coro) for coro in
+                 (self.ingest_rollouts(), self.sample_minibatchs(),
+                  self.update_priorities(), self.evaluate())]
+
+        try:
+            #: 他のタスクが例外で終わった場合もここで止める
+            done, _ = await asyncio.wait(
+                [trainer] + tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in [trainer] + tasks:
+                task.cancel()
+            await asyncio.gather(trainer, *tasks, return_exceptions=True)
+            self.replay_executor.shutdown()
+
+    async def ingest_rollouts(self):
+
+        pending = {}  #: pid -> ObjectRef
+        waiters = {}  #: pid -> asyncio.Future
+
+        def dispatch(pid):
+            ref = self.actors[pid].rollout.remote(self.current_weights)
+            pending[pid] = ref
+            waiters[pid] = asyncio.wrap_future(ref.future())
+
+        for pid in range(len(self.actors)):
+            dispatch(pid)
+
+        #: RateLimiterに止められたrollout. そのactorは挿入できるまで次のrolloutを始めない
+        held_rollouts = collections.deque()
+
+        loop = asyncio.get_running_loop()
+
+        #: executorに投げて終わっていないpush
+        pushes = []
+
+        while True:
+
+            #: 終わったpushの例外はここで上げる
+            for push in [push for push in pushes if push.done()]:
+                push.result()
+                pushes.remove(push)
+
+            wakeups = list(waiters.values())
+            sampled = None
+            if held_rollouts:
+                if not pending and not self.rate_limiter.can_sample(self.samples_per_cycle):
+                    raise RuntimeError(
+                        "RateLimiter blocked both actors and learner, increase rate_error_buffer")
+                #: サンプルされれば保留中のrolloutを挿入できるかもしれない
+                sampled = asyncio.ensure_future(self.sampled.wait())
+                wakeups.append(sampled)
+
+            with self.profiler.span("actor_wait"):
+                await asyncio.wait(wakeups, return_when=asyncio.FIRST_COMPLETED)
+
+            if sampled is not None:
+                sampled.cancel()
+
+            #: 起きた時点で終わっているものはまとめて回収する
+            if pending:
+                pids = list(pending)
+                ready, _ = ray.wait([pending[pid] for pid in pids],
+                                    num_returns=len(pids), timeout=0)
+                ready = set(ready)
+                finished = [pid for pid in pids if pending[pid] in ready]
+
+                held_rollouts.extend(ray.get([pending[pid] for pid in finished]))
+                for pid in finished:
+                    del pending[pid], waiters[pid]
+
+            #: 挿入できるものは先に次のrolloutを出してからbufferに入れる
+            inserted = []
+            while held_rollouts and self.rate_limiter.can_insert(len(held_rollouts[0][1])):
+                priorities, experiences, pid = held_rollouts.popleft()
+                self.rate_limiter.insert(len(experiences))
+                self.profiler.count("env_steps", len(experiences))
+                dispatch(pid)
+                inserted.append((priorities, experiences))
+
+            #: ここから次に待つまでの間のサンプルを取りこぼさないようにclearしておく
+            self.sampled.clear()
+
+            if inserted:
+                #: pushは投げるだけで待たない(サンプル中でもすぐactorを待ちに戻る).
+                #: executorは1スレッドなので、この後に投げるサンプルより先に実行される
+                for priorities, experiences in inserted:
+                    pushes.append(loop.run_in_executor(
+                        self.replay_executor, self.global_buffer.push,
+                        priorities, experiences))
+                self.actor_count += len(inserted)
+                self.inserted.set()
+
+    def _sample(self):
+
+        minibatchs = [self.global_buffer.sample_batch(self.batch_size)
+                      for _ in range(self.num_minibatchs)]
+
+        #: 上書きされたスロットはミニバッチをサンプルした時点で区切ってlearnerに渡す
+        return minibatchs, self.global_buffer.pop_overwritten()
+
+    async def sample_minibatchs(self):
+
+        setup_finished = False
+        while True:
+
+            while not self.rate_limiter.can_sample(self.samples_per_cycle):
+                self.inserted.clear()
+                await self.inserted.wait()
+
+            if not setup_finished:
+                print("Setup finished")
+                setup_finished = True
+
+            self.rate_limiter.sample(self.samples_per_cycle)
+            self.sampled.set()
+
+            with self.profiler.span("replay_sample"):
+                minibatchs, overwritten = await self.replay(self._sample)
+
+            await self.minibatch_queue.put((minibatchs, overwritten))
+
+    async def update_priorities(self):
+
+        while True:
+
+            indices, generations, td_errors = await self.priority_queue.get()
+
+            with self.profiler.span("replay_update_priority"):
+                await self.replay(
+                    self.global_buffer.update_priorities, indices, td_errors, generations)
+
+    async def train(self):
+
+        s = time.time()
+        while self.learner_count <= self.max_learner_count:
+
+            minibatchs, overwritten = await self.minibatch_queue.get()
+
+            learner_future = self.learner.update_qnetwork.remote(minibatchs, overwritten)
+            self.learner_count += 1
+
+            with self.profiler.span("learner_fetch"):
+                (current_weights, indices, generations,
+                 td_errors, loss_mean, cache_stats, layer_stats) = await learner_future
+                self.current_weights = ray.put(current_weights)
+
+            print("Actor cycle", self.actor_count)
+            print("Leaner", self.learner_count)
+            self.actor_count = 0
+            self.profiler.count("updates", self.num_minibatchs)
+            self.profiler.count("samples", self.samples_per_cycle)
+
+            self.priority_queue.put_nowait((indices, generations, td_errors))
+
+            learner_count = self.learner_count
+            with self.profiler.span("summary"):
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("learner_loss", loss_mean, step=learner_count)
+                    if cache_stats is not None:
+                        tf.summary.scalar("target_cache_hit_rate",
+                                          cache_stats["hit_rate"], step=learner_count)
+
+            #: learnerが統計をとった回だけdictが返ってくる. 書き込みは別スレッド
+            if layer_stats is not None:
+                self.stats_writer.write(learner_count, layer_stats)
+
+            if learner_count % 10 == 0:
+                elapsed_time = (time.time() - s) / 10
+
+                #: bufferはreplay_executorからしか触らない
+                buffer_size = await self.replay(len, self.global_buffer)
+                stale_updates = await self.replay(self.global_buffer.pop_stale_updates)
+
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("buffer_size", buffer_size, step=learner_count)
+                    tf.summary.scalar("Elapsed time", elapsed_time, step=learner_count)
+
+                    tf.summary.scalar("replay/stale_priority_updates",
+                                      stale_updates, step=learner_count)
+
+                    for key, value in self.rate_limiter.stats().items():
+                        tf.summary.scalar(f"replay/{key}", value, step=learner_count)
+
+                s = time.time()
+
+            if learner_count % 500 == 0:
+                print("Model Saved")
+                self.learner.save.remote("checkpoints/qnet")
+
+            self.profiler.step(learner_count)
+
+    async def evaluate(self):
+
+        while True:
+
+            result = await self.test_actor.play_batched.remote(
+                self.current_weights, n_episodes=self.n_eval_episodes, epsilon=0.01)
+            print("TEST:", result["mean"], result["median"], result["iqm"])
+
+            with self.summary_writer.as_default():
+                tf.summary.scalar(
+                    "test_steps", np.mean(result["steps"]), step=self.learner_count)
+                for key in ("mean", "median", "iqm"):
+                    tf.summary.scalar(
+                        f"test_rewards/{key}", result[key], step=self.learner_count)
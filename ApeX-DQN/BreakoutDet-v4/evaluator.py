@@ -0,0 +1,81 @@
+import collections
+
+import gym
+import numpy as np
+
+from util import preprocess_frame
+
+
+def score_stats(scores):
+    """ テストスコアの分布の要約
+
+        IQM(interquartile mean)は上下25%ずつを除いた平均
+    """
+    scores = np.sort(np.asarray(scores, dtype=np.float64))
+
+    n = len(scores)
+    trimmed = scores[n // 4: n - n // 4] if n >= 4 else scores
+
+    return {"mean": float(scores.mean()),
+            "median": float(np.median(scores)),
+            "iqm": float(trimmed.mean()),
+            "std": float(scores.std()),
+            "min": float(scores.min()),
+            "max": float(scores.max()),
+            "n_episodes": n}
+
+
+def evaluate(network, env_name, n_episodes=8, n_frames=4, epsilon=0.05,
+             stall_steps=500, stall_score=3, seed=0):
+    """ n_episodes個のエピソードを同時に進め、行動選択は一回のバッチ推論で行う
+
+    Args:
+        network: sample_actions(states)を持つネットワーク
+        stall_steps, stall_score: stall_stepsを超えてもstall_score未満なら打ち切る
+            (ゲーム開始(action: 0)しないまま停滞するケースへの対処)
+
+    Returns:
+        scores, steps: エピソードごとのスコアとステップ数
+    """
+    envs = [gym.make(env_name) for _ in range(n_episodes)]
+    for i, env in enumerate(envs):
+        env.seed(seed + i)
+
+    action_space = envs[0].action_space.n
+
+    frames = []
+    for env in envs:
+        frame = preprocess_frame(env.reset())
+        frames.append(collections.deque([frame] * n_frames, maxlen=n_frames))
+
+    scores = np.zeros(n_episodes)
+    steps = np.zeros(n_episodes, dtype=np.int64)
+    active = np.ones(n_episodes, dtype=bool)
+
+    while active.any():
+
+        indices = np.flatnonzero(active)
+
+        states = np.stack([np.stack(frames[i], axis=2) for i in indices])
+        greedy_actions, _ = network.sample_actions(states)
+        greedy_actions = np.asarray(greedy_actions).flatten()
+
+        is_random = np.random.random(len(indices)) < epsilon
+        actions = np.where(
+            is_random, np.random.randint(action_space, size=len(indices)),
+            greedy_actions)
+
+        for i, action in zip(indices, actions):
+            next_frame, reward, done, _ = envs[i].step(int(action))
+            frames[i].append(preprocess_frame(next_frame))
+
+            scores[i] += reward
+            steps[i] += 1
+
+            if done or (steps[i] > stall_steps and scores[i] < stall_score):
+                active[i] = False
+
+    for env in envs:
+        env.close()
+
+    return scores.tolist(), steps.tolist()
@@ -0,0 +1,127 @@
+import queue
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+
+def summarize(x, n_quantiles):
+    """ 配列の分布を等間隔の分位点といくつかのスカラーにまとめる
+    """
+    x = np.asarray(x, dtype=np.float32).ravel()
+
+    return {"quantiles": np.quantile(x, np.linspace(0., 1., n_quantiles)).astype(np.float32),
+            "mean": float(x.mean()),
+            "std": float(x.std()),
+            "norm": float(np.linalg.norm(x))}
+
+
+class LayerStats:
+    """ learner側でネットワークの重みと中間出力の統計をとる
+
+        interval回に一回だけ、Keras layerではなく小さなdict
+        (分位点, ノルム, 更新量の比など)を返す.
+        update_ratioはその回の学習(update_qnetwork一回分)での
+        ||w_after - w_before|| / ||w_before||
+
+    Args:
+        interval (int): 何回のupdate_qnetworkに一回統計をとるか
+        n_quantiles (int): 分位点の数. histogramはこの点から描く
+        n_samples (int): 中間出力を計算するのに使う状態の数
+    """
+
+    def __init__(self, interval=10, n_quantiles=33, n_samples=32):
+
+        self.interval = interval
+
+        self.n_quantiles = n_quantiles
+
+        self.n_samples = n_samples
+
+        self.n_calls = 0
+
+        self.before = None
+
+    def begin(self, qnet):
+        """ update_qnetworkの最初に呼ぶ. 統計をとる回なら更新前の重みを控える
+
+        Returns:
+            bool: この回に統計をとるかどうか
+        """
+        self.n_calls += 1
+
+        if self.n_calls % self.interval != 0:
+            return False
+
+        self.before = [var.numpy() for var in qnet.trainable_variables]
+
+        return True
+
+    def end(self, qnet, states):
+        """ beginがTrueを返した回の最後に呼ぶ
+
+        Args:
+            states: 中間出力の統計に使う状態. 先頭のn_samples個だけ使う
+        """
+        stats = {}
+
+        for var, before in zip(qnet.trainable_variables, self.before):
+            after = var.numpy()
+            summary = summarize(after, self.n_quantiles)
+            summary["update_ratio"] = float(
+                np.linalg.norm(after - before) / (np.linalg.norm(before) + 1e-12))
+            stats[f"weights/{var.name}"] = summary
+
+        self.before = None
+
+        for name, activation in qnet.activations(states[:self.n_samples]).items():
+            activation = activation.numpy()
+            summary = summarize(activation, self.n_quantiles)
+            #: reluの出力が0の割合 (dead unitの目安)
+            summary["zero_fraction"] = float((activation == 0).mean())
+            stats[f"activations/{name}"] = summary
+
+        return stats
+
+
+class StatsWriter:
+    """ LayerStatsの結果をバックグラウンドのスレッドでTensorBoardに書く
+
+        write()はキューに積むだけなのでdriverのループを止めない.
+        histogramは分位点から描く(各点が同じ確率質量を持つので分布の形が残る)
+    """
+
+    def __init__(self, summary_writer):
+
+        self.summary_writer = summary_writer
+
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+        self.thread.start()
+
+    def write(self, step, stats):
+
+        self.queue.put((step, stats))
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+
+        while True:
+
+            item = self.queue.get()
+            if item is None:
+                break
+
+            step, stats = item
+            with self.summary_writer.as_default():
+                for name, summary in stats.items():
+                    tf.summary.histogram(name, summary["quantiles"], step=step)
+                    for key, value in summary.items():
+                        if key != "quantiles":
+                            tf.summary.scalar(f"{name}/{key}", value, step=step)
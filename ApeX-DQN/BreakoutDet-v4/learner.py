@@ -0,0 +1,276 @@
+import pickle
+import zlib
+from concurrent import futures
+
+import tensorflow as tf
+import gym
+import numpy as np
+
+from model import DuelingQNetwork
+from util import preprocess_frame
+from target_cache import TargetCache
+from layer_stats import LayerStats
+from mixed_precision import (
+    enable_mixed_precision, wrap_optimizer, scale_loss, unscale_gradients)
+
+
+class Learner:
+
+    def __init__(self, env_name, gamma, nstep,
+                 target_update_period, n_frames, mixed_precision=False,
+                 target_cache_size=None, fused=False, stats_interval=10):
+        """
+        Args:
+            target_cache_size (int): global bufferの容量. 指定すると
+                target networkの出力をスロットごとにメモする(TargetCache)
+            fused (bool): update_qnetworkで受け取ったミニバッチを積んで、
+                すべての更新を一つのtf.functionの中で行う
+            stats_interval (int): update_qnetworkの何回に一回、重みと
+                中間出力の統計(LayerStats)を返すか. Noneなら返さない
+        """
+        if fused and target_cache_size:
+            #: target出力はtf.functionの中で計算するのでメモを挟めない
+            raise ValueError("fused learner does not support the target cache")
+
+        self.env_name = env_name
+
+        self.gamma = gamma
+
+        self.nstep = nstep
+
+        self.action_space = gym.make(env_name).action_space.n
+
+        if mixed_precision:
+            enable_mixed_precision()
+
+        self.qnet = DuelingQNetwork(action_space=self.action_space)
+
+        self.target_qnet = DuelingQNetwork(action_space=self.action_space)
+
+        self.target_update_period = target_update_period
+
+        self.n_frames = n_frames
+
+        #self.optimizer = tf.keras.optimizers.Adam(lr=0.0001)
+
+        self.optimizer = wrap_optimizer(tf.keras.optimizers.RMSprop(
+            learning_rate= 0.00025 / 4, rho=0.95, momentum=0.0,
+            epsilon=1.5e-07, centered=True))
+
+        self.update_count = 0
+
+        self.fused = fused
+
+        self.target_cache = (
+            TargetCache(target_cache_size) if target_cache_size else None)
+
+        self.layer_stats = (
+            LayerStats(interval=stats_interval) if stats_interval else None)
+
+    def define_network(self):
+
+        env = gym.make(self.env_name)
+        frame = preprocess_frame(env.reset())
+        frames = [frame] * self.n_frames
+        state = np.stack(frames, axis=2)[np.newaxis, ...]
+
+        #: define by run
+        self.qnet(state)
+        self.target_qnet(state)
+        self.target_qnet.set_weights(self.qnet.get_weights())
+
+        return self.qnet.get_weights()
+
+    def save(self, save_path):
+        self.qnet.save_weights(save_path)
+
+    def target_outputs(self, indices, next_states):
+
+        compute = lambda x: self.target_qnet.sample_actions(x)[1]
+
+        if self.target_cache is None:
+            return compute(next_states)
+
+        return self.target_cache.get(indices, next_states, compute)
+
+    def update_qnetwork(self, compressed_minibatchs, overwritten=None):
+        """
+        Args:
+            overwritten: compressed_minibatchsをサンプルするまでに
+                global bufferで上書きされたスロット. メモを捨ててから学習する
+
+        Returns:
+            current_weights, indices, generations, td_errors, loss_mean,
+            cache_stats, layer_stats: layer_statsは統計をとらない回はNone
+        """
+        collect_stats = (self.layer_stats is not None
+                         and self.layer_stats.begin(self.qnet))
+
+        if self.fused:
+            return self.update_qnetwork_fused(compressed_minibatchs, collect_stats)
+
+        if self.target_cache is not None and overwritten:
+            self.target_cache.invalidate(overwritten)
+
+        indices_all, generations_all, td_errors_all = [], [], []
+        loss_list = []
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            """ batchをdecompressして整形する作業がわりと重いのでthreading
+            """
+            work_in_progresses = [
+                executor.submit(self.prepare_minibatch, compressed)
+                for compressed in compressed_minibatchs]
+
+            for ready_batch in futures.as_completed(work_in_progresses):
+
+                indices, per_weights, minibacth, generations = ready_batch.result()
+                states, actions, rewards, next_states, dones = minibacth
+
+                next_actions, _ = self.qnet.sample_actions(next_states)
+                next_qvalues = self.target_outputs(np.array(indices), next_states)
+
+                next_actions_onehot = tf.one_hot(next_actions, self.action_space)
+                max_next_qvalues = tf.reduce_sum(
+                    next_qvalues * next_actions_onehot, axis=1, keepdims=True)
+
+                target_q = rewards + self.gamma ** (self.nstep) * (1 - dones) * max_next_qvalues
+
+                with tf.GradientTape() as tape:
+
+                    qvalues = self.qnet(states)
+                    actions_onehot = tf.one_hot(
+                        actions.flatten().astype(np.int32), self.action_space)
+                    q = tf.reduce_sum(
+                        qvalues * actions_onehot, axis=1, keepdims=True)
+
+                    #td_loss = huber_loss(target_q, q)
+                    td_loss = tf.square(target_q - q)
+                    loss = tf.reduce_mean(per_weights * td_loss)
+                    scaled_loss = scale_loss(self.optimizer, loss)
+
+                grads = tape.gradient(scaled_loss, self.qnet.trainable_variables)
+                grads = unscale_gradients(self.optimizer, grads)
+                grads, _ = tf.clip_by_global_norm(grads, 40.0)
+                self.optimizer.apply_gradients(
+                    zip(grads, self.qnet.trainable_variables))
+
+                indices_all += indices
+                generations_all += generations.tolist()
+                td_errors_all += td_loss.numpy().flatten().tolist()
+                loss_list.append(loss.numpy())
+                self.update_count += 1
+
+                if self.update_count % self.target_update_period == 0:
+                    print("== target_update ==")
+                    self.target_qnet.set_weights(self.qnet.get_weights())
+                    if self.target_cache is not None:
+                        self.target_cache.sync()
+
+        loss_mean = np.array(loss_list).mean()
+        current_weights = self.qnet.get_weights()
+        cache_stats = self.target_cache.stats() if self.target_cache else None
+        layer_stats = self.layer_stats.end(self.qnet, states) if collect_stats else None
+        return (current_weights, indices_all, generations_all,
+                td_errors_all, loss_mean, cache_stats, layer_stats)
+
+    def update_qnetwork_fused(self, compressed_minibatchs, collect_stats=False):
+        """ update_qnetworkと同じ更新を、K個のミニバッチを積んで
+            一回のtf.function呼び出しで行う. host側との同期は最後の一回だけ
+        """
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            minibatchs = list(executor.map(
+                self.prepare_minibatch, compressed_minibatchs))
+
+        indices = np.concatenate([np.asarray(m[0]) for m in minibatchs])
+        generations = np.concatenate([m[3] for m in minibatchs])
+        per_weights = np.stack([m[1] for m in minibatchs])
+        states, actions, rewards, next_states, dones = (
+            np.stack(x) for x in zip(*[m[2] for m in minibatchs]))
+
+        losses, td_errors = self.fused_update(
+            tf.constant(self.update_count, dtype=tf.int64), per_weights,
+            states, actions.astype(np.int32), rewards.astype(np.float32),
+            next_states, dones.astype(np.float32))
+
+        n_updates = len(minibatchs)
+        if (self.update_count + n_updates) // self.target_update_period \
+                != self.update_count // self.target_update_period:
+            print("== target_update ==")
+        self.update_count += n_updates
+
+        loss_mean = losses.numpy().mean()
+        current_weights = self.qnet.get_weights()
+        layer_stats = self.layer_stats.end(self.qnet, states[-1]) if collect_stats else None
+        return (current_weights, indices, generations,
+                td_errors.numpy(), loss_mean, None, layer_stats)
+
+    @tf.function
+    def fused_update(self, update_count, per_weights, states, actions,
+                     rewards, next_states, dones):
+        """
+        Args:
+            update_count: この呼び出しの前までの更新回数
+            per_weights, states, ...: 先頭の次元がミニバッチ(K個)
+
+        Returns:
+            losses: shape==(K,)
+            td_errors: shape==(K * batch_size,)
+        """
+        losses, td_errors = [], []
+        for k in range(states.shape[0]):
+
+            next_actions, _ = self.qnet.sample_actions(next_states[k])
+            _, next_qvalues = self.target_qnet.sample_actions(next_states[k])
+
+            next_actions_onehot = tf.one_hot(next_actions, self.action_space)
+            max_next_qvalues = tf.reduce_sum(
+                next_qvalues * next_actions_onehot, axis=1, keepdims=True)
+
+            target_q = rewards[k] + self.gamma ** (self.nstep) * (1 - dones[k]) * max_next_qvalues
+
+            with tf.GradientTape() as tape:
+
+                qvalues = self.qnet(states[k])
+                actions_onehot = tf.one_hot(
+                    tf.reshape(actions[k], [-1]), self.action_space)
+                q = tf.reduce_sum(
+                    qvalues * actions_onehot, axis=1, keepdims=True)
+
+                td_loss = tf.square(target_q - q)
+                loss = tf.reduce_mean(per_weights[k] * td_loss)
+                scaled_loss = scale_loss(self.optimizer, loss)
+
+            grads = tape.gradient(scaled_loss, self.qnet.trainable_variables)
+            grads = unscale_gradients(self.optimizer, grads)
+            grads, _ = tf.clip_by_global_norm(grads, 40.0)
+            self.optimizer.apply_gradients(
+                zip(grads, self.qnet.trainable_variables))
+
+            losses.append(loss)
+            td_errors.append(tf.reshape(td_loss, [-1]))
+
+            #: 逐次版と同じく target_update_period 回目の更新の直後に同期する
+            if (update_count + k + 1) % self.target_update_period == 0:
+                for target_var, var in zip(self.target_qnet.variables,
+                                           self.qnet.variables):
+                    target_var.assign(var)
+
+        return tf.stack(losses), tf.concat(td_errors, axis=0)
+
+    @staticmethod
+    def prepare_minibatch(compressed_minibatch):
+        indices, per_weights, experiences, generations = compressed_minibatch
+
+        per_weights = tf.convert_to_tensor(
+            per_weights.reshape(-1, 1), dtype=tf.float32)
+
+        experiences = [pickle.loads(zlib.decompress(exp)) for exp in experiences]
+
+        states = np.vstack([exp.state for exp in experiences])
+        actions = np.vstack([exp.action for exp in experiences]).astype(np.float32)
+        rewards = np.array([exp.reward for exp in experiences]).reshape(-1, 1)
+        next_states = np.vstack(
+            [exp.next_state for exp in experiences])
+        dones = np.array([exp.done for exp in experiences]).reshape(-1, 1)
+
+        return indices, per_weights, (states, actions, rewards, next_states, dones), generations
@@ -24,16 +24,21 @@ class DuelingQNetwork(tf.keras.Model):
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.value = kl.Dense(1, kernel_initializer="he_normal")
+        #: mixed precisionでも出力はfloat32
+        self.value = kl.Dense(1, dtype="float32",
+                              kernel_initializer="he_normal")
 
         self.dense2 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.advantages = kl.Dense(self.action_space,
+        self.advantages = kl.Dense(self.action_space, dtype="float32",
                                    kernel_initializer="he_normal")
 
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -50,6 +55,19 @@ class DuelingQNetwork(tf.keras.Model):
 
         return q_values
 
+    def activations(self, x):
+        """ 統計をとるための中間出力. callと同じ計算をたどる
+        """
+        x = tf.cast(x, tf.float32) / 255.
+
+        conv1 = self.conv1(x)
+        conv2 = self.conv2(conv1)
+        conv3 = self.conv3(conv2)
+        x = self.flatten1(conv3)
+
+        return {"conv1": conv1, "conv2": conv2, "conv3": conv3,
+                "dense1": self.dense1(x), "dense2": self.dense2(x)}
+
     def sample_action(self, x, epsilon):
 
         if random.random() > epsilon:
@@ -4,7 +4,6 @@ import zlib
 from pathlib import Path
 import shutil
 
-import ray
 import gym
 import numpy as np
 import tensorflow as tf
@@ -12,20 +11,29 @@ import tensorflow as tf
 from model import DuelingQNetwork
 from buffer import LocalReplayBuffer
 from util import preprocess_frame
+from evaluator import evaluate, score_stats
 
 
-@ray.remote(num_cpus=1)
 class Actor:
+    """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+    Args:
+        epsilon (float or list): envごとのε. floatならすべてのenvで同じ
+        buffer_size (int): 一回のrolloutでenvごとに進めるステップ数
+    """
 
     def __init__(self, pid, env_name, epsilon, alpha,
                  buffer_size, n_frames,
-                 gamma, nstep, reward_clip):
+                 gamma, nstep, reward_clip, n_envs=1):
 
         self.pid = pid
 
-        self.env = gym.make(env_name)
+        self.n_envs = n_envs
 
-        self.epsilon = epsilon
+        self.envs = [gym.make(env_name) for _ in range(n_envs)]
+
+        self.epsilons = np.broadcast_to(
+            np.asarray(epsilon, dtype=np.float64), (n_envs,))
 
         self.gamma = gamma
 
@@ -33,24 +41,26 @@ class Actor:
 
         self.n_frames = n_frames
 
-        self.action_space = self.env.action_space.n
+        self.action_space = self.envs[0].action_space.n
 
-        self.frames = collections.deque(maxlen=n_frames)
+        self.frames = [collections.deque(maxlen=n_frames) for _ in range(n_envs)]
 
         self.nstep = nstep
 
         self.buffer_size = buffer_size
 
-        self.local_buffer = LocalReplayBuffer(
-            reward_clip=reward_clip, gamma=gamma, nstep=nstep)
+        #: n-step遷移はenvごとに組み立てる
+        self.local_buffers = [
+            LocalReplayBuffer(reward_clip=reward_clip, gamma=gamma, nstep=nstep)
+            for _ in range(n_envs)]
 
         self.local_qnet = DuelingQNetwork(action_space=self.action_space)
 
-        self.episode_steps = 0
+        self.episode_steps = np.zeros(n_envs, dtype=np.int64)
 
-        self.episode_rewards = 0
+        self.episode_rewards = np.zeros(n_envs)
 
-        self.lives = 5  #: Breakout only
+        self.lives = [5] * n_envs  #: Breakout only
 
         self.define_network()
 
@@ -60,12 +70,16 @@ class Actor:
         tf.config.set_visible_devices([], 'GPU')
 
         #: define by run
-        frame = preprocess_frame(self.env.reset())
-        for _ in range(self.n_frames):
-            self.frames.append(frame)
+        for env, frames in zip(self.envs, self.frames):
+            frame = preprocess_frame(env.reset())
+            for _ in range(self.n_frames):
+                frames.append(frame)
 
-        state = np.stack(self.frames, axis=2)[np.newaxis, ...]
-        self.local_qnet(state)
+        self.local_qnet(self.stacked_states())
+
+    def stacked_states(self):
+
+        return np.stack([np.stack(frames, axis=2) for frames in self.frames])
 
     def rollout(self, current_weights):
 
@@ -73,66 +87,75 @@ class Actor:
 
         self.local_qnet.set_weights(current_weights)
 
-        state = np.stack(self.frames, axis=2)[np.newaxis, ...]
-
         for _ in range(self.buffer_size):
 
-            state = np.stack(self.frames, axis=2)[np.newaxis, ...]
+            states = self.stacked_states()
 
-            action = self.local_qnet.sample_action(state, self.epsilon)
+            greedy_actions, _ = self.local_qnet.sample_actions(states)
+            greedy_actions = greedy_actions.numpy()
 
-            next_frame, reward, done, info = self.env.step(action)
+            is_random = np.random.random(self.n_envs) < self.epsilons
+            actions = np.where(
+                is_random, np.random.randint(self.action_space, size=self.n_envs),
+                greedy_actions)
 
-            self.episode_steps += 1
+            for i, (env, action) in enumerate(zip(self.envs, actions)):
 
-            self.episode_rewards += reward
+                action = int(action)
 
-            self.frames.append(preprocess_frame(next_frame))
+                next_frame, reward, done, info = env.step(action)
 
-            next_state = np.stack(self.frames, axis=2)[np.newaxis, ...]
+                self.episode_steps[i] += 1
 
-            if self.lives != info["ale.lives"]:
-                #: loss of life as episode ends
-                transition = (state, action, reward, next_state, True)
-                self.lives = info["ale.lives"]
-            else:
-                transition = (state, action, reward, next_state, done)
+                self.episode_rewards[i] += reward
 
-            self.local_buffer.push(transition)
+                self.frames[i].append(preprocess_frame(next_frame))
 
-            if done:
-                print(self.pid, self.episode_steps, self.episode_rewards, round(self.epsilon, 3))
-                self.episode_steps = 0
-                self.episode_rewards = 0
-                self.lives = 5
-                frame = preprocess_frame(self.env.reset())
-                for _ in range(self.n_frames):
-                    self.frames.append(frame)
+                state = states[[i]]
 
-        experiences = self.local_buffer.pull()
+                next_state = np.stack(self.frames[i], axis=2)[np.newaxis, ...]
+
+                if self.lives[i] != info["ale.lives"]:
+                    #: loss of life as episode ends
+                    transition = (state, action, reward, next_state, True)
+                    self.lives[i] = info["ale.lives"]
+                else:
+                    transition = (state, action, reward, next_state, done)
+
+                self.local_buffers[i].push(transition)
+
+                if done:
+                    print(self.pid, i, self.episode_steps[i], self.episode_rewards[i],
+                          round(self.epsilons[i], 3))
+                    self.episode_steps[i] = 0
+                    self.episode_rewards[i] = 0
+                    self.lives[i] = 5
+                    frame = preprocess_frame(env.reset())
+                    for _ in range(self.n_frames):
+                        self.frames[i].append(frame)
+
+        experiences = [exp for buffer in self.local_buffers for exp in buffer.pull()]
 
         states = np.vstack(
-            [exp.state for exp in experiences]).astype(np.float32)
+            [exp.state for exp in experiences])
         actions = np.vstack(
             [exp.action for exp in experiences]).astype(np.float32)
         rewards = np.array(
             [exp.reward for exp in experiences]).reshape(-1, 1)
         next_states = np.vstack(
             [exp.next_state for exp in experiences]
-            ).astype(np.float32)
+            )
         dones = np.array(
             [exp.done for exp in experiences]).reshape(-1, 1)
 
-        next_actions, next_qvalues = self.local_qnet.sample_actions(next_states)
+        #: stateとnext_stateをまとめて一回のforwardで
+        qvalues_all = self.local_qnet(np.concatenate([states, next_states]))
+        qvalues, next_qvalues = qvalues_all[:len(states)], qvalues_all[len(states):]
 
-        next_actions_onehot = tf.one_hot(next_actions, self.action_space)
-
-        max_next_qvalues = tf.reduce_sum(
-            next_qvalues * next_actions_onehot, axis=1, keepdims=True)
+        max_next_qvalues = tf.reduce_max(next_qvalues, axis=1, keepdims=True)
 
         TQ = rewards + self.gamma ** (self.nstep) * (1 - dones) * max_next_qvalues
 
-        qvalues = self.local_qnet(states)
         actions_onehot = tf.one_hot(
             actions.flatten().astype(np.int32), self.action_space)
         Q = tf.reduce_sum(qvalues * actions_onehot, axis=1, keepdims=True)
@@ -144,8 +167,7 @@ class Actor:
         return priorities, experiences, self.pid
 
 
-@ray.remote(num_cpus=1)
-class RemoteTestActor:
+class TestActor:
 
     def __init__(self, env_name, epsilon=0.05, n_frames=4):
 
@@ -163,6 +185,8 @@ class RemoteTestActor:
 
         self.qnet = DuelingQNetwork(action_space=self.action_space)
 
+        self.n_evaluated = 0
+
         self.define_network()
 
     def define_network(self):
@@ -179,9 +203,6 @@ class RemoteTestActor:
 
         self.qnet(state)
 
-    def get_layers(self, idx):
-        return self.qnet.layers[idx:]
-
     def play(self, current_weights, epsilon=0.01):
 
         tf.config.set_visible_devices([], 'GPU')
@@ -216,6 +237,28 @@ class RemoteTestActor:
 
         return episode_steps, episode_rewards
 
+    def play_batched(self, current_weights, n_episodes=8, epsilon=0.01):
+        """ n_episodes個のエピソードをバッチ推論でまとめて評価する
+
+        Returns:
+            dict: スコアの mean, median, iqm など
+        """
+
+        tf.config.set_visible_devices([], 'GPU')
+
+        self.qnet.set_weights(current_weights)
+
+        scores, steps = evaluate(
+            self.qnet, self.env_name, n_episodes=n_episodes,
+            n_frames=self.n_frames, epsilon=epsilon,
+            stall_steps=1000, stall_score=10, seed=self.n_evaluated)
+        self.n_evaluated += n_episodes
+
+        result = score_stats(scores)
+        result.update({"scores": scores, "steps": steps})
+
+        return result
+
     def play_with_video(self, checkpoint_path, monitor_dir, epsilon=0.01):
 
         monitor_dir = Path(monitor_dir)
@@ -0,0 +1,159 @@
+import time
+
+import numpy as np
+
+
+class SharedRing:
+    """ 共有メモリ上の固定長スロットのリングバッファ (producer 1, consumer 1)
+
+        put()はpayload(bytes)を空いているスロットにコピーし、get()はそれを取り出す.
+        空き/使用中のスロット数はSemaphoreで数えるので、満杯ならputが、
+        空ならgetがtimeoutまで待つ. RawArrayはspawnしたプロセスに
+        Processの引数として渡したときだけ共有できる
+
+    Args:
+        ctx: multiprocessing.get_context("spawn")
+        n_slots (int): スロット数
+        slot_size (int): 1スロットのバイト数. これより大きいpayloadはputできない
+    """
+
+    def __init__(self, ctx, n_slots, slot_size):
+
+        self.n_slots = n_slots
+
+        self.slot_size = slot_size
+
+        self.data = ctx.RawArray("B", n_slots * slot_size)
+
+        self.sizes = ctx.RawArray("q", n_slots)
+
+        #: headはproducerだけが、tailはconsumerだけが書き換える
+        self.head = ctx.RawValue("q", 0)
+
+        self.tail = ctx.RawValue("q", 0)
+
+        self.free = ctx.Semaphore(n_slots)
+
+        self.filled = ctx.Semaphore(0)
+
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None
+        return state
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = np.frombuffer(self.data, dtype=np.uint8)
+        return self._view
+
+    def put(self, payload, timeout=None):
+        """
+        Returns:
+            bool: timeoutまでに書き込めたかどうか
+        """
+        if len(payload) > self.slot_size:
+            raise ValueError(
+                f"payload of {len(payload)} bytes exceeds slot_size={self.slot_size}")
+
+        if not self.free.acquire(timeout=timeout):
+            return False
+
+        slot = self.head.value % self.n_slots
+        offset = slot * self.slot_size
+        self.view[offset:offset + len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+        self.sizes[slot] = len(payload)
+        self.head.value += 1
+
+        self.filled.release()
+
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns:
+            bytes: timeoutまでに何もなければNone
+        """
+        if not self.filled.acquire(timeout=timeout):
+            return None
+
+        slot = self.tail.value % self.n_slots
+        offset = slot * self.slot_size
+        payload = self.view[offset:offset + self.sizes[slot]].tobytes()
+        self.tail.value += 1
+
+        self.free.release()
+
+        return payload
+
+
+class SharedWeights:
+    """ 共有メモリ上のネットワークの重み (writer 1, reader 多)
+
+        seqlock: 書き込み中はversionを奇数にしておき、readerは読む前後で
+        versionが同じ偶数であることを確かめてから使う(違えば読み直す)
+
+    Args:
+        ctx: multiprocessing.get_context("spawn")
+        shapes: get_weights()で得られる各重みのshape
+    """
+
+    def __init__(self, ctx, shapes):
+
+        self.shapes = [tuple(shape) for shape in shapes]
+
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        self.data = ctx.RawArray("f", sum(self.sizes))
+
+        self.version = ctx.RawValue("q", 0)
+
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None
+        return state
+
+    @property
+    def view(self):
+        if self._view is None:
+            self._view = np.frombuffer(self.data, dtype=np.float32)
+        return self._view
+
+    def publish(self, weights):
+
+        self.version.value += 1
+        self.view[:] = np.concatenate(
+            [np.asarray(w, dtype=np.float32).ravel() for w in weights])
+        self.version.value += 1
+
+    def read(self, last_version=-1):
+        """
+        Args:
+            last_version: 前回読んだversion. 変わっていなければ読まない
+
+        Returns:
+            weights, version: 一度もpublishされていないか
+                last_versionから変わっていなければweightsはNone
+        """
+        while True:
+            version = self.version.value
+            if version == 0 or version == last_version:
+                return None, last_version
+            if version % 2 == 1:
+                time.sleep(0.001)
+                continue
+
+            flat = self.view.copy()
+            if self.version.value == version:
+                break
+
+        weights, offset = [], 0
+        for shape, size in zip(self.shapes, self.sizes):
+            weights.append(flat[offset:offset + size].reshape(shape))
+            offset += size
+
+        return weights, version
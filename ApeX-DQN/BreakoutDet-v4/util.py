@@ -23,8 +23,8 @@ def preprocess_frame(frame):
     """Breakout only"""
     image = Image.fromarray(frame)
     image = image.convert("L").crop((0, 34, 160, 200)).resize((84, 84))
-    image_scaled = np.array(image) / 255.0
-    return image_scaled.astype(np.float32)
+    #: [0, 1]へのスケーリングはネットワークの中で行う
+    return np.array(image, dtype=np.uint8)
 
 
 def huber_loss(target_q, q, d=1.0):
@@ -1,4 +1,5 @@
 from pathlib import Path
+import functools
 import shutil
 
 import gym
@@ -9,6 +10,8 @@ import collections
 from model import CategoricalQNet
 from buffer import Experience, ReplayBuffer
 from util import frame_preprocess
+from vecenv import SubProcVecEnv, epsilon_greedy
+from evaluator import EvalService
 
 
 class CategoricalDQNAgent:
@@ -51,6 +54,10 @@ class CategoricalDQNAgent:
 
         self.action_space = env.action_space.n
 
+        #: 評価プロセスでも同じネットワークを作れるようにしておく
+        self.network_fn = functools.partial(
+            CategoricalQNet, self.action_space, self.n_atoms, self.Z)
+
         self.qnet = CategoricalQNet(
             self.action_space, self.n_atoms, self.Z)
 
@@ -59,13 +66,18 @@ class CategoricalDQNAgent:
 
         self.optimizer = tf.keras.optimizers.Adam(lr=lr, epsilon=0.01/batch_size)
 
-    def learn(self, n_episodes, buffer_size=800000, logdir="log"):
+    def learn(self, n_episodes, buffer_size=800000, logdir="log",
+              n_eval_episodes=8):
 
         logdir = Path(__file__).parent / logdir
         if logdir.exists():
             shutil.rmtree(logdir)
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
+        evaluator = EvalService(
+            self.network_fn, self.env_name, n_episodes=n_eval_episodes,
+            n_frames=self.n_frames, epsilon=0.1)
+
         self.replay_buffer = ReplayBuffer(max_len=buffer_size)
 
         steps = 0
@@ -132,15 +144,102 @@ class CategoricalDQNAgent:
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
 
             if episode % 20 == 0:
-                test_scores, test_steps = self.test_play(n_testplay=1)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar("test_score", test_scores[0], step=steps)
-                    tf.summary.scalar("test_step", test_steps[0], step=steps)
+                evaluator.submit(steps, self.qnet.get_weights())
+
+            for result in evaluator.poll():
+                self.log_evaluation(result)
 
             if episode % 1000 == 0:
                 print("Model Saved")
                 self.qnet.save_weights("checkpoints/qnet")
 
+        for result in evaluator.close(wait=True):
+            self.log_evaluation(result)
+
+    def log_evaluation(self, result):
+
+        with self.summary_writer.as_default():
+            for key in ("mean", "median", "iqm"):
+                tf.summary.scalar(
+                    f"test_score/{key}", result[key], step=result["step"])
+            tf.summary.scalar(
+                "test_step", np.mean(result["steps"]), step=result["step"])
+
+    def learn_vectorized(self, total_steps, n_envs=8, epsilon_alpha=0.,
+                         buffer_size=800000, logdir="log"):
+        """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+        Args:
+            epsilon_alpha (float): env iのε = ε(steps) ** (1 + α * i / (n_envs-1)).
+                0ならすべてのenvで同じε, Ape-Xでは7
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        self.replay_buffer = ReplayBuffer(max_len=buffer_size)
+
+        vecenv = SubProcVecEnv(self.env_name, n_envs, n_frames=self.n_frames)
+
+        states = vecenv.reset()
+
+        #: ネットワーク重みの初期化
+        self.qnet(states)
+        self.target_qnet(states)
+        self.target_qnet.set_weights(self.qnet.get_weights())
+
+        epsilon_exponents = 1 + epsilon_alpha * np.arange(n_envs) / max(n_envs - 1, 1)
+
+        steps, episode = 0, 0
+        while steps < total_steps:
+
+            epsilons = self.epsilon_scheduler(steps) ** epsilon_exponents
+
+            greedy_actions, _ = self.qnet.sample_actions(states)
+            actions = epsilon_greedy(greedy_actions, epsilons, self.action_space)
+
+            results = vecenv.step(actions)
+
+            self.replay_buffer.push_batch(
+                [Experience(states[[i]], actions[i], res.reward,
+                            res.next_state[np.newaxis, ...], res.done)
+                 for i, res in enumerate(results)])
+
+            states = np.stack([res.state for res in results])
+
+            prev_steps, steps = steps, steps + n_envs
+
+            for res in results:
+                if not res.episode_done:
+                    continue
+
+                episode += 1
+                print(f"Episode: {episode}, score: {res.episode_rewards}, steps: {res.episode_steps}")
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("train_score", res.episode_rewards, step=steps)
+                    tf.summary.scalar("train_steps", res.episode_steps, step=steps)
+
+                if episode % 1000 == 0:
+                    self.qnet.save_weights("checkpoints/qnet")
+
+            if len(self.replay_buffer) > 20000:
+                n_updates = steps // self.update_period - prev_steps // self.update_period
+                for _ in range(n_updates):
+                    loss = self.update_network()
+
+                if n_updates:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("loss", loss, step=steps)
+                        tf.summary.scalar("epsilon", epsilons[0], step=steps)
+                        tf.summary.scalar("buffer_size", len(self.replay_buffer), step=steps)
+
+            if steps // self.target_update_period != prev_steps // self.target_update_period:
+                self.target_qnet.set_weights(self.qnet.get_weights())
+
+        vecenv.close()
+
     def update_network(self):
 
         #: ミニバッチの作成
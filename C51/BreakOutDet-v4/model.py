@@ -31,6 +31,9 @@ class CategoricalQNet(tf.keras.Model):
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         batch_size = x.shape[0]
 
         x = self.conv1(x)
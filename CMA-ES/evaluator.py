@@ -0,0 +1,171 @@
+import multiprocessing
+
+import numpy as np
+
+
+class SerialEvaluator:
+    """ 適合度を逐次評価する. levi_funcなどの軽い関数向け
+    """
+
+    def __init__(self, fitness_fn):
+
+        self.fitness_fn = fitness_fn
+
+    def evaluate(self, X):
+
+        return np.array([self.fitness_fn(x) for x in X], dtype=np.float64)
+
+    def close(self):
+        pass
+
+
+#: ワーカープロセスごとに一度だけ生成される適合度関数
+_worker_fitness_fn = None
+
+
+def _init_worker(fitness_factory, factory_args, seed):
+
+    global _worker_fitness_fn
+
+    np.random.seed((seed + multiprocessing.current_process().pid) % 2**32)
+
+    _worker_fitness_fn = fitness_factory(*factory_args)
+
+
+def _evaluate_one(args):
+
+    idx, x = args
+
+    return idx, _worker_fitness_fn(x)
+
+
+class ParallelEvaluator:
+    """ プロセスプールによる個体群の並列評価
+
+        fitness_factoryは各ワーカーで一度だけ呼ばれ、適合度関数を返す.
+        gym環境やネットワークのような重い状態はワーカー側に保持させ、
+        世代ごとには個体ベクトルxと適合度だけをやりとりする
+
+    Args:
+        fitness_factory (callable): factory(*factory_args) -> fitness_fn(x)
+        factory_args (tuple): fitness_factoryの引数
+        n_workers (int): プロセス数, Noneならcpu_count()
+        start_method (str): "spawn"など. tensorflowを親プロセスで
+            初期化済みの場合はforkを避けること
+    """
+
+    def __init__(self, fitness_factory, factory_args=(),
+                 n_workers=None, seed=0, start_method=None):
+
+        self.n_workers = n_workers if n_workers else multiprocessing.cpu_count()
+
+        ctx = multiprocessing.get_context(start_method)
+
+        self.pool = ctx.Pool(
+            processes=self.n_workers, initializer=_init_worker,
+            initargs=(fitness_factory, factory_args, seed))
+
+    def evaluate(self, X, callback=None):
+        """ 適合度を個体の順番どおりに返す
+
+        Args:
+            X (np.ndarray): 個体群, shape==(lam, dim)
+            callback (callable): callback(idx, fitness),
+                評価が終わった個体から順に呼ばれる
+        """
+        fitnesses = np.zeros(len(X), dtype=np.float64)
+
+        for idx, fitness in self.pool.imap_unordered(
+                _evaluate_one, enumerate(X)):
+
+            fitnesses[idx] = fitness
+
+            if callback is not None:
+                callback(idx, fitness)
+
+        return fitnesses
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GymLinearPolicyFitness:
+    """ 線形方策 a = argmax(Ws + b) のgymロールアウトによる適合度
+        CMAESは最小化なので -(平均総報酬) を返す
+    """
+
+    def __init__(self, env_id, n_episodes=1, max_steps=1000):
+
+        import gym
+
+        self.env = gym.make(env_id)
+
+        self.obs_dim = self.env.observation_space.shape[0]
+
+        self.action_space = self.env.action_space.n
+
+        self.n_episodes = n_episodes
+
+        self.max_steps = max_steps
+
+    @property
+    def dim(self):
+        return (self.obs_dim + 1) * self.action_space
+
+    def __call__(self, x):
+
+        params = np.asarray(x).reshape(self.obs_dim + 1, self.action_space)
+        W, b = params[:-1], params[-1]
+
+        total_reward = 0
+
+        for _ in range(self.n_episodes):
+
+            state = self.env.reset()
+
+            for _ in range(self.max_steps):
+
+                action = int(np.argmax(np.matmul(state, W) + b))
+
+                state, reward, done, _ = self.env.step(action)
+
+                total_reward += reward
+
+                if done:
+                    break
+
+        return -total_reward / self.n_episodes
+
+
+def main(env_id="CartPole-v1", n_generations=30, n_workers=4):
+
+    from main import CMAES
+
+    dim = GymLinearPolicyFitness(env_id).dim
+
+    cmaes = CMAES(centroid=np.zeros(dim), sigma=0.5)
+
+    with ParallelEvaluator(GymLinearPolicyFitness, (env_id, 3),
+                           n_workers=n_workers) as evaluator:
+
+        for gen in range(n_generations):
+
+            X = cmaes.sample_population()
+
+            fitnesses = evaluator.evaluate(X)
+
+            cmaes.update(X, fitnesses, gen)
+
+            print(f"Generation {gen}: best {-fitnesses.min()}, mean {-fitnesses.mean()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -67,7 +67,6 @@ class CMAES:
             ) + self.c_sigma
 
         #: 共分散行列： 進化パスとrank-μ, rank-one更新の学習率
-        self.C = np.identity(self.dim)
         self.p_c = np.zeros(self.dim)
         self.c_c = (4 + self.mu_eff / self.dim) / (self.dim + 4 + 2 * self.mu_eff / self.dim)
         self.c_1 = 2.0 / ((self.dim+1.3)**2 + self.mu_eff)
@@ -76,23 +75,57 @@ class CMAES:
             2.0 * (self.mu_eff - 2 + 1/self.mu_eff) / ((self.dim + 2) ** 2 + self.mu_eff)
             )
 
+        self._init_covariance()
+
+        self.gen = 0
+
+    def _init_covariance(self):
+
+        self.C = np.identity(self.dim)
+
+        #: 固有値分解 C = BDDB^T のキャッシュ
+        #: O(dim^3)の分解は 1/(c_1+c_μ)/dim/10 世代ごとにだけ更新すれば十分
+        self.eigen_interval = max(
+            1, int(1. / (self.c_1 + self.c_mu) / self.dim / 10))
+        self.eigen_gen = None
+        self.B = np.identity(self.dim)
+        self.diagD = np.ones(self.dim)
+        self.BD = np.identity(self.dim)
+        self.invsqrtC = np.identity(self.dim)
+
+    def _update_eigensystem(self, force=False):
+        """ C = BDDB^Tの遅延更新
+        """
+        if not force and self.eigen_gen is not None:
+            if self.gen - self.eigen_gen < self.eigen_interval:
+                return
+
+        self.eigen_gen = self.gen
+
+        #: 数値誤差で非対称になるのを防ぐ
+        self.C = np.triu(self.C) + np.triu(self.C, 1).T
+
+        diagD, self.B = np.linalg.eigh(self.C)
+        self.diagD = np.sqrt(np.maximum(diagD, 1e-20))
+
+        self.BD = self.B * self.diagD
+        self.invsqrtC = np.matmul(self.B / self.diagD, self.B.T)
+
     def sample_population(self):
         """個体群の発生
             B = np.linalg.cholesky(self.C)でも実装できるが、
             updateのときに必要になるので面倒なやりかたで実装
 
-            C = BDDB^T
+            C = BDDB^T, 分解結果はupdateと共有してキャッシュする
         """
         #: z ~ N(0, 1)
         Z = np.random.normal(0, 1, size=(self.lam, self.dim))
 
         #: C = B√D√DB.T
-        diagD, B = np.linalg.eigh(self.C)
-        diagD = np.sqrt(diagD)
-        BD = np.matmul(B, np.diag(diagD))
+        self._update_eigensystem()
 
         #: y~N(0, C)
-        Y = np.matmul(BD, Z.T).T
+        Y = np.matmul(Z, self.BD.T)
         #: X~N(μ, σC)
         X = self.centroid + self.sigma * Y
 
@@ -123,12 +156,9 @@ class CMAES:
         self.centroid = (1 - self.c_m) * old_centroid + self.c_m * X_w
 
         #: 2. Step-size control
-        diagD, B = np.linalg.eigh(self.C)
-        diagD = np.sqrt(diagD)
-        inv_diagD = 1.0 / diagD
-
         #: Note. 定義からnp.matmul(B, Z.T).T == np.matmul(C_, Y.T).T
-        C_ = np.matmul(np.matmul(B, np.diag(inv_diagD)), B.T)
+        self._update_eigensystem()
+        C_ = self.invsqrtC
 
         new_p_sigma = (1 - self.c_sigma) * self.p_sigma
         new_p_sigma += np.sqrt(self.c_sigma * (2 - self.c_sigma) * self.mu_eff) * np.matmul(C_, Y_w)
@@ -156,17 +186,79 @@ class CMAES:
         new_C = (1 + self.c_1 * d_hsigma - self.c_1 - self.c_mu) * self.C
         new_C += self.c_1 * np.outer(self.p_c, self.p_c)
 
-        #: スマートな実装 from deap/cma.py
-        #new_C += self.c_mu * np.dot((self.weights * Y_elite.T), Y_elite)
-        #: あたまのわるいじっそう
-        wyy = np.zeros((self.dim, self.dim))
-        for i in range(self.mu):
-            y_i = Y_elite[i]
-            wyy += self.weights[0, i] * np.outer(y_i, y_i)
-        new_C += self.c_mu * wyy
+        #: rank-μ update: Σ w_i y_i y_i^T を一回の行列積で計算 (deap/cma.py)
+        new_C += self.c_mu * np.matmul(self.weights * Y_elite.T, Y_elite)
+
+        self.C = new_C
+
+        self.gen = gen + 1
+
+
+class SepCMAES(CMAES):
+    """ 共分散行列を対角に制限したsep-CMA-ES (Ros & Hansen, 2008)
+        メモリ・計算量ともO(dim)なので、NNの重みのような高次元の最適化向け
+    """
+
+    def _init_covariance(self):
+
+        #: 対角成分のみ保持する
+        self.C = np.ones(self.dim)
+
+        #: 対角共分散は自由度が小さいので学習率を (dim+2)/3 倍する
+        self.c_1 = min(1., self.c_1 * (self.dim + 2) / 3)
+        self.c_mu = min(1 - self.c_1, self.c_mu * (self.dim + 2) / 3)
+
+    def sample_population(self):
+
+        Z = np.random.normal(0, 1, size=(self.lam, self.dim))
+
+        Y = Z * np.sqrt(self.C)
+
+        X = self.centroid + self.sigma * Y
+
+        return X
+
+    def update(self, X, fitnesses, gen):
+
+        #: 1. Selection and recombination
+        old_centroid = self.centroid
+        old_sigma = self.sigma
+
+        elite_indices = np.argsort(fitnesses)[:self.mu]
+        X_elite = X[elite_indices, :]
+        Y_elite = (X_elite - old_centroid) / old_sigma
+
+        X_w = np.matmul(self.weights, X_elite)[0]
+        Y_w = np.matmul(self.weights, Y_elite)[0]
+
+        self.centroid = (1 - self.c_m) * old_centroid + self.c_m * X_w
+
+        #: 2. Step-size control: C^-1/2 は要素ごとの除算
+        self.p_sigma = (1 - self.c_sigma) * self.p_sigma
+        self.p_sigma += np.sqrt(self.c_sigma * (2 - self.c_sigma) * self.mu_eff) * Y_w / np.sqrt(self.C)
+
+        E_normal = np.sqrt(self.dim) * (1 - 1/(4*self.dim) + 1/(21 * self.dim **2))
+        norm_p_sigma = np.sqrt((self.p_sigma ** 2).sum())
+        self.sigma = self.sigma * np.exp(
+            (self.c_sigma / self.d_sigma) * (norm_p_sigma / E_normal - 1))
+
+        #: 3. Covariance matrix adaptation (対角成分のみ)
+        left = norm_p_sigma / np.sqrt(1 - (1 - self.c_sigma) ** (2 * (gen+1)))
+        right = (1.4 + 2 / (self.dim + 1)) * E_normal
+        hsigma = 1 if left < right else 0
+        d_hsigma = (1 - hsigma) * self.c_c * (2 - self.c_c)
+
+        self.p_c = (1 - self.c_c) * self.p_c
+        self.p_c += hsigma * np.sqrt(self.c_c * (2 - self.c_c) * self.mu_eff) * Y_w
+
+        new_C = (1 + self.c_1 * d_hsigma - self.c_1 - self.c_mu) * self.C
+        new_C += self.c_1 * self.p_c ** 2
+        new_C += self.c_mu * np.matmul(self.weights, Y_elite ** 2)[0]
 
         self.C = new_C
 
+        self.gen = gen + 1
+
 
 def main(n_generations, savepath):
 
@@ -0,0 +1,225 @@
+import os
+import sys
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import numpy as np
+
+from main import CMAES, SepCMAES
+from evaluator import ParallelEvaluator
+
+
+class WeightsCodec:
+    """ kerasモデルのtrainable_variablesと一次元ベクトルの相互変換
+    """
+
+    def __init__(self, model):
+
+        self.shapes = [tuple(var.shape) for var in model.trainable_variables]
+
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+
+        self.split_points = np.cumsum(self.sizes)[:-1]
+
+    @property
+    def dim(self):
+        return sum(self.sizes)
+
+    def flatten(self, model):
+
+        return np.concatenate(
+            [var.numpy().ravel() for var in model.trainable_variables])
+
+    def assign(self, model, x):
+
+        for var, w, shape in zip(model.trainable_variables,
+                                 np.split(x, self.split_points), self.shapes):
+            var.assign(w.reshape(shape).astype(np.float32))
+
+
+def greedy_logits_action(model, state):
+    """ ActorCriticNet: (values, logits) -> argmax logits
+    """
+    _, logits = model(state)
+
+    return int(np.argmax(logits.numpy()[0]))
+
+
+def gaussian_mean_action(model, state):
+    """ PolicyNetwork: (mean, stdev) -> mean
+    """
+    mean, _ = model(state)
+
+    return mean.numpy()[0]
+
+
+def build_model(model_fn, env):
+
+    model = model_fn()
+
+    dummy_state = np.zeros((1, *env.observation_space.shape), dtype=np.float32)
+
+    model(dummy_state)
+
+    return model
+
+
+class KerasPolicyFitness:
+    """ ワーカープロセスごとに一度だけモデルとenvを構築し、
+        個体ベクトルを重みに書き込んでロールアウトする.
+        CMAESは最小化なので -(平均総報酬) を返す
+    """
+
+    def __init__(self, model_fn, env_id, action_fn,
+                 n_episodes=1, max_steps=1000):
+
+        import gym
+        import tensorflow as tf
+
+        #: 並列度はプロセス数で稼ぐので、TF側のスレッドは1に制限
+        tf.config.threading.set_intra_op_parallelism_threads(1)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+        self.env = gym.make(env_id)
+
+        self.model = build_model(model_fn, self.env)
+
+        self.codec = WeightsCodec(self.model)
+
+        self.action_fn = action_fn
+
+        self.n_episodes = n_episodes
+
+        self.max_steps = max_steps
+
+    def __call__(self, x):
+
+        self.codec.assign(self.model, x)
+
+        total_reward = 0
+
+        for _ in range(self.n_episodes):
+
+            state = self.env.reset()
+
+            for _ in range(self.max_steps):
+
+                state = np.atleast_2d(state).astype(np.float32)
+
+                action = self.action_fn(self.model, state)
+
+                state, reward, done, _ = self.env.step(action)
+
+                total_reward += reward
+
+                if done:
+                    break
+
+        return -total_reward / self.n_episodes
+
+
+class NeuroEvolution:
+    """ CMA-ESでkerasモデルの重みを直接最適化する勾配フリーの学習器
+
+        モデルの初期重みを正規分布中心とし、λ個体を並列ワーカーで評価する.
+        次元数がSEP_THRESHOLDを超える場合は対角共分散のsep-CMA-ESを使う
+
+    Args:
+        model_fn (callable): 引数なしでkerasモデルを返す. spawnしたワーカーから
+            呼ばれるのでモジュールレベルの関数であること
+        env_id (str): gym環境ID
+        action_fn (callable): action_fn(model, state) -> action
+    """
+
+    SEP_THRESHOLD = 1000
+
+    def __init__(self, model_fn, env_id, action_fn, sigma=0.1, lam=None,
+                 n_workers=None, n_episodes=1, max_steps=1000,
+                 separable=None):
+
+        import gym
+
+        env = gym.make(env_id)
+
+        self.model = build_model(model_fn, env)
+
+        self.codec = WeightsCodec(self.model)
+
+        centroid = self.codec.flatten(self.model)
+
+        if separable is None:
+            separable = self.codec.dim > self.SEP_THRESHOLD
+
+        if separable:
+            self.cmaes = SepCMAES(centroid=centroid, sigma=sigma, lam=lam)
+        else:
+            self.cmaes = CMAES(centroid=centroid, sigma=sigma, lam=lam)
+
+        #: 親プロセスでTFを初期化済みなのでforkではなくspawnを使う
+        self.evaluator = ParallelEvaluator(
+            KerasPolicyFitness,
+            (model_fn, env_id, action_fn, n_episodes, max_steps),
+            n_workers=n_workers, start_method="spawn")
+
+        self.best_score = None
+
+    def run(self, n_generations, verbose=True):
+
+        history = []
+
+        for gen in range(n_generations):
+
+            X = self.cmaes.sample_population()
+
+            fitnesses = self.evaluator.evaluate(X)
+
+            self.cmaes.update(X, fitnesses, gen)
+
+            scores = -fitnesses
+
+            history.append(scores.mean())
+
+            if (self.best_score is None) or (scores.max() > self.best_score):
+                self.best_score = scores.max()
+                self.codec.assign(self.model, X[np.argmax(scores)])
+                self.save_model()
+
+            if verbose:
+                print(f"Generation {gen}: mean {scores.mean()}, "
+                      f"max {scores.max()}, sigma {self.cmaes.sigma}")
+
+        return history
+
+    def save_model(self):
+
+        self.model.save_weights("checkpoints/neuroevolution")
+
+    def close(self):
+
+        self.evaluator.close()
+
+
+def build_cartpole_actorcritic():
+
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "A3C", "CartPole-v1"))
+
+    from models import ActorCriticNet
+
+    return ActorCriticNet(action_space=2)
+
+
+def main(n_generations=50, n_workers=4):
+
+    trainer = NeuroEvolution(build_cartpole_actorcritic, "CartPole-v1",
+                             greedy_logits_action, sigma=0.1,
+                             n_workers=n_workers)
+
+    history = trainer.run(n_generations)
+
+    trainer.close()
+
+    print(history)
+
+
+if __name__ == '__main__':
+    main()
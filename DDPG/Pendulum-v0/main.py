@@ -172,15 +172,17 @@ class DDPGAgent:
         (states, actions, rewards,
          next_states, dones) = self.buffer.get_minibatch(batch_size)
 
+        self._update_network(states, actions, rewards, next_states, dones)
+
+    @tf.function
+    def _update_network(self, states, actions, rewards, next_states, dones):
+
         next_actions = self.target_actor_network(next_states)
 
-        next_qvalues = self.target_critic_network(next_states, next_actions).numpy().flatten()
+        next_qvalues = self.target_critic_network(next_states, next_actions)
 
         #: Compute taeget values and update CriticNetwork
-        target_values = np.vstack(
-            [reward + self.GAMMA * next_qvalue if not done else reward
-             for reward, done, next_qvalue
-             in zip(rewards, dones, next_qvalues)]).astype(np.float32)
+        target_values = rewards + self.GAMMA * (1. - dones) * next_qvalues
 
         with tf.GradientTape() as tape:
             qvalues = self.critic_network(states, actions)
@@ -198,27 +200,18 @@ class DDPGAgent:
         gradients = tape.gradient(J, variables)
         self.actor_network.optimizer.apply_gradients(zip(gradients, variables))
 
-    def update_target_network(self):
-
-        # soft-target update Actor
-        target_actor_weights = self.target_actor_network.get_weights()
-        actor_weights = self.actor_network.get_weights()
-
-        assert len(target_actor_weights) == len(actor_weights)
+        return loss
 
-        self.target_actor_network.set_weights(
-            (1 - self.TAU) * np.array(target_actor_weights)
-            + (self.TAU) * np.array(actor_weights))
-
-        # soft-target update Critic
-        target_critic_weights = self.target_critic_network.get_weights()
-        critic_weights = self.critic_network.get_weights()
-
-        assert len(target_critic_weights) == len(critic_weights)
+    def update_target_network(self):
+        """ soft-target update. eager/グラフ内どちらからも呼べる
+        """
+        for target_var, var in zip(self.target_actor_network.weights,
+                                   self.actor_network.weights):
+            target_var.assign((1 - self.TAU) * target_var + self.TAU * var)
 
-        self.target_critic_network.set_weights(
-            (1 - self.TAU) * np.array(target_critic_weights)
-            + (self.TAU) * np.array(critic_weights))
+        for target_var, var in zip(self.target_critic_network.weights,
+                                   self.critic_network.weights):
+            target_var.assign((1 - self.TAU) * target_var + self.TAU * var)
 
     def save_model(self):
 
@@ -4,6 +4,8 @@ import numpy as np
 import pickle
 import zlib
 
+from sampler import UniformSampler
+
 
 @dataclass
 class Experience:
@@ -21,10 +23,15 @@ class Experience:
 
 class ReplayBuffer:
 
-    def __init__(self, max_len, compress=True):
+    def __init__(self, max_len, compress=True, target_cache=None):
 
         self.max_len = max_len
 
+        #: 上書きしたスロットのtarget出力のメモを無効にする
+        self.target_cache = target_cache
+
+        self.sampler = UniformSampler()
+
         self.buffer = []
 
         self.compress = compress
@@ -47,6 +54,9 @@ class ReplayBuffer:
         if self.count == self.max_len:
             self.count = 0
 
+        if self.target_cache is not None:
+            self.target_cache.invalidate(self.count)
+
         try:
             self.buffer[self.count] = exp
         except IndexError:
@@ -54,12 +64,17 @@ class ReplayBuffer:
 
         self.count += 1
 
-    def get_minibatch(self, batch_size):
+    def push_batch(self, transitions):
+        """ 複数envの遷移をまとめて追加する
+        """
+        for transition in transitions:
+            self.push(transition)
+
+    def get_minibatch(self, batch_size, return_indices=False):
 
         N = len(self.buffer)
 
-        indices = np.random.choice(
-            np.arange(N), replace=False, size=batch_size)
+        indices = self.sampler.sample(N, batch_size)
 
         if self.compress:
             selected_experiences = [
@@ -68,7 +83,7 @@ class ReplayBuffer:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -78,9 +93,12 @@ class ReplayBuffer:
 
         next_states = np.vstack(
             [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            )
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
 
+        if return_indices:
+            return indices, (states, actions, rewards, next_states, dones)
+
         return (states, actions, rewards, next_states, dones)
@@ -0,0 +1,212 @@
+import collections
+import multiprocessing
+import queue
+
+import gym
+import numpy as np
+
+from util import preprocess_frame
+
+
+def score_stats(scores):
+    """ テストスコアの分布の要約
+
+        IQM(interquartile mean)は上下25%ずつを除いた平均
+    """
+    scores = np.sort(np.asarray(scores, dtype=np.float64))
+
+    n = len(scores)
+    trimmed = scores[n // 4: n - n // 4] if n >= 4 else scores
+
+    return {"mean": float(scores.mean()),
+            "median": float(np.median(scores)),
+            "iqm": float(trimmed.mean()),
+            "std": float(scores.std()),
+            "min": float(scores.min()),
+            "max": float(scores.max()),
+            "n_episodes": n}
+
+
+def evaluate(network, env_name, n_episodes=8, n_frames=4, epsilon=0.05,
+             stall_steps=500, stall_score=3, seed=0):
+    """ n_episodes個のエピソードを同時に進め、行動選択は一回のバッチ推論で行う
+
+    Args:
+        network: sample_actions(states)を持つネットワーク
+        stall_steps, stall_score: stall_stepsを超えてもstall_score未満なら打ち切る
+            (ゲーム開始(action: 0)しないまま停滞するケースへの対処)
+
+    Returns:
+        scores, steps: エピソードごとのスコアとステップ数
+    """
+    envs = [gym.make(env_name) for _ in range(n_episodes)]
+    for i, env in enumerate(envs):
+        env.seed(seed + i)
+
+    action_space = envs[0].action_space.n
+
+    frames = []
+    for env in envs:
+        frame = preprocess_frame(env.reset())
+        frames.append(collections.deque([frame] * n_frames, maxlen=n_frames))
+
+    scores = np.zeros(n_episodes)
+    steps = np.zeros(n_episodes, dtype=np.int64)
+    active = np.ones(n_episodes, dtype=bool)
+
+    while active.any():
+
+        indices = np.flatnonzero(active)
+
+        states = np.stack([np.stack(frames[i], axis=2) for i in indices])
+        greedy_actions, _ = network.sample_actions(states)
+        greedy_actions = np.asarray(greedy_actions).flatten()
+
+        is_random = np.random.random(len(indices)) < epsilon
+        actions = np.where(
+            is_random, np.random.randint(action_space, size=len(indices)),
+            greedy_actions)
+
+        for i, action in zip(indices, actions):
+            next_frame, reward, done, _ = envs[i].step(int(action))
+            frames[i].append(preprocess_frame(next_frame))
+
+            scores[i] += reward
+            steps[i] += 1
+
+            if done or (steps[i] > stall_steps and scores[i] < stall_score):
+                active[i] = False
+
+    for env in envs:
+        env.close()
+
+    return scores.tolist(), steps.tolist()
+
+
+def _evaluator_worker(tasks, results, network_fn, env_name,
+                      n_episodes, n_frames, epsilon, seed):
+
+    import tensorflow as tf
+    tf.config.set_visible_devices([], "GPU")
+
+    network = network_fn()
+
+    env = gym.make(env_name)
+    frame = preprocess_frame(env.reset())
+    state = np.stack([frame] * n_frames, axis=2)[np.newaxis, ...]
+    network(state)
+
+    while True:
+
+        task = tasks.get()
+        if task is None:
+            break
+
+        step, weights = task
+        network.set_weights(weights)
+
+        scores, steps = evaluate(
+            network, env_name, n_episodes=n_episodes, n_frames=n_frames,
+            epsilon=epsilon, seed=seed)
+        seed += n_episodes
+
+        result = score_stats(scores)
+        result.update({"step": step, "scores": scores, "steps": steps})
+        results.put(result)
+
+
+class EvalService:
+    """ 学習を止めずに別プロセスで重みのスナップショットを評価する
+
+        submit()で重みを渡し、poll()で終わった評価結果を受け取る.
+        評価中にsubmitされたスナップショットは捨てる(学習側は待たない)
+
+    Args:
+        network_fn: 評価用ネットワークを作る関数. spawnした子プロセスで呼ぶので
+            pickle可能であること(モジュールレベルの関数やfunctools.partial)
+    """
+
+    def __init__(self, network_fn, env_name, n_episodes=8, n_frames=4,
+                 epsilon=0.05, seed=0):
+
+        ctx = multiprocessing.get_context("spawn")
+
+        self.tasks = ctx.Queue()
+
+        self.results = ctx.Queue()
+
+        self.worker = ctx.Process(
+            target=_evaluator_worker,
+            args=(self.tasks, self.results, network_fn, env_name,
+                  n_episodes, n_frames, epsilon, seed))
+        self.worker.daemon = True
+        self.worker.start()
+
+        self.n_pending = 0
+
+        self.closed = False
+
+    @property
+    def busy(self):
+        return self.n_pending > 0
+
+    def submit(self, step, weights):
+        """
+        Returns:
+            bool: 受け付けたかどうか
+        """
+        if self.busy:
+            return False
+
+        self.tasks.put((step, weights))
+        self.n_pending += 1
+
+        return True
+
+    def poll(self):
+        """ 終わった評価結果のリスト(ブロックしない)
+        """
+        finished = []
+        while True:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+
+        self.n_pending -= len(finished)
+
+        #: workerが落ちると結果は来ないので、busyのままsubmitが捨てられ続けないように
+        if self.n_pending > 0 and not self.worker.is_alive():
+            raise RuntimeError(
+                f"evaluator worker exited with code {self.worker.exitcode}")
+
+        return finished
+
+    def close(self, wait=False):
+        """
+        Args:
+            wait (bool): 実行中の評価を待ってから終了する
+        """
+        if self.closed:
+            return []
+
+        finished = []
+        if wait:
+            while self.n_pending > 0:
+                try:
+                    finished.append(self.results.get(timeout=1.))
+                except queue.Empty:
+                    #: workerが落ちていれば残りの結果は来ない
+                    if not self.worker.is_alive():
+                        break
+                    continue
+                self.n_pending -= 1
+
+        self.tasks.put(None)
+        self.worker.join(timeout=None if wait else 1.)
+        if self.worker.is_alive():
+            self.worker.terminate()
+
+        self.closed = True
+
+        return finished
@@ -1,4 +1,5 @@
 from pathlib import Path
+import functools
 import shutil
 
 import gym
@@ -10,6 +11,13 @@ import collections
 from model import QNetwork
 from buffer import Experience, ReplayBuffer
 from util import preprocess_frame
+from profiler import Profiler
+from metrics import MetricsLogger
+from evaluator import EvalService
+from target_cache import TargetCache
+from mixed_precision import (
+    enable_mixed_precision, wrap_optimizer, scale_loss, unscale_gradients)
+from vecenv import SubProcVecEnv, epsilon_greedy
 
 
 class DQNAgent:
@@ -20,7 +28,7 @@ class DQNAgent:
                  lr=0.00025,
                  update_period=4,
                  target_update_period=10000,
-                 n_frames=4):
+                 n_frames=4, mixed_precision=False, use_target_cache=False):
 
         self.env_name = env_name
 
@@ -39,11 +47,18 @@ class DQNAgent:
 
         self.action_space = env.action_space.n
 
+        if mixed_precision:
+            enable_mixed_precision()
+
+        #: 評価プロセスでも同じネットワークを作れるようにしておく
+        self.network_fn = functools.partial(QNetwork, self.action_space)
+
         self.qnet = QNetwork(self.action_space)
 
         self.target_qnet = QNetwork(self.action_space)
 
-        self.optimizer = Adam(lr=lr, epsilon=0.01/self.batch_size)
+        self.optimizer = wrap_optimizer(
+            Adam(lr=lr, epsilon=0.01/self.batch_size))
 
         self.n_frames = n_frames
 
@@ -51,14 +66,35 @@ class DQNAgent:
 
         self.huber_loss = tf.keras.losses.Huber()
 
-    def learn(self, n_episodes, buffer_size=1000000, logdir="log"):
+        #: Trueならtarget networkの出力をreplayのスロットごとにメモする
+        self.use_target_cache = use_target_cache
+
+        self.target_cache = None
+
+        #: learn()で置き換えられる. それ以外(learn_vectorizedなど)では計測しない
+        self.profiler = Profiler(enabled=False)
+
+    def learn(self, n_episodes, buffer_size=1000000, logdir="log",
+              profile=True, n_eval_episodes=8):
 
         logdir = Path(__file__).parent / logdir
         if logdir.exists():
             shutil.rmtree(logdir)
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
-        self.replay_buffer = ReplayBuffer(max_len=buffer_size)
+        self.profiler = profiler = Profiler(
+            logdir=logdir, summary_writer=self.summary_writer, enabled=profile)
+
+        metrics = MetricsLogger(self.summary_writer)
+
+        evaluator = EvalService(
+            self.network_fn, self.env_name, n_episodes=n_eval_episodes,
+            n_frames=self.n_frames, epsilon=0.05)
+
+        self.target_cache = TargetCache(buffer_size) if self.use_target_cache else None
+
+        self.replay_buffer = ReplayBuffer(
+            max_len=buffer_size, target_cache=self.target_cache)
 
         steps = 0
         for episode in range(1, n_episodes+1):
@@ -81,15 +117,18 @@ class DQNAgent:
 
                 state = np.stack(frames, axis=2)[np.newaxis, ...]
 
-                action = self.qnet.sample_action(state, epsilon=epsilon)
+                with profiler.span("inference"):
+                    action = self.qnet.sample_action(state, epsilon=epsilon)
 
-                next_frame, reward, done, info = env.step(action)
+                with profiler.span("env_step"):
+                    next_frame, reward, done, info = env.step(action)
+                profiler.count("env_steps")
 
                 episode_rewards += reward
 
-                frames.append(preprocess_frame(next_frame))
-
-                next_state = np.stack(frames, axis=2)[np.newaxis, ...]
+                with profiler.span("preprocess"):
+                    frames.append(preprocess_frame(next_frame))
+                    next_state = np.stack(frames, axis=2)[np.newaxis, ...]
 
                 if info["ale.lives"] != lives:
                     lives = info["ale.lives"]
@@ -97,48 +136,170 @@ class DQNAgent:
                 else:
                     transition = (state, action, reward, next_state, done)
 
-                self.replay_buffer.push(transition)
+                with profiler.span("replay_push"):
+                    self.replay_buffer.push(transition)
 
                 if len(self.replay_buffer) > 50000:
                     if steps % self.update_period == 0:
-                        loss = self.update_network()
-                        with self.summary_writer.as_default():
-                            tf.summary.scalar("loss", loss, step=steps)
-                            tf.summary.scalar("epsilon", epsilon, step=steps)
-                            tf.summary.scalar("buffer_size", len(self.replay_buffer), step=steps)
-                            tf.summary.scalar("train_score", episode_rewards, step=steps)
-                            tf.summary.scalar("train_steps", episode_steps, step=steps)
+                        with profiler.span("train_step"):
+                            loss = self.update_network()
+                        profiler.count("updates")
+                        profiler.count("samples", self.batch_size)
+                        with profiler.span("summary"):
+                            metrics.scalar("loss", loss, steps)
+                            metrics.scalar("epsilon", epsilon, steps)
+                            metrics.scalar("buffer_size", len(self.replay_buffer), steps)
+                            metrics.scalar("train_score", episode_rewards, steps)
+                            metrics.scalar("train_steps", episode_steps, steps)
+                            if self.target_cache is not None:
+                                metrics.scalar("target_cache_hit_rate",
+                                               self.target_cache.stats()["hit_rate"], steps)
 
                     if steps % self.target_update_period == 0:
-                        self.target_qnet.set_weights(self.qnet.get_weights())
+                        with profiler.span("target_sync"):
+                            self.sync_target_network()
+
+                profiler.step(steps)
 
                 if done:
                     break
 
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
             if episode % 20 == 0:
-                test_scores, test_steps = self.test_play(n_testplay=1)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar("test_score", test_scores[0], step=steps)
-                    tf.summary.scalar("test_step", test_steps[0], step=steps)
+                evaluator.submit(steps, self.qnet.get_weights())
+
+            for result in evaluator.poll():
+                self.log_evaluation(metrics, result)
 
             if episode % 1000 == 0:
                 self.qnet.save_weights("checkpoints/qnet")
 
-    def update_network(self):
+        for result in evaluator.close(wait=True):
+            self.log_evaluation(metrics, result)
 
-        #: ミニバッチの作成
-        (states, actions, rewards,
-         next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size)
+        metrics.close()
 
-        if self.use_reward_clipping:
-            rewards = np.clip(rewards, -1, 1)
+        profiler.close()
+
+    @staticmethod
+    def log_evaluation(metrics, result):
+
+        step = result["step"]
+        for key in ("mean", "median", "iqm"):
+            metrics.scalar(f"test_score/{key}", result[key], step)
+        metrics.scalar("test_step", np.mean(result["steps"]), step)
+
+    def learn_vectorized(self, total_steps, n_envs=8, buffer_size=1000000,
+                         epsilon_alpha=0., logdir="log"):
+        """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+        Args:
+            epsilon_alpha (float): env iのε = ε(steps) ** (1 + α * i / (n_envs-1)).
+                0ならすべてのenvで同じε, Ape-Xでは7
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        metrics = MetricsLogger(self.summary_writer)
+
+        self.target_cache = TargetCache(buffer_size) if self.use_target_cache else None
+
+        self.replay_buffer = ReplayBuffer(
+            max_len=buffer_size, target_cache=self.target_cache)
+
+        vecenv = SubProcVecEnv(self.env_name, n_envs, n_frames=self.n_frames)
+
+        states = vecenv.reset()
+
+        epsilon_exponents = 1 + epsilon_alpha * np.arange(n_envs) / max(n_envs - 1, 1)
+
+        steps, episode = 0, 0
+        while steps < total_steps:
+
+            epsilons = self.epsilon_scheduler(steps) ** epsilon_exponents
+
+            greedy_actions, _ = self.qnet.sample_actions(states)
+            actions = epsilon_greedy(greedy_actions, epsilons, self.action_space)
+
+            results = vecenv.step(actions)
+
+            self.replay_buffer.push_batch(
+                [(states[[i]], actions[i], res.reward,
+                  res.next_state[np.newaxis, ...], res.done)
+                 for i, res in enumerate(results)])
+
+            states = np.stack([res.state for res in results])
+
+            prev_steps, steps = steps, steps + n_envs
+
+            for res in results:
+                if not res.episode_done:
+                    continue
+
+                episode += 1
+                print(f"Episode: {episode}, score: {res.episode_rewards}, steps: {res.episode_steps}")
+                metrics.scalar("train_score", res.episode_rewards, steps)
+                metrics.scalar("train_steps", res.episode_steps, steps)
+
+                if episode % 1000 == 0:
+                    self.qnet.save_weights("checkpoints/qnet")
+
+            if len(self.replay_buffer) > 50000:
+                n_updates = steps // self.update_period - prev_steps // self.update_period
+                for _ in range(n_updates):
+                    loss = self.update_network()
+
+                if n_updates:
+                    metrics.scalar("loss", loss, steps)
+                    metrics.scalar("epsilon", epsilons[0], steps)
+                    metrics.scalar("buffer_size", len(self.replay_buffer), steps)
+                    if self.target_cache is not None:
+                        metrics.scalar("target_cache_hit_rate",
+                                       self.target_cache.stats()["hit_rate"], steps)
+
+                if steps // self.target_update_period != prev_steps // self.target_update_period:
+                    self.sync_target_network()
+
+        vecenv.close()
+
+        metrics.close()
+
+    def sync_target_network(self):
+
+        self.target_qnet.set_weights(self.qnet.get_weights())
+
+        if self.target_cache is not None:
+            self.target_cache.sync()
+
+    def max_target_qvalues(self, next_states):
 
         next_actions, next_qvalues = self.target_qnet.sample_actions(next_states)
         next_actions_onehot = tf.one_hot(next_actions, self.action_space)
         max_next_qvalues = tf.reduce_sum(
             next_qvalues * next_actions_onehot, axis=1, keepdims=True)
 
+        return max_next_qvalues
+
+    def update_network(self):
+
+        #: ミニバッチの作成
+        with self.profiler.span("replay_sample"):
+            indices, (states, actions, rewards, next_states, dones) = \
+                self.replay_buffer.get_minibatch(self.batch_size, return_indices=True)
+
+        if self.use_reward_clipping:
+            rewards = np.clip(rewards, -1, 1)
+
+        with self.profiler.span("target_forward"):
+            if self.target_cache is not None:
+                max_next_qvalues = self.target_cache.get(
+                    indices, next_states, self.max_target_qvalues)
+            else:
+                max_next_qvalues = self.max_target_qvalues(next_states)
+
         target_q = rewards + self.gamma * (1 - dones) * max_next_qvalues
 
         with tf.GradientTape() as tape:
@@ -149,8 +310,10 @@ class DQNAgent:
             q = tf.reduce_sum(
                 qvalues * actions_onehot, axis=1, keepdims=True)
             loss = self.huber_loss(target_q, q)
+            scaled_loss = scale_loss(self.optimizer, loss)
 
-        grads = tape.gradient(loss, self.qnet.trainable_variables)
+        grads = tape.gradient(scaled_loss, self.qnet.trainable_variables)
+        grads = unscale_gradients(self.optimizer, grads)
         self.optimizer.apply_gradients(
             zip(grads, self.qnet.trainable_variables))
 
@@ -210,6 +373,12 @@ class DQNAgent:
         return scores, steps
 
 
+def main_vectorized(n_envs=8):
+    agent = DQNAgent()
+    agent.learn_vectorized(total_steps=10000000, n_envs=n_envs)
+    agent.qnet.save_weights("checkpoints/qnet_fin")
+
+
 def main():
     agent = DQNAgent()
     agent.learn(n_episodes=5001)
@@ -20,12 +20,16 @@ class QNetwork(tf.keras.Model):
         self.flatten1 = kl.Flatten()
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
-        self.qvalues = kl.Dense(self.action_space,
+        #: mixed precisionでも出力はfloat32
+        self.qvalues = kl.Dense(self.action_space, dtype="float32",
                                 kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+class TargetCache:
+    """ replay bufferのスロットごとにtarget networkの出力をメモしておく
+
+        値にはtarget networkのバージョンを付けて保存する. 最初にサンプルされた
+        ときにだけtarget networkで計算し、同じバージョンのうちに再びサンプルされたら
+        forwardを省略する. target同期(sync)でバージョンを進めると全スロットが
+        無効になり、スロットが新しい遷移で上書きされたらそのスロットだけ無効にする.
+
+        Prioritized replayでは優先度の高い遷移が何度もサンプルされるので効きやすい.
+        target networkが決定的であること(NoisyNetのようにforwardごとに
+        ノイズが変わるtargetでは使えない)
+
+    Args:
+        capacity (int): replay bufferのmax_len
+        dtype: 保存する値の型
+    """
+
+    def __init__(self, capacity, dtype=np.float32):
+
+        self.capacity = capacity
+
+        self.dtype = dtype
+
+        #: 値の形は最初のstoreでわかるので、そこで確保する
+        self.values = None
+
+        self.versions = np.full(capacity, -1, dtype=np.int64)
+
+        self.version = 0
+
+        self.hits = 0
+
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def sync(self):
+        """ target networkを更新したら呼ぶ
+        """
+        self.version += 1
+
+    def invalidate(self, indices):
+        """ 上書きされたスロットのメモを捨てる
+        """
+        self.versions[indices] = -1
+
+    def get(self, indices, next_states, compute):
+        """ indicesの遷移のtarget出力を返す. メモのないものだけcomputeで計算する
+
+        Args:
+            indices: バッファ内のスロット番号. shape==(batch_size,)
+            next_states: indicesに対応するnext_state
+            compute: next_statesを受け取りtarget出力(batch次元が先頭)を返す関数
+
+        Returns:
+            np.ndarray: shape==(batch_size, ...)
+        """
+        indices = np.asarray(indices)
+
+        hit = self.versions[indices] == self.version
+        n_hits = int(hit.sum())
+
+        self.hits += n_hits
+        self.misses += len(indices) - n_hits
+
+        if n_hits == len(indices):
+            return self.values[indices]
+
+        miss = np.flatnonzero(~hit)
+
+        #: missの数ごとにtf.functionがtraceし直さないよう、2のべき乗(上限batch_size)に
+        #: なるように水増ししてから計算する
+        n_padded = min(1 << int(len(miss) - 1).bit_length(), len(indices))
+        padded = np.concatenate([miss, np.repeat(miss[:1], n_padded - len(miss))])
+        computed = np.asarray(compute(next_states[padded]), dtype=self.dtype)
+        computed = computed[:len(miss)]
+
+        if self.values is None:
+            self.values = np.zeros(
+                (self.capacity,) + computed.shape[1:], dtype=self.dtype)
+
+        values = np.empty((len(indices),) + computed.shape[1:], dtype=self.dtype)
+        values[hit] = self.values[indices[hit]]
+        values[miss] = computed
+
+        self.values[indices[miss]] = computed
+        self.versions[indices[miss]] = self.version
+
+        return values
+
+    def stats(self, reset=True):
+        """
+        Returns:
+            dict: hits, misses, hit_rate
+        """
+        stats = {"hits": self.hits, "misses": self.misses,
+                 "hit_rate": self.hit_rate}
+        if reset:
+            self.hits, self.misses = 0, 0
+
+        return stats
@@ -7,8 +7,8 @@ def preprocess_frame(frame):
     image_gray = tf.image.rgb_to_grayscale(image)
     image_crop = tf.image.crop_to_bounding_box(image_gray, 34, 0, 160, 160)
     image_resize = tf.image.resize(image_crop, [84, 84])
-    image_scaled = tf.divide(image_resize, 255)
 
-    frame = image_scaled.numpy()[:, :, 0]
+    #: [0, 1]へのスケーリングはネットワークの中で行う
+    frame = tf.cast(tf.round(image_resize), tf.uint8).numpy()[:, :, 0]
 
     return frame
@@ -0,0 +1,158 @@
+import collections
+from dataclasses import dataclass
+import multiprocessing
+
+import gym
+import numpy as np
+
+from util import preprocess_frame
+
+
+@dataclass
+class Step:
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+    episode_done: bool
+
+    episode_rewards: float
+
+    episode_steps: int
+
+    state: np.ndarray
+
+
+def epsilon_greedy(greedy_actions, epsilons, action_space):
+    """ envごとのεでgreedy actionをランダム行動に置き換える
+    """
+    greedy_actions = np.asarray(greedy_actions).flatten()
+
+    n_envs = len(greedy_actions)
+
+    random_actions = np.random.randint(action_space, size=n_envs)
+
+    is_random = np.random.random(n_envs) < epsilons
+
+    return np.where(is_random, random_actions, greedy_actions)
+
+
+def workerfunc(conn, env_name, n_frames, seed):
+    """ env.stepに加えて前処理・フレームスタック・life lossの判定までを
+        ワーカー側で行う. エピソード終了時は自動でresetする
+    """
+
+    env = gym.make(env_name)
+    env.seed(seed)
+
+    frames = collections.deque(maxlen=n_frames)
+
+    def reset():
+        frame = preprocess_frame(env.reset())
+        for _ in range(n_frames):
+            frames.append(frame)
+        return np.stack(frames, axis=2)
+
+    lives = None
+    episode_rewards, episode_steps = 0, 0
+
+    while True:
+
+        cmd, action = conn.recv()
+
+        if cmd == "step":
+            frame, reward, done, info = env.step(action)
+            frames.append(preprocess_frame(frame))
+            next_state = np.stack(frames, axis=2)
+
+            episode_rewards += reward
+            episode_steps += 1
+
+            #: life loss as episode ends
+            life_lost = (lives is not None) and (info["ale.lives"] != lives)
+            lives = info["ale.lives"]
+
+            step = Step(reward, next_state, done or life_lost, done,
+                        episode_rewards, episode_steps, next_state)
+
+            if done:
+                step.state = reset()
+                lives = None
+                episode_rewards, episode_steps = 0, 0
+
+            conn.send(step)
+
+        elif cmd == "reset":
+            lives = None
+            episode_rewards, episode_steps = 0, 0
+            conn.send(reset())
+
+        elif cmd == "close":
+            conn.close()
+            break
+
+        else:
+            raise NotImplementedError()
+
+
+class SubProcVecEnv:
+    """ n_envs個のenvをサブプロセスで同時に進める
+
+        ワーカーはtensorflowを初期化済みの親プロセスからforkしないようspawnで起動する
+    """
+
+    def __init__(self, env_name, n_envs, n_frames=4, seed=0):
+
+        self.closed = False
+
+        self.n_envs = n_envs
+
+        ctx = multiprocessing.get_context("spawn")
+
+        pipes = [ctx.Pipe() for _ in range(self.n_envs)]
+
+        self.conns = [pipe[0] for pipe in pipes]
+
+        self.workers = [
+            ctx.Process(target=workerfunc,
+                        args=(pipe[1], env_name, n_frames, seed + i))
+            for i, pipe in enumerate(pipes)]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def step(self, actions):
+        """
+        Returns:
+            list of Step. Step.stateは次に行動選択するための状態で、
+            エピソード終了時はreset後の状態になる
+        """
+
+        for conn, action in zip(self.conns, actions):
+            conn.send(("step", int(action)))
+
+        return [conn.recv() for conn in self.conns]
+
+    def reset(self):
+
+        for conn in self.conns:
+            conn.send(("reset", None))
+
+        return np.stack([conn.recv() for conn in self.conns])
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        for conn in self.conns:
+            conn.send(("close", None))
+
+        for worker in self.workers:
+            worker.join()
+
+        self.closed = True
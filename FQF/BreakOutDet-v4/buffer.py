@@ -5,6 +5,8 @@ import numpy as np
 import pickle
 import zlib
 
+from sampler import UniformSampler
+
 
 @dataclass
 class Experience:
@@ -28,6 +30,8 @@ class ReplayBuffer:
 
         self.max_len = max_len
 
+        self.sampler = UniformSampler()
+
         self.buffer = []
 
         self.compress = compress
@@ -52,12 +56,17 @@ class ReplayBuffer:
 
         self.count += 1
 
+    def push_batch(self, exps):
+        """ 複数envの遷移をまとめて追加する
+        """
+        for exp in exps:
+            self.push(exp)
+
     def get_minibatch(self, batch_size):
 
         N = len(self.buffer)
 
-        indices = np.random.choice(
-            np.arange(N), replace=False, size=batch_size)
+        indices = self.sampler.sample(N, batch_size)
 
         if self.compress:
             selected_experiences = [
@@ -66,7 +75,7 @@ class ReplayBuffer:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -76,7 +85,7 @@ class ReplayBuffer:
 
         next_states = np.vstack(
             [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            )
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
@@ -1,4 +1,5 @@
 from pathlib import Path
+import functools
 import shutil
 
 import gym
@@ -8,7 +9,11 @@ import collections
 
 from models import FQFNetwork
 from buffer import Experience, ReplayBuffer
-from util import frame_preprocess
+from util import frame_preprocess, quantile_huberloss
+from mixed_precision import (
+    enable_mixed_precision, wrap_optimizer, scale_loss, unscale_gradients)
+from vecenv import SubProcVecEnv, epsilon_greedy
+from evaluator import EvalService
 
 
 class FQFAgent:
@@ -19,7 +24,8 @@ class FQFAgent:
                  gamma=0.99, n_frames=4, batch_size=32,
                  buffer_size=1000000,
                  update_period=8,
-                 target_update_period=10000):
+                 target_update_period=10000,
+                 mixed_precision=False):
 
         self.env_name = env_name
 
@@ -37,6 +43,17 @@ class FQFAgent:
 
         self.action_space = gym.make(self.env_name).action_space.n
 
+        if mixed_precision:
+            enable_mixed_precision()
+
+        #: 評価プロセスでも同じネットワークを作れるようにしておく
+        self.network_fn = functools.partial(
+            FQFNetwork,
+            action_space=self.action_space,
+            num_quantiles=self.num_quantiles,
+            state_embedding_dim=self.state_embedding_dim,
+            quantile_embedding_dim=self.quantile_embedding_dim)
+
         self.fqf_network = FQFNetwork(
             action_space=self.action_space,
             num_quantiles=self.num_quantiles,
@@ -51,13 +68,13 @@ class FQFAgent:
 
         self._define_network()
 
-        self.optimizer = tf.keras.optimizers.Adam(
-            lr=0.00015, epsilon=0.01/32)
+        self.optimizer = wrap_optimizer(tf.keras.optimizers.Adam(
+            lr=0.00015, epsilon=0.01/32))
 
         #: fpl; fraction proposal layer
-        self.optimizer_fpl = tf.keras.optimizers.Adam(
+        self.optimizer_fpl = wrap_optimizer(tf.keras.optimizers.Adam(
             learning_rate=0.00005 * fqf_factor,
-            epsilon=0.0003125)
+            epsilon=0.0003125))
 
         self.gamma = gamma
 
@@ -94,13 +111,17 @@ class FQFAgent:
         else:
             return 0.05
 
-    def learn(self, n_episodes, logdir="log"):
+    def learn(self, n_episodes, logdir="log", n_eval_episodes=8):
 
         logdir = Path(__file__).parent / logdir
         if logdir.exists():
             shutil.rmtree(logdir)
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
+        evaluator = EvalService(
+            self.network_fn, self.env_name, n_episodes=n_eval_episodes,
+            n_frames=self.n_frames, epsilon=0.01)
+
         for episode in range(1, n_episodes+1):
 
             env = gym.make(self.env_name)
@@ -159,104 +180,181 @@ class FQFAgent:
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
 
             if episode % 20 == 0:
-                test_scores, test_steps = self.test_play(n_testplay=1)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar("test_score", test_scores[0], step=self.steps)
-                    tf.summary.scalar("test_step", test_steps[0], step=self.steps)
+                evaluator.submit(self.steps, self.fqf_network.get_weights())
+
+            for result in evaluator.poll():
+                self.log_evaluation(result)
 
             if episode % 500 == 0:
                 self.fqf_network.save_weights("checkpoints/fqfnet")
                 print("Model Saved")
 
+        for result in evaluator.close(wait=True):
+            self.log_evaluation(result)
+
+    def log_evaluation(self, result):
+
+        with self.summary_writer.as_default():
+            for key in ("mean", "median", "iqm"):
+                tf.summary.scalar(
+                    f"test_score/{key}", result[key], step=result["step"])
+            tf.summary.scalar(
+                "test_step", np.mean(result["steps"]), step=result["step"])
+
+    def learn_vectorized(self, total_steps, n_envs=8, epsilon_alpha=0.,
+                         logdir="log"):
+        """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+        Args:
+            epsilon_alpha (float): env iのε = ε(steps) ** (1 + α * i / (n_envs-1)).
+                0ならすべてのenvで同じε, Ape-Xでは7
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        vecenv = SubProcVecEnv(self.env_name, n_envs, n_frames=self.n_frames)
+
+        states = vecenv.reset()
+
+        epsilon_exponents = 1 + epsilon_alpha * np.arange(n_envs) / max(n_envs - 1, 1)
+
+        episode = 0
+        while self.steps < total_steps:
+
+            epsilons = self.epsilon ** epsilon_exponents
+
+            greedy_actions, _ = self.fqf_network.greedy_action(states)
+            actions = epsilon_greedy(greedy_actions, epsilons, self.action_space)
+
+            results = vecenv.step(actions)
+
+            self.replay_buffer.push_batch(
+                [Experience(states[[i]], actions[i], res.reward,
+                            res.next_state[np.newaxis, ...], res.done)
+                 for i, res in enumerate(results)])
+
+            states = np.stack([res.state for res in results])
+
+            prev_steps, self.steps = self.steps, self.steps + n_envs
+
+            for res in results:
+                if not res.episode_done:
+                    continue
+
+                episode += 1
+                print(f"Episode: {episode}, score: {res.episode_rewards}, steps: {res.episode_steps}")
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("train_score", res.episode_rewards, step=self.steps)
+                    tf.summary.scalar("train_steps", res.episode_steps, step=self.steps)
+
+                if episode % 500 == 0:
+                    self.fqf_network.save_weights("checkpoints/fqfnet")
+
+            if len(self.replay_buffer) > 50000:
+                n_updates = self.steps // self.update_period - prev_steps // self.update_period
+                for _ in range(n_updates):
+                    loss, loss_fp, entropy = self.update_network()
+
+                if n_updates:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("loss", loss, step=self.steps)
+                        tf.summary.scalar("loss_fp", loss_fp, step=self.steps)
+                        tf.summary.scalar("entropy", entropy, step=self.steps)
+                        tf.summary.scalar("epsilon", epsilons[0], step=self.steps)
+                        tf.summary.scalar("buffer_size", len(self.replay_buffer), step=self.steps)
+
+            if self.steps // self.target_update_period != prev_steps // self.target_update_period:
+                self.target_fqf_network.set_weights(self.fqf_network.get_weights())
+
+        vecenv.close()
+
     def update_network(self):
 
         (states, actions, rewards,
          next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size)
 
-        rewards = rewards.reshape((self.batch_size, 1, 1))
-        dones = dones.reshape((self.batch_size, 1, 1))
+        rewards = rewards.astype(np.float32)
+        dones = dones.astype(np.float32)
+
+        loss, loss_fp, entropy = self._update_network(
+            states, actions, rewards, next_states, dones)
+
+        return loss, loss_fp, entropy
+
+    @tf.function
+    def _update_network(self, states, actions, rewards, next_states, dones):
+        """ state embeddingはonline/targetそれぞれ一度だけ計算し、
+            F(τ^)とF(τ)はτを連結して一度のquantile_functionで評価する
+        """
+
+        actions_onehot = tf.one_hot(
+            tf.cast(tf.reshape(actions, [-1]), tf.int32), self.action_space)
+        actions_mask = tf.expand_dims(actions_onehot, axis=2)
+
+        with tf.GradientTape(persistent=True) as tape:
 
-        with tf.GradientTape() as tape:
-            #: Compute F(τ^)
             state_embedded = self.fqf_network.state_embedding_layer(states)
 
-            taus, taus_hat, taus_hat_probs = self.fqf_network.propose_fractions(state_embedded)
-            taus_hat, taus_hat_probs = tf.stop_gradient(taus_hat), tf.stop_gradient(taus_hat_probs)
+            #: fraction proposal lossはstate embeddingに勾配を流さないので、
+            #: τはfraction_proposal_layerの重みにのみ依存させる
+            taus, taus_hat, taus_hat_probs = self.fqf_network.propose_fractions(
+                tf.stop_gradient(state_embedded))
+
+            #: Compute F(τ^) and F(τ), shape==(batchsize, 2N-1)
+            quantiles_all = self.fqf_network.quantile_function(
+                state_embedded, tf.concat([taus_hat, taus[:, 1:-1]], axis=1))
+            quantiles_all = tf.reduce_sum(quantiles_all * actions_mask, axis=1)
 
-            quantiles = self.fqf_network.quantile_function(
-                state_embedded, taus_hat)
-            actions_onehot = tf.one_hot(
-                actions.flatten().astype(np.int32), self.action_space)
-            actions_mask = tf.expand_dims(actions_onehot, axis=2)
-            quantiles = tf.reduce_sum(
-                quantiles * actions_mask, axis=1, keepdims=True)
+            quantiles_hat = quantiles_all[:, :self.num_quantiles]
+            quantiles = quantiles_all[:, self.num_quantiles:]
 
             #: Compute target F(τ^), use same taus proposed by online network
             next_actions, target_quantiles = self.target_fqf_network.greedy_action_on_given_taus(
-                next_states, taus_hat, taus_hat_probs)
+                next_states, tf.stop_gradient(taus_hat), tf.stop_gradient(taus_hat_probs))
 
-            next_actions_onehot = tf.one_hot(next_actions.numpy().flatten(), self.action_space)
+            next_actions_onehot = tf.one_hot(
+                tf.reshape(next_actions, [-1]), self.action_space)
             next_actions_mask = tf.expand_dims(next_actions_onehot, axis=2)
             target_quantiles = tf.reduce_sum(
-                target_quantiles * next_actions_mask, axis=1, keepdims=True)
+                target_quantiles * next_actions_mask, axis=1)
 
             #: TF(τ^)
             target_quantiles = rewards + self.gamma * (1-dones) * target_quantiles
             target_quantiles = tf.stop_gradient(target_quantiles)
 
             #: Compute Quantile regression loss
-            target_quantiles = tf.repeat(
-                target_quantiles, self.num_quantiles, axis=1)
-            quantiles = tf.repeat(
-                tf.transpose(quantiles, [0, 2, 1]), self.num_quantiles, axis=2)
-
-            #: huberloss
-            bellman_errors = target_quantiles - quantiles
-            is_smaller_than_k = tf.abs(bellman_errors) < self.k
-            squared_loss = 0.5 * tf.square(bellman_errors)
-            linear_loss = self.k * (tf.abs(bellman_errors) - 0.5 * self.k)
+            loss = quantile_huberloss(
+                target_quantiles, quantiles_hat,
+                tf.stop_gradient(taus_hat), k=self.k)
+            loss = tf.reduce_mean(loss)
 
-            huberloss = tf.where(is_smaller_than_k, squared_loss, linear_loss)
+            #: Compute fraction proposal loss
+            dw_dtau = 2 * quantiles - quantiles_hat[:, 1:] - quantiles_hat[:, :-1]
 
-            #: quantile loss
-            indicator = tf.stop_gradient(tf.where(bellman_errors < 0, 1., 0.))
-            _taus_hat = tf.repeat(
-                tf.expand_dims(taus_hat, axis=2), self.num_quantiles, axis=2)
+            entropy = tf.reduce_sum(-1 * taus_hat * tf.math.log(taus_hat), axis=1)
 
-            quantile_factors = tf.abs(_taus_hat - indicator)
-            quantile_huberloss = quantile_factors * huberloss
+            loss_fp = tf.reduce_mean(tf.square(dw_dtau), axis=1)
+            loss_fp += -1 * self.ent_coef * entropy
+            loss_fp = tf.reduce_mean(loss_fp)
 
-            loss = tf.reduce_mean(quantile_huberloss, axis=2),
-            loss = tf.reduce_sum(loss, axis=1)
-            loss = tf.reduce_mean(loss)
+            scaled_loss = scale_loss(self.optimizer, loss)
+            scaled_loss_fp = scale_loss(self.optimizer_fpl, loss_fp)
 
         state_embedding_vars = self.fqf_network.state_embedding_layer.trainable_variables
         quantile_function_vars = self.fqf_network.quantile_function.trainable_variables
 
         variables = state_embedding_vars + quantile_function_vars
-        grads = tape.gradient(loss, variables)
-
-        with tf.GradientTape() as tape2:
-            taus_all = self.fqf_network.fraction_proposal_layer(state_embedded)
-            taus = taus_all[:, 1:-1]
-
-            quantiles = self.fqf_network.quantile_function(
-                state_embedded, taus)
-            taus_hat = (taus_all[:, 1:] + taus_all[:, :-1]) / 2.
-            quantiles_hat = self.fqf_network.quantile_function(
-                state_embedded, taus_hat)
-
-            dw_dtau = 2 * quantiles - quantiles_hat[:, :, 1:] - quantiles_hat[:, :, :-1]
-            dw_dtau = tf.reduce_sum(dw_dtau * actions_mask, axis=1)
-
-            entropy = tf.reduce_sum(-1 * taus_hat * tf.math.log(taus_hat), axis=1)
-
-            loss_fp = tf.reduce_mean(tf.square(dw_dtau), axis=1)
-            loss_fp += -1 * self.ent_coef * entropy
-            loss_fp = tf.reduce_mean(loss_fp)
+        grads = tape.gradient(scaled_loss, variables)
+        grads = unscale_gradients(self.optimizer, grads)
 
         fp_variables = self.fqf_network.fraction_proposal_layer.trainable_variables
-        grads_fp = tape2.gradient(loss_fp, fp_variables)
+        grads_fp = tape.gradient(scaled_loss_fp, fp_variables)
+        grads_fp = unscale_gradients(self.optimizer_fpl, grads_fp)
+
+        del tape
 
         self.optimizer.apply_gradients(zip(grads, variables))
         self.optimizer_fpl.apply_gradients(zip(grads_fp, fp_variables))
@@ -76,11 +76,8 @@ class FQFNetwork(tf.keras.Model):
 
         _, taus_hat_probs, quantiles_tau_hat = self(state)
 
-        taus_hat_probs = tf.repeat(
-            tf.expand_dims(taus_hat_probs, axis=1),
-            self.action_space, axis=1)
-
-        weighted_quantiles_tau_hat = quantiles_tau_hat * taus_hat_probs
+        weighted_quantiles_tau_hat = (
+            quantiles_tau_hat * tf.expand_dims(taus_hat_probs, axis=1))
         q_means = tf.reduce_mean(
             weighted_quantiles_tau_hat, axis=2, keepdims=True)
         selected_actions = tf.argmax(q_means, axis=1)
@@ -95,11 +92,8 @@ class FQFNetwork(tf.keras.Model):
 
         quantiles_tau_hat = self.quantile_function(state_embedded, taus_hat)
 
-        taus_hat_probs = tf.repeat(
-            tf.expand_dims(taus_hat_probs, axis=1),
-            self.action_space, axis=1)
-
-        weighted_quantiles_tau_hat = quantiles_tau_hat * taus_hat_probs
+        weighted_quantiles_tau_hat = (
+            quantiles_tau_hat * tf.expand_dims(taus_hat_probs, axis=1))
         q_means = tf.reduce_mean(
             weighted_quantiles_tau_hat, axis=2, keepdims=True)
         selected_actions = tf.argmax(q_means, axis=1)
@@ -123,6 +117,8 @@ class StateEmbeddingNetwork(tf.keras.layers.Layer):
         self.flatten1 = kl.Flatten()
 
     def call(self, x):
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -142,7 +138,9 @@ class FractionProposalNetwork(tf.keras.layers.Layer):
 
         self.state_embedding_dim = state_embedding_dim
 
+        #: softmax/cumsumはfloat32で計算する
         self.dense_1 = kl.Dense(num_quantiles-1, activation=None,
+                                dtype="float32",
                                 kernel_initializer="he_normal")
 
     def call(self, state_embedded):
@@ -181,44 +179,48 @@ class QuantileFunctionNetwork(tf.keras.layers.Layer):
         self.dense2 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
+        #: mixed precisionでも出力はfloat32
         self.out = kl.Dense(self.action_space, activation=None,
+                            dtype="float32",
                             kernel_initializer="he_normal")
 
-    def call(self, state_embedded, quantiles):
+        self.pis = tf.range(
+            1, self.quantile_embedding_dim+1, 1, dtype=tf.float32) * np.pi
 
-        batch_size, N = state_embedded.shape[0], quantiles.shape[1]
+    def cosine_embedding(self, quantiles):
+        """ cos(πiτ), i=1,...,quantile_embedding_dim
 
-        """ Repeat for the number of quantiles
+        Args:
+            quantiles: shape==(batchsize, N) or (N,)
+        Returns:
+            shape==(batchsize, N, quantile_embedding_dim) or (1, N, quantile_embedding_dim)
         """
-        state_embedded = tf.repeat(
-            tf.expand_dims(state_embedded, axis=1), N, axis=1)
-        state_embedded = tf.reshape(
-            state_embedded,
-            [batch_size * N, self.state_embedding_dim])
+        if len(quantiles.shape) == 1:
+            quantiles = tf.expand_dims(quantiles, axis=0)
 
-        """ cosine embedding of τ
-        """
-        quantiles_embedded = tf.expand_dims(quantiles, axis=2)
-        quantiles_embedded = tf.repeat(
-            quantiles_embedded, self.quantile_embedding_dim, axis=2)
+        #: (batchsize, N, 1) * (quantile_embedding_dim,) のbroadcast
+        return tf.cos(tf.expand_dims(quantiles, axis=2) * self.pis)
 
-        pis = tf.range(1, self.quantile_embedding_dim+1, 1, dtype=tf.float32) * np.pi
-        quantiles_embedded = tf.cos(quantiles_embedded * pis)
+    def call(self, state_embedded, quantiles, cos_basis=None):
+        """ τごとの分位点の値 F(τ)
 
-        #: DenseLayerに適用するための不自然なreshape
-        quantiles_embedded = tf.reshape(
-            quantiles_embedded, [batch_size * N, self.quantile_embedding_dim])
-        quantiles_embedded = self.dense1(quantiles_embedded)
+            τはbatchごとに異なっても(FQF, IQN)、batch全体で共通(shape==(N,))でもよい.
+            同じτを複数回評価する場合はcosine_embeddingの結果をcos_basisで渡せる
+
+        Returns:
+            quantile_values: shape==(batchsize, action_space, N)
+        """
+        if cos_basis is None:
+            cos_basis = self.cosine_embedding(quantiles)
 
-        assert quantiles_embedded.shape.as_list() == [batch_size * N, self.state_embedding_dim]
-        assert state_embedded.shape.as_list() == [batch_size * N, self.state_embedding_dim]
+        #: Denseはrank3入力に対して最終次元にのみ作用する
+        quantiles_embedded = self.dense1(cos_basis)
 
-        x = state_embedded * quantiles_embedded
+        #: (batchsize, 1, state_embedding_dim) * (batchsize, N, state_embedding_dim)
+        x = tf.expand_dims(state_embedded, axis=1) * quantiles_embedded
         x = self.dense2(x)
         quantile_values = self.out(x)
 
-        quantile_values = tf.reshape(
-            quantile_values, (batch_size, N, self.action_space))
         quantile_values = tf.transpose(quantile_values, [0, 2, 1])
 
         return quantile_values
@@ -237,10 +239,10 @@ if __name__ == "__main__":
         frames.append(frame)
 
     state1 = np.stack(frames, axis=2)
-    state2 = np.stack(frames, axis=2) * 0.77
+    state2 = (np.stack(frames, axis=2) * 0.77).astype(np.uint8)
 
     state = np.stack([state1, state2], axis=0)
-    state = tf.convert_to_tensor(state, dtype=tf.float32)
+    state = tf.convert_to_tensor(state)
 
     action = tf.convert_to_tensor([[1], [1]], dtype=tf.float32)
 
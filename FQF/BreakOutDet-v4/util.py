@@ -1,4 +1,7 @@
+import functools
+
 import numpy as np
+import tensorflow as tf
 from PIL import Image
 
 
@@ -6,5 +9,65 @@ def frame_preprocess(frame):
     """Breakout only"""
     image = Image.fromarray(frame)
     image = image.convert("L").crop((0, 34, 160, 200)).resize((84, 84))
-    image = np.array(image) / 255.0
-    return image.astype(np.float32)
+    #: [0, 1]へのスケーリングはネットワークの中で行う
+    return np.array(image, dtype=np.uint8)
+
+
+def _quantile_huberloss(target_quantile_values, quantile_values,
+                        quantiles, k):
+
+    #: (batchsize, N, N'), tf.repeatせずbroadcastで組み合わせを作る
+    td_errors = (tf.expand_dims(target_quantile_values, axis=1)
+                 - tf.expand_dims(quantile_values, axis=2))
+
+    #: huberloss
+    is_smaller_than_k = tf.abs(td_errors) < k
+    squared_loss = 0.5 * tf.square(td_errors)
+    linear_loss = k * (tf.abs(td_errors) - 0.5 * k)
+    huberloss = tf.where(is_smaller_than_k, squared_loss, linear_loss)
+
+    #: quantile huberloss
+    indicator = tf.stop_gradient(tf.where(td_errors < 0, 1., 0.))
+    quantile_weights = tf.abs(tf.expand_dims(quantiles, axis=2) - indicator)
+    quantile_huberloss = quantile_weights * huberloss
+
+    loss = tf.reduce_mean(quantile_huberloss, axis=2)
+    loss = tf.reduce_sum(loss, axis=1)
+
+    return loss
+
+
+def quantile_huberloss(target_quantile_values, quantile_values,
+                       quantiles, k=1.0, chunk_size=None):
+    """ Quantile regression loss  Σ_i E_j[ρ^κ_τi(Tθ_j - θ_i)]
+
+    Args:
+        target_quantile_values: shape==(batchsize, N')
+        quantile_values: shape==(batchsize, N)
+        quantiles: τ_i, shape==(N,) or (batchsize, N)
+        chunk_size (int): Nをchunk_sizeごとに分割して計算する.
+            各chunkは逆伝播時に再計算されるので
+            (batchsize, N, N')の中間テンソルを保持しない
+
+    Returns:
+        loss: shape==(batchsize,)
+    """
+    quantiles = tf.broadcast_to(
+        tf.cast(quantiles, tf.float32), tf.shape(quantile_values))
+
+    N = quantile_values.shape[1]
+
+    if chunk_size is None or chunk_size >= N:
+        return _quantile_huberloss(
+            target_quantile_values, quantile_values, quantiles, k)
+
+    chunk_loss = tf.recompute_grad(
+        functools.partial(_quantile_huberloss, k=k))
+
+    loss = 0.
+    for i in range(0, N, chunk_size):
+        loss += chunk_loss(target_quantile_values,
+                           quantile_values[:, i:i+chunk_size],
+                           quantiles[:, i:i+chunk_size])
+
+    return loss
@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 from env import VecEnv
 from models import PolicyNetwork, CriticNetwork
 import util
+from profiler import Profiler
 
 
 class PPOAgent:
@@ -43,10 +44,13 @@ class PPOAgent:
 
         self.r_running_stats = util.RunningStats(shape=(action_space,))
 
-    def run(self, n_updates, logdir):
+    def run(self, n_updates, logdir, profile=True):
 
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
+        profiler = Profiler(logdir=logdir, summary_writer=self.summary_writer,
+                            enabled=profile)
+
         history = {"steps": [], "scores": []}
 
         states = self.vecenv.reset()
@@ -57,24 +61,31 @@ class PPOAgent:
 
             for _ in range(self.trajectory_size):
 
-                actions = self.policy.sample_action(states)
+                with profiler.span("inference"):
+                    actions = self.policy.sample_action(states)
 
-                next_states = self.vecenv.step(actions)
+                with profiler.span("env_step"):
+                    next_states = self.vecenv.step(actions)
+                profiler.count("env_steps", self.n_envs)
 
                 states = next_states
 
-            trajectories = self.vecenv.get_trajectories()
+            with profiler.span("preprocess"):
+                trajectories = self.vecenv.get_trajectories()
 
-            for trajectory in trajectories:
-                self.r_running_stats.update(trajectory["r"])
+                for trajectory in trajectories:
+                    self.r_running_stats.update(trajectory["r"])
 
-            trajectories = self.compute_advantage(trajectories)
+                trajectories = self.compute_advantage(trajectories)
 
-            states, actions, advantages, vtargs = self.create_minibatch(trajectories)
+                states, actions, advantages, vtargs = self.create_minibatch(trajectories)
 
-            vloss = self.update_critic(states, vtargs)
+            with profiler.span("train_step"):
+                vloss = self.update_critic(states, vtargs)
 
-            self.update_policy(states, actions, advantages)
+                self.update_policy(states, actions, advantages)
+            profiler.count("updates")
+            profiler.count("samples", len(states))
 
             global_steps = (epoch+1) * self.trajectory_size * self.n_envs
             train_scores = np.array([traj["r"].sum() for traj in trajectories])
@@ -93,9 +104,14 @@ class PPOAgent:
                 hiscore = ma_score
                 print("Model Saved")
 
-            with self.summary_writer.as_default():
-                tf.summary.scalar("value_loss", vloss, step=epoch)
-                tf.summary.scalar("train_score", train_scores.mean(), step=epoch)
+            with profiler.span("summary"):
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("value_loss", vloss, step=epoch)
+                    tf.summary.scalar("train_score", train_scores.mean(), step=epoch)
+
+            profiler.step(global_steps)
+
+        profiler.close()
 
         return history
 
@@ -0,0 +1,111 @@
+""" quantile huberlossのメモリ/レイテンシ比較
+    repeat: 旧実装 (tf.repeatで(batchsize, N, N)を実体化)
+    broadcast: util.quantile_huberloss
+    chunked: util.quantile_huberloss(chunk_size=N//4)
+"""
+import time
+
+import tensorflow as tf
+
+from util import quantile_huberloss
+
+
+def repeat_quantile_huberloss(target_quantile_values, quantile_values,
+                              quantiles, k=1.0):
+    N = quantile_values.shape[1]
+
+    target_quantile_values = tf.repeat(
+        tf.expand_dims(target_quantile_values, axis=1), N, axis=1)
+    quantile_values = tf.repeat(
+        tf.expand_dims(quantile_values, axis=2), N, axis=2)
+
+    td_errors = target_quantile_values - quantile_values
+
+    is_smaller_than_k = tf.abs(td_errors) < k
+    squared_loss = 0.5 * tf.square(td_errors)
+    linear_loss = k * (tf.abs(td_errors) - 0.5 * k)
+    huberloss = tf.where(is_smaller_than_k, squared_loss, linear_loss)
+
+    indicator = tf.stop_gradient(tf.where(td_errors < 0, 1., 0.))
+    quantiles = tf.repeat(tf.expand_dims(quantiles, axis=1), N, axis=1)
+    quantile_weights = tf.abs(quantiles - indicator)
+    quantile_huberloss = quantile_weights * huberloss
+
+    loss = tf.reduce_mean(quantile_huberloss, axis=2)
+    loss = tf.reduce_sum(loss, axis=1)
+
+    return loss
+
+
+def make_step(loss_fn, **kwargs):
+
+    @tf.function
+    def step(target_quantile_values, quantile_values, quantiles):
+        with tf.GradientTape() as tape:
+            tape.watch(quantile_values)
+            loss = tf.reduce_mean(loss_fn(
+                target_quantile_values, quantile_values, quantiles, **kwargs))
+        grads = tape.gradient(loss, quantile_values)
+        return loss, grads
+
+    return step
+
+
+def peak_memory_mb():
+    """ GPUがあればallocatorのpeakを返す. CPUでは計測できないのでNone
+    """
+    if not tf.config.list_physical_devices("GPU"):
+        return None
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20
+
+
+def reset_peak_memory():
+    if tf.config.list_physical_devices("GPU"):
+        tf.config.experimental.reset_memory_stats("GPU:0")
+
+
+def benchmark(N, batch_size=32, n_iters=100):
+
+    target_quantile_values = tf.random.normal((batch_size, N))
+    quantile_values = tf.random.normal((batch_size, N))
+    quantiles = tf.constant(
+        [1/(2*N) + i * 1 / N for i in range(N)], dtype=tf.float32)
+
+    steps = {
+        "repeat": make_step(repeat_quantile_huberloss),
+        "broadcast": make_step(quantile_huberloss),
+        "chunked": make_step(quantile_huberloss, chunk_size=max(1, N // 4)),
+        }
+
+    results = {}
+    for name, step in steps.items():
+        #: tracing
+        loss, _ = step(target_quantile_values, quantile_values, quantiles)
+
+        reset_peak_memory()
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            loss, grads = step(target_quantile_values, quantile_values, quantiles)
+        grads.numpy()
+        elapsed = (time.perf_counter() - start) / n_iters
+
+        results[name] = {"loss": float(loss), "latency_ms": elapsed * 1000,
+                         "peak_mb": peak_memory_mb()}
+
+    return results
+
+
+def main():
+
+    for N in [32, 64, 200]:
+        results = benchmark(N)
+        pairwise_mb = 32 * N * N * 4 / 2**20
+        print(f"N={N}: (batchsize, N, N) float32 tensor = {pairwise_mb:.2f}MB")
+        for name, res in results.items():
+            peak = f"{res['peak_mb']:.2f}MB" if res["peak_mb"] is not None else "n/a"
+            print(f"    {name:<10} latency {res['latency_ms']:.3f}ms, "
+                  f"peak {peak}, loss {res['loss']:.5f}")
+
+
+if __name__ == "__main__":
+    main()
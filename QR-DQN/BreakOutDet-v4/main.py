@@ -1,4 +1,5 @@
 from pathlib import Path
+import functools
 import shutil
 
 import gym
@@ -8,7 +9,11 @@ import collections
 
 from model import QuantileQNetwork
 from buffer import Experience, ReplayBuffer
-from util import frame_preprocess
+from util import frame_preprocess, quantile_huberloss
+from mixed_precision import (
+    enable_mixed_precision, wrap_optimizer, scale_loss, unscale_gradients)
+from vecenv import SubProcVecEnv, epsilon_greedy
+from evaluator import EvalService
 
 
 class QRDQNAgent:
@@ -18,7 +23,9 @@ class QRDQNAgent:
                  n_frames=4, batch_size=32,
                  buffer_size=1000000,
                  update_period=8,
-                 target_update_period=10000):
+                 target_update_period=10000,
+                 loss_chunk_size=None,
+                 mixed_precision=False):
 
         self.env_name = env_name
 
@@ -26,10 +33,13 @@ class QRDQNAgent:
 
         self.N = N
 
-        self.quantiles = [1/(2*N) + i * 1 / N for i in range(N)]
+        self.quantiles = tf.constant(
+            [1/(2*N) + i * 1 / N for i in range(N)], dtype=tf.float32)
 
         self.k = 1.0
 
+        self.loss_chunk_size = loss_chunk_size
+
         self.n_frames = n_frames
 
         self.batch_size = batch_size
@@ -40,6 +50,13 @@ class QRDQNAgent:
 
         self.action_space = gym.make(self.env_name).action_space.n
 
+        if mixed_precision:
+            enable_mixed_precision()
+
+        #: 評価プロセスでも同じネットワークを作れるようにしておく
+        self.network_fn = functools.partial(
+            QuantileQNetwork, actions_space=self.action_space, N=N)
+
         self.qnet = QuantileQNetwork(actions_space=self.action_space, N=N)
 
         self.target_qnet = QuantileQNetwork(actions_space=self.action_space, N=N)
@@ -48,7 +65,8 @@ class QRDQNAgent:
 
         self.replay_buffer = ReplayBuffer(max_len=buffer_size)
 
-        self.optimizer = tf.keras.optimizers.Adam(lr=0.00025, epsilon=0.01/32)
+        self.optimizer = wrap_optimizer(
+            tf.keras.optimizers.Adam(lr=0.00025, epsilon=0.01/32))
 
         self.steps = 0
 
@@ -75,13 +93,17 @@ class QRDQNAgent:
         else:
             return 0.05
 
-    def learn(self, n_episodes, logdir="log"):
+    def learn(self, n_episodes, logdir="log", n_eval_episodes=8):
 
         logdir = Path(__file__).parent / logdir
         if logdir.exists():
             shutil.rmtree(logdir)
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
+        evaluator = EvalService(
+            self.network_fn, self.env_name, n_episodes=n_eval_episodes,
+            n_frames=self.n_frames, epsilon=0.01)
+
         for episode in range(1, n_episodes+1):
             env = gym.make(self.env_name)
 
@@ -136,64 +158,135 @@ class QRDQNAgent:
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
 
             if episode % 20 == 0:
-                test_scores, test_steps = self.test_play(n_testplay=1)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar("test_score", test_scores[0], step=self.steps)
-                    tf.summary.scalar("test_step", test_steps[0], step=self.steps)
+                evaluator.submit(self.steps, self.qnet.get_weights())
+
+            for result in evaluator.poll():
+                self.log_evaluation(result)
 
             if episode % 500 == 0:
                 self.qnet.save_weights("checkpoints/qnet")
                 print("Model Saved")
 
+        for result in evaluator.close(wait=True):
+            self.log_evaluation(result)
+
+    def log_evaluation(self, result):
+
+        with self.summary_writer.as_default():
+            for key in ("mean", "median", "iqm"):
+                tf.summary.scalar(
+                    f"test_score/{key}", result[key], step=result["step"])
+            tf.summary.scalar(
+                "test_step", np.mean(result["steps"]), step=result["step"])
+
+    def learn_vectorized(self, total_steps, n_envs=8, epsilon_alpha=0.,
+                         logdir="log"):
+        """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+        Args:
+            epsilon_alpha (float): env iのε = ε(steps) ** (1 + α * i / (n_envs-1)).
+                0ならすべてのenvで同じε, Ape-Xでは7
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        vecenv = SubProcVecEnv(self.env_name, n_envs, n_frames=self.n_frames)
+
+        states = vecenv.reset()
+
+        epsilon_exponents = 1 + epsilon_alpha * np.arange(n_envs) / max(n_envs - 1, 1)
+
+        episode = 0
+        while self.steps < total_steps:
+
+            epsilons = self.epsilon ** epsilon_exponents
+
+            greedy_actions, _ = self.qnet.sample_actions(states)
+            actions = epsilon_greedy(greedy_actions, epsilons, self.action_space)
+
+            results = vecenv.step(actions)
+
+            self.replay_buffer.push_batch(
+                [Experience(states[[i]], actions[i], res.reward,
+                            res.next_state[np.newaxis, ...], res.done)
+                 for i, res in enumerate(results)])
+
+            states = np.stack([res.state for res in results])
+
+            prev_steps, self.steps = self.steps, self.steps + n_envs
+
+            for res in results:
+                if not res.episode_done:
+                    continue
+
+                episode += 1
+                print(f"Episode: {episode}, score: {res.episode_rewards}, steps: {res.episode_steps}")
+                with self.summary_writer.as_default():
+                    tf.summary.scalar("train_score", res.episode_rewards, step=self.steps)
+                    tf.summary.scalar("train_steps", res.episode_steps, step=self.steps)
+
+                if episode % 500 == 0:
+                    self.qnet.save_weights("checkpoints/qnet")
+
+            if len(self.replay_buffer) > 20000:
+                n_updates = self.steps // self.update_period - prev_steps // self.update_period
+                for _ in range(n_updates):
+                    loss = self.update_network()
+
+                if n_updates:
+                    with self.summary_writer.as_default():
+                        tf.summary.scalar("loss", loss, step=self.steps)
+                        tf.summary.scalar("epsilon", epsilons[0], step=self.steps)
+                        tf.summary.scalar("buffer_size", len(self.replay_buffer), step=self.steps)
+
+            if self.steps // self.target_update_period != prev_steps // self.target_update_period:
+                self.target_qnet.set_weights(self.qnet.get_weights())
+
+        vecenv.close()
+
     def update_network(self):
         (states, actions, rewards,
          next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size)
 
-        next_actions, next_quantile_values_all = self.target_qnet.sample_actions(next_states)
+        rewards = rewards.astype(np.float32)
+        dones = dones.astype(np.float32)
 
-        assert self.batch_size == states.shape[0] == len(next_actions)
+        loss = self._update_network(
+            states, actions, rewards, next_states, dones)
 
-        next_actions_onehot = tf.one_hot(next_actions.numpy().flatten(), self.action_space)
-        next_actions_mask = tf.expand_dims(next_actions_onehot, axis=2)
+        return loss
+
+    @tf.function
+    def _update_network(self, states, actions, rewards, next_states, dones):
+
+        next_actions, next_quantile_values_all = self.target_qnet.sample_actions(next_states)
+
+        #: (batchsize, N)
+        next_actions_onehot = tf.one_hot(tf.reshape(next_actions, [-1]), self.action_space)
         next_quantile_values = tf.reduce_sum(
-            next_quantile_values_all * next_actions_mask, axis=1, keepdims=True)
+            next_quantile_values_all * tf.expand_dims(next_actions_onehot, axis=2), axis=1)
 
-        target_quantile_values = np.zeros_like(next_quantile_values)
-        for i in range(self.batch_size):
-            target_quantile_values[i, ...] = rewards[i] + self.gamma * (1 - dones[i]) * next_quantile_values[i, ...]
-        target_quantile_values = tf.repeat(target_quantile_values, self.N, axis=1)
+        target_quantile_values = rewards + self.gamma * (1. - dones) * next_quantile_values
 
         with tf.GradientTape() as tape:
             quantile_values_all = self.qnet(states)
             actions_onehot = tf.one_hot(
-                actions.flatten().astype(np.int32), self.action_space)
-            actions_mask = tf.expand_dims(actions_onehot, axis=2)
+                tf.cast(tf.reshape(actions, [-1]), tf.int32), self.action_space)
             quantile_values = tf.reduce_sum(
-                quantile_values_all * actions_mask, axis=1, keepdims=True)
-            quantile_values = tf.repeat(
-                tf.transpose(quantile_values, [0, 2, 1]), self.N, axis=2)
-
-            #: (batchsize, N, N)
-            td_errors = target_quantile_values - quantile_values
-
-            #: huberloss(k=1.0)
-            is_smaller_than_k = tf.abs(td_errors) < self.k
-            squared_loss = 0.5 * tf.square(td_errors)
-            linear_loss = self.k * (tf.abs(td_errors) - 0.5 * self.k)
-            huberloss = tf.where(is_smaller_than_k, squared_loss, linear_loss)
-
-            #: quantile huberloss
-            indicator = tf.stop_gradient(tf.where(td_errors < 0, 1., 0.))
-            quantiles = tf.repeat(tf.expand_dims(self.quantiles, axis=1), self.N, axis=1)
-            quantile_weights = tf.abs(quantiles - indicator)
-            quantile_huberloss = quantile_weights * huberloss
-
-            loss = tf.reduce_mean(quantile_huberloss, axis=2)
-            loss = tf.reduce_sum(loss, axis=1)
+                quantile_values_all * tf.expand_dims(actions_onehot, axis=2), axis=1)
+
+            loss = quantile_huberloss(
+                target_quantile_values, quantile_values, self.quantiles,
+                k=self.k, chunk_size=self.loss_chunk_size)
             loss = tf.reduce_mean(loss)
+            scaled_loss = scale_loss(self.optimizer, loss)
 
         variables = self.qnet.trainable_variables
-        grads = tape.gradient(loss, variables)
+        grads = tape.gradient(scaled_loss, variables)
+        grads = unscale_gradients(self.optimizer, grads)
         self.optimizer.apply_gradients(
             zip(grads, variables))
 
@@ -23,12 +23,16 @@ class QuantileQNetwork(tf.keras.Model):
         self.flatten1 = kl.Flatten()
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
-        self.out = kl.Dense(self.action_space * self.N,
+        #: mixed precisionでも出力はfloat32
+        self.out = kl.Dense(self.action_space * self.N, dtype="float32",
                             kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         batch_size = x.shape[0]
 
         x = self.conv1(x)
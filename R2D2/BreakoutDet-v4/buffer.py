@@ -0,0 +1,267 @@
+from dataclasses import dataclass
+import collections
+import pickle
+import zlib
+
+import numpy as np
+
+import util
+
+
+@dataclass
+class Segment:
+    """ actorが送る連続したステップのまとまり
+
+        segmentの中にはstrideステップずつずらした長さseq_lenの系列が
+        seqs_per_segment個含まれる. 重なっている系列どうしでフレームを共有するため、
+        フレームは系列ごとではなくstrideステップごとのブロックに分けて圧縮しておく
+    """
+
+    frame_blocks: list  #: zlib圧縮した(stride, 84, 84)のuint8フレーム
+
+    actions: np.ndarray
+
+    returns: np.ndarray  #: n-step return
+
+    discounts: np.ndarray  #: γ^n. n-step以内にdoneがあれば0
+
+    resets: np.ndarray  #: 1ならそのステップの前でLSTMの状態を0にする
+
+    lstm_states: np.ndarray  #: 各系列の開始時点のLSTM状態. shape==(seqs_per_segment, 2, units)
+
+    priorities: np.ndarray  #: 系列ごとの優先度. shape==(seqs_per_segment,)
+
+
+class LocalSegmentBuffer:
+    """ actor側で1ステップずつ溜め、segmentの長さに達したらSegmentにまとめる
+
+        隣のsegmentの先頭の系列が必要とする分(seq_len - stride ステップ)は
+        次のsegmentにも残す
+    """
+
+    def __init__(self, gamma, nstep, burn_in, unroll_length, stride,
+                 seqs_per_segment, eta=0.9):
+
+        self.gamma = gamma
+
+        self.nstep = nstep
+
+        self.burn_in = burn_in
+
+        self.unroll_length = unroll_length
+
+        self.stride = stride
+
+        self.seqs_per_segment = seqs_per_segment
+
+        self.eta = eta
+
+        #: burn-in + 学習に使うステップ + bootstrap用のnステップ
+        self.seq_len = burn_in + unroll_length + nstep
+
+        self.segment_len = (seqs_per_segment - 1) * stride + self.seq_len
+
+        self.steps = collections.deque()
+
+    def __len__(self):
+
+        return len(self.steps)
+
+    @property
+    def ready(self):
+
+        return len(self.steps) >= self.segment_len
+
+    def push(self, frame, action, reward, done, reset, qvalues, lstm_state):
+        """
+        Args:
+            frame: 行動を選んだときの観測
+            reset: このステップがエピソードの最初なら True
+            qvalues: actorが計算したQ値. 初期優先度に使う
+            lstm_state: このステップの入力になったLSTM状態(h, c)
+        """
+
+        self.steps.append(
+            (frame, action, reward, done, reset, qvalues, np.stack(lstm_state)))
+
+    def pull(self):
+
+        assert self.ready
+
+        steps = [self.steps[i] for i in range(self.segment_len)]
+
+        for _ in range(self.seqs_per_segment * self.stride):
+            self.steps.popleft()
+
+        frames, actions, rewards, dones, resets, qvalues, lstm_states = (
+            np.array(x) for x in zip(*steps))
+
+        returns, discounts = self.nstep_returns(rewards, dones)
+
+        priorities = self.initial_priorities(
+            actions, returns, discounts, qvalues)
+
+        frame_blocks = [
+            zlib.compress(pickle.dumps(frames[i:i+self.stride]))
+            for i in range(0, self.segment_len, self.stride)]
+
+        starts = np.arange(self.seqs_per_segment) * self.stride
+
+        return Segment(frame_blocks=frame_blocks,
+                       actions=actions.astype(np.int32),
+                       returns=returns.astype(np.float32),
+                       discounts=discounts.astype(np.float32),
+                       resets=resets.astype(np.float32),
+                       lstm_states=lstm_states[starts, :, 0, :],
+                       priorities=priorities)
+
+    def nstep_returns(self, rewards, dones):
+
+        T = len(rewards)
+
+        returns = np.zeros(T)
+        discounts = np.zeros(T)
+
+        #: 末尾のnステップは学習に使わないので0のまま
+        for t in range(T - self.nstep):
+            nstep_return, discount = 0., self.gamma ** self.nstep
+            for i in range(self.nstep):
+                nstep_return += self.gamma ** i * rewards[t+i]
+                if dones[t+i]:
+                    discount = 0.
+                    break
+            returns[t], discounts[t] = nstep_return, discount
+
+        return returns, discounts
+
+    def initial_priorities(self, actions, returns, discounts, qvalues):
+        """ actorのQ値からのTD誤差で系列ごとの優先度を計算する
+            p = η max|δ| + (1 - η) mean|δ|
+        """
+        T = len(actions)
+
+        #: bootstrapするQ値はnステップ先
+        next_qvalues = np.zeros(T)
+        next_qvalues[:T - self.nstep] = qvalues[self.nstep:].max(axis=1)
+
+        target_q = util.value_rescaling(
+            returns + discounts * util.inverse_value_rescaling(next_qvalues))
+        q = qvalues[np.arange(T), actions]
+
+        td_errors = np.abs(np.asarray(target_q) - q)
+
+        priorities = []
+        for j in range(self.seqs_per_segment):
+            start = j * self.stride + self.burn_in
+            errors = td_errors[start:start + self.unroll_length]
+            priorities.append(
+                self.eta * errors.max() + (1 - self.eta) * errors.mean())
+
+        return np.array(priorities, dtype=np.float32)
+
+
+class SegmentReplayBuffer:
+    """ 系列単位のprioritized replay
+
+        優先度は系列ごとに持ち、データはsegmentごとに持つ.
+        系列のインデックス idx は segments[idx // seqs_per_segment] の
+        (idx % seqs_per_segment)番目の系列
+    """
+
+    def __init__(self, capacity, seqs_per_segment, stride, seq_len,
+                 alpha, beta):
+
+        assert capacity & (capacity - 1) == 0
+        assert capacity % seqs_per_segment == 0
+
+        self.capacity = capacity
+
+        self.seqs_per_segment = seqs_per_segment
+
+        self.stride = stride
+
+        self.seq_len = seq_len
+
+        self.segments = [None] * (capacity // seqs_per_segment)
+
+        self.sumtree = util.SumTree(capacity=capacity)
+
+        self.alpha = alpha
+
+        self.beta = beta
+
+        self.epsilon = 0.001
+
+        self.next_idx = 0
+
+        self.full = False
+
+    def __len__(self):
+
+        n_segments = len(self.segments) if self.full else self.next_idx
+
+        return n_segments * self.seqs_per_segment
+
+    def push(self, segment):
+
+        assert len(segment.priorities) == self.seqs_per_segment
+
+        offset = self.next_idx * self.seqs_per_segment
+        for j, priority in enumerate(segment.priorities):
+            self.sumtree[offset + j] = (priority + self.epsilon) ** self.alpha
+
+        self.segments[self.next_idx] = segment
+
+        self.next_idx += 1
+        if self.next_idx == len(self.segments):
+            self.full = True
+            self.next_idx = 0
+
+    def get_sequence(self, idx):
+        """
+        Returns:
+            tuple(frame_blocks, actions, returns, discounts, resets, lstm_state).
+                frame_blocksは系列が含まれるブロック(segmentと共有)で、
+                先頭から seq_len フレームが系列になる
+        """
+        segment = self.segments[idx // self.seqs_per_segment]
+
+        j = idx % self.seqs_per_segment
+        start, end = j * self.stride, j * self.stride + self.seq_len
+
+        frame_blocks = segment.frame_blocks[j: (end - 1) // self.stride + 1]
+
+        return (frame_blocks,
+                segment.actions[start:end],
+                segment.returns[start:end],
+                segment.discounts[start:end],
+                segment.resets[start:end],
+                segment.lstm_states[j])
+
+    def sample_batch(self, batch_size):
+
+        indices = [self.sumtree.sample() for _ in range(batch_size)]
+
+        total = self.sumtree.sum()
+        weights = []
+        for idx in indices:
+            prob = self.sumtree[idx] / total
+            weight = (prob * len(self))**(-self.beta)
+            weights.append(weight)
+        weights = np.array(weights) / max(weights)
+
+        sequences = [self.get_sequence(idx) for idx in indices]
+
+        return indices, weights, sequences
+
+    def update_priorities(self, indices, priorities):
+        """ Update priorities of sampled sequences.
+        """
+        assert len(indices) == len(priorities)
+
+        for idx, priority in zip(indices, priorities):
+            self.sumtree[idx] = (priority + self.epsilon) ** self.alpha
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,129 @@
+import random
+
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras.layers as kl
+
+
+class RecurrentDuelingQNetwork(tf.keras.Model):
+    """ Conv -> LSTM -> Dueling head
+
+        入力は時系列 x: (batch, T, 84, 84) と LSTMの初期状態(h, c).
+        resets[:, t] == 1 のステップ(エピソード開始)ではLSTMの状態を0に戻すので、
+        エピソード境界をまたぐ系列もそのまま一回でunrollできる
+    """
+
+    def __init__(self, action_space, lstm_units=512):
+
+        super(RecurrentDuelingQNetwork, self).__init__()
+
+        self.action_space = action_space
+
+        self.lstm_units = lstm_units
+
+        self.conv1 = kl.Conv2D(32, 8, strides=4, activation="relu",
+                               kernel_initializer="he_normal")
+        self.conv2 = kl.Conv2D(64, 4, strides=2, activation="relu",
+                               kernel_initializer="he_normal")
+        self.conv3 = kl.Conv2D(64, 3, strides=1, activation="relu",
+                               kernel_initializer="he_normal")
+        self.flatten1 = kl.Flatten()
+
+        self.lstm = kl.LSTMCell(lstm_units)
+
+        self.dense1 = kl.Dense(512, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.value = kl.Dense(1, kernel_initializer="he_normal")
+
+        self.dense2 = kl.Dense(512, activation="relu",
+                               kernel_initializer="he_normal")
+
+        self.advantages = kl.Dense(self.action_space,
+                                   kernel_initializer="he_normal")
+
+    def call(self, x, states, resets):
+        """
+        Args:
+            x: uint8. shape==(batch, T, 84, 84)
+            states: tuple(h, c). shape==(batch, lstm_units)
+            resets: shape==(batch, T)
+
+        Returns:
+            qvalues: shape==(batch, T, action_space)
+            states: 最後のステップのあとの(h, c)
+        """
+        batch_size, seq_len = tf.shape(x)[0], tf.shape(x)[1]
+
+        #: 時間方向をbatchにまとめてconvを一回で通す
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+        x = tf.reshape(x, (batch_size * seq_len, 84, 84, 1))
+
+        x = self.conv1(x)
+        x = self.conv2(x)
+        x = self.conv3(x)
+        x = self.flatten1(x)
+        x = tf.reshape(x, (batch_size, seq_len, x.shape[-1]))
+
+        resets = tf.cast(resets, tf.float32)
+
+        h, c = states
+        outputs = tf.TensorArray(tf.float32, size=seq_len)
+        for t in tf.range(seq_len):
+            mask = 1. - resets[:, t:t+1]
+            out, (h, c) = self.lstm(x[:, t], [h * mask, c * mask])
+            outputs = outputs.write(t, out)
+
+        #: (T, batch, units) -> (batch, T, units)
+        x = tf.transpose(outputs.stack(), [1, 0, 2])
+
+        value = self.value(self.dense1(x))
+        advantages = self.advantages(self.dense2(x))
+
+        advantages_scaled = advantages - tf.reduce_mean(
+            advantages, axis=-1, keepdims=True)
+        qvalues = value + advantages_scaled
+
+        return qvalues, (h, c)
+
+    def initial_state(self, batch_size):
+
+        return (np.zeros((batch_size, self.lstm_units), dtype=np.float32),
+                np.zeros((batch_size, self.lstm_units), dtype=np.float32))
+
+    def sample_action(self, frame, states, epsilon):
+        """ 1ステップ分の行動選択
+
+        Args:
+            frame: shape==(84, 84)
+
+        Returns:
+            action, qvalues(shape==(action_space,)), 次のLSTM状態
+        """
+        x = frame[np.newaxis, np.newaxis, ...]
+        resets = np.zeros((1, 1), dtype=np.float32)
+
+        qvalues, next_states = self(x, states, resets)
+        qvalues = qvalues.numpy()[0, 0]
+
+        if random.random() > epsilon:
+            action = int(np.argmax(qvalues))
+        else:
+            action = np.random.choice(self.action_space)
+
+        return action, qvalues, next_states
+
+    def sample_actions(self, frames, states):
+        """ envごとの1ステップ分をバッチで
+
+        Args:
+            frames: shape==(batch, 84, 84)
+        """
+        x = frames[:, np.newaxis, ...]
+        resets = np.zeros((len(frames), 1), dtype=np.float32)
+
+        qvalues, next_states = self(x, states, resets)
+        selected_actions = tf.cast(tf.argmax(qvalues[:, 0], axis=1), tf.int32)
+
+        return selected_actions, qvalues[:, 0], next_states
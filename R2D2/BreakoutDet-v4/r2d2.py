@@ -0,0 +1,347 @@
+import time
+import pickle
+import zlib
+import shutil
+from pathlib import Path
+from concurrent import futures
+
+import ray
+import tensorflow as tf
+import gym
+import numpy as np
+
+from model import RecurrentDuelingQNetwork
+from buffer import SegmentReplayBuffer
+from remote_actor import Actor, RemoteTestActor
+from util import preprocess_frame, value_rescaling, inverse_value_rescaling
+from profiler import Profiler
+
+
+@ray.remote(num_cpus=1, num_gpus=1)
+class Learner:
+
+    def __init__(self, env_name, gamma, nstep, burn_in, unroll_length,
+                 target_update_period, eta=0.9):
+
+        self.env_name = env_name
+
+        self.gamma = gamma
+
+        self.nstep = nstep
+
+        self.burn_in = burn_in
+
+        self.unroll_length = unroll_length
+
+        self.eta = eta
+
+        self.action_space = gym.make(env_name).action_space.n
+
+        self.qnet = RecurrentDuelingQNetwork(action_space=self.action_space)
+
+        self.target_qnet = RecurrentDuelingQNetwork(action_space=self.action_space)
+
+        self.target_update_period = target_update_period
+
+        self.optimizer = tf.keras.optimizers.Adam(lr=0.0001, epsilon=1e-3)
+
+        self.update_count = 0
+
+    def define_network(self):
+
+        env = gym.make(self.env_name)
+        frame = preprocess_frame(env.reset())
+
+        #: define by run
+        self.qnet.sample_action(frame, self.qnet.initial_state(1), epsilon=0.)
+        self.target_qnet.sample_action(frame, self.target_qnet.initial_state(1), epsilon=0.)
+        self.target_qnet.set_weights(self.qnet.get_weights())
+
+        return self.qnet.get_weights()
+
+    def save(self, save_path):
+        self.qnet.save_weights(save_path)
+
+    def update_qnetwork(self, compressed_minibatchs):
+
+        indices_all, priorities_all = [], []
+        loss_list = []
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            """ フレームのブロックをdecompressして系列に組み立てる作業が重いのでthreading
+            """
+            work_in_progresses = [
+                executor.submit(self.prepare_minibatch, compressed)
+                for compressed in compressed_minibatchs]
+
+            for ready_batch in futures.as_completed(work_in_progresses):
+
+                indices, per_weights, minibatch = ready_batch.result()
+
+                loss, priorities = self.train_on_batch(per_weights, *minibatch)
+
+                indices_all += indices
+                priorities_all += priorities.numpy().tolist()
+                loss_list.append(loss.numpy())
+                self.update_count += 1
+
+                if self.update_count % self.target_update_period == 0:
+                    print("== target_update ==")
+                    self.target_qnet.set_weights(self.qnet.get_weights())
+
+        loss_mean = np.array(loss_list).mean()
+        current_weights = self.qnet.get_weights()
+        return current_weights, indices_all, priorities_all, loss_mean
+
+    @tf.function
+    def train_on_batch(self, per_weights, frames, actions, returns,
+                       discounts, resets, h, c):
+        """ バッチ化した系列をburn-inからまとめてunrollして1回更新する
+
+        Args:
+            frames: shape==(batch, seq_len, 84, 84)
+            actions, returns, discounts, resets: shape==(batch, seq_len)
+            h, c: 系列の開始時点で保存したLSTM状態
+
+        Returns:
+            loss, 系列ごとの優先度 η max|δ| + (1 - η) mean|δ|
+        """
+        burn_in, unroll = self.burn_in, self.unroll_length
+
+        #: burn-in: 保存した状態から始めてLSTMの状態だけを温める(勾配なし)
+        _, states = self.qnet(
+            frames[:, :burn_in], (h, c), resets[:, :burn_in])
+        states = [tf.stop_gradient(s) for s in states]
+
+        #: targetはburn-inも含めて系列全体をunrollする
+        target_qvalues, _ = self.target_qnet(frames, (h, c), resets)
+        target_qvalues = target_qvalues[:, burn_in:]
+
+        with tf.GradientTape() as tape:
+
+            #: qvalues[:, t] は系列の burn_in + t ステップ目
+            qvalues, _ = self.qnet(
+                frames[:, burn_in:], states, resets[:, burn_in:])
+
+            actions_onehot = tf.one_hot(
+                actions[:, burn_in:burn_in + unroll], self.action_space)
+            q = tf.reduce_sum(
+                qvalues[:, :unroll] * actions_onehot, axis=2)
+
+            #: Double DQN: nステップ先の行動はonline, 価値はtargetで
+            next_actions = tf.argmax(
+                tf.stop_gradient(qvalues[:, self.nstep:]), axis=2)
+            next_actions_onehot = tf.one_hot(next_actions, self.action_space)
+            max_next_qvalues = tf.reduce_sum(
+                target_qvalues[:, self.nstep:] * next_actions_onehot, axis=2)
+
+            target_q = value_rescaling(
+                returns[:, burn_in:burn_in + unroll]
+                + discounts[:, burn_in:burn_in + unroll]
+                * inverse_value_rescaling(max_next_qvalues))
+
+            td_errors = tf.stop_gradient(target_q) - q
+            td_loss = tf.reduce_mean(0.5 * tf.square(td_errors), axis=1)
+            loss = tf.reduce_mean(per_weights * td_loss)
+
+        grads = tape.gradient(loss, self.qnet.trainable_variables)
+        grads, _ = tf.clip_by_global_norm(grads, 40.0)
+        self.optimizer.apply_gradients(
+            zip(grads, self.qnet.trainable_variables))
+
+        abs_td_errors = tf.abs(td_errors)
+        priorities = (self.eta * tf.reduce_max(abs_td_errors, axis=1)
+                      + (1 - self.eta) * tf.reduce_mean(abs_td_errors, axis=1))
+
+        return loss, priorities
+
+    @staticmethod
+    def prepare_minibatch(compressed_minibatch):
+        indices, per_weights, sequences = compressed_minibatch
+
+        per_weights = per_weights.astype(np.float32)
+
+        #: 重なった系列はブロックを共有しているので一度だけdecompressする
+        decompressed = {}
+
+        def load_frames(frame_blocks, seq_len):
+            blocks = []
+            for block in frame_blocks:
+                if id(block) not in decompressed:
+                    decompressed[id(block)] = pickle.loads(zlib.decompress(block))
+                blocks.append(decompressed[id(block)])
+            return np.concatenate(blocks)[:seq_len]
+
+        frame_blocks, actions, returns, discounts, resets, lstm_states = zip(*sequences)
+        seq_len = len(actions[0])
+
+        frames = np.stack([load_frames(blocks, seq_len) for blocks in frame_blocks])
+        actions = np.stack(actions)
+        returns = np.stack(returns)
+        discounts = np.stack(discounts)
+        resets = np.stack(resets)
+        lstm_states = np.stack(lstm_states)
+        h, c = lstm_states[:, 0], lstm_states[:, 1]
+
+        return indices, per_weights, (frames, actions, returns, discounts, resets, h, c)
+
+
+def main(num_actors, env_name="BreakoutDeterministic-v4",
+         gamma=0.997, batch_size=64,
+         epsilon=0.4, eps_alpha=7.,
+         burn_in=40, unroll_length=80, nstep=5, seqs_per_segment=8,
+         target_update_period=2500, num_minibatchs=8,
+         alpha=0.9, beta=0.6, eta=0.9,
+         global_buffer_size=2**16, profile=True, n_eval_episodes=8):
+    """
+    Args:
+        burn_in: 保存したLSTM状態から学習前に温めるステップ数
+        unroll_length: 学習に使うステップ数. 系列は unroll_length // 2 ずつずらして
+            重ねて切り出す(系列長は burn_in + unroll_length + nstep)
+        seqs_per_segment: actorが一度に送る系列の数
+        global_buffer_size: 系列の数
+    """
+
+    ray.init(local_mode=False)
+
+    logdir = Path(__file__).parent / "log"
+    if logdir.exists():
+        shutil.rmtree(logdir)
+    summary_writer = tf.summary.create_file_writer(str(logdir))
+
+    profiler = Profiler(logdir=logdir, summary_writer=summary_writer,
+                        enabled=profile)
+
+    stride = unroll_length // 2
+
+    global_buffer = SegmentReplayBuffer(
+        capacity=global_buffer_size, seqs_per_segment=seqs_per_segment,
+        stride=stride, seq_len=burn_in + unroll_length + nstep,
+        alpha=alpha, beta=beta)
+
+    epsilons = [epsilon ** (1 + eps_alpha * i / (num_actors - 1)) for i in range(num_actors)]
+    epsilons = [max(0.01, eps) for eps in epsilons]
+
+    actors = [Actor.remote(
+        pid=i, env_name=env_name, epsilon=epsilons[i],
+        gamma=gamma, nstep=nstep, burn_in=burn_in,
+        unroll_length=unroll_length, stride=stride,
+        seqs_per_segment=seqs_per_segment, eta=eta,
+        ) for i in range(num_actors)]
+
+    learner = Learner.remote(
+        env_name=env_name, gamma=gamma, nstep=nstep,
+        burn_in=burn_in, unroll_length=unroll_length,
+        target_update_period=target_update_period, eta=eta)
+
+    current_weights = ray.put(ray.get(learner.define_network.remote()))
+
+    test_actor = RemoteTestActor.remote(env_name=env_name)
+
+    work_in_progreses = [actor.rollout.remote(current_weights) for actor in actors]
+
+    learner_count = 0
+    MIN_SEQUENCES = 5000
+    while len(global_buffer) < MIN_SEQUENCES:
+        finished, work_in_progreses = ray.wait(work_in_progreses, num_returns=1)
+        segment, pid = ray.get(finished[0])
+        global_buffer.push(segment)
+        work_in_progreses.extend([actors[pid].rollout.remote(current_weights)])
+
+    print("Setup finished")
+
+    minibatchs = [global_buffer.sample_batch(batch_size) for _ in range(num_minibatchs)]
+    learner_future = learner.update_qnetwork.remote(minibatchs)
+    learner_count += 1
+
+    next_minibatchs = [global_buffer.sample_batch(batch_size) for _ in range(num_minibatchs)]
+
+    tester_future = test_actor.play_batched.remote(
+        current_weights, n_episodes=n_eval_episodes, epsilon=0.01)
+
+    s = time.time()
+    count = 0
+    while learner_count <= 20000:
+
+        with profiler.span("actor_wait"):
+            actor_finished, work_in_progreses = ray.wait(work_in_progreses, num_returns=1)
+            segment, pid = ray.get(actor_finished[0])
+        profiler.count("sequences", seqs_per_segment)
+
+        with profiler.span("replay_push"):
+            global_buffer.push(segment)
+        work_in_progreses.extend([actors[pid].rollout.remote(current_weights)])
+        count += 1
+
+        learner_finished, _ = ray.wait([learner_future], timeout=0)
+
+        if learner_finished:
+            print("Actor cycle", count)
+            print("Leaner", learner_count)
+            with profiler.span("learner_fetch"):
+                current_weights, indices, priorities, loss_mean = ray.get(learner_finished[0])
+                current_weights = ray.put(current_weights)
+            profiler.count("updates", num_minibatchs)
+            profiler.count("samples", num_minibatchs * batch_size)
+
+            learner_future = learner.update_qnetwork.remote(next_minibatchs)
+
+            with profiler.span("replay_update_priority"):
+                global_buffer.update_priorities(indices, priorities)
+            with profiler.span("replay_sample"):
+                next_minibatchs = [global_buffer.sample_batch(batch_size) for _ in range(num_minibatchs)]
+
+            learner_count += 1
+            count = 0
+            with profiler.span("summary"):
+                with summary_writer.as_default():
+                    tf.summary.scalar("learner_loss", loss_mean, step=learner_count)
+
+            #: 評価が終わっていれば記録して最新の重みで次の評価を始める(待たない)
+            tester_finished, _ = ray.wait([tester_future], timeout=0)
+            if tester_finished:
+                result = ray.get(tester_finished[0])
+                print("TEST:", result["mean"], result["median"], result["iqm"])
+                tester_future = test_actor.play_batched.remote(
+                    current_weights, n_episodes=n_eval_episodes, epsilon=0.01)
+
+                with summary_writer.as_default():
+                    tf.summary.scalar(
+                        "test_steps", np.mean(result["steps"]), step=learner_count)
+                    for key in ("mean", "median", "iqm"):
+                        tf.summary.scalar(
+                            f"test_rewards/{key}", result[key], step=learner_count)
+
+            if learner_count % 10 == 0:
+                elapsed_time = (time.time() - s) / 10
+
+                with summary_writer.as_default():
+                    tf.summary.scalar("buffer_size", len(global_buffer), step=learner_count)
+                    tf.summary.scalar("Elapsed time", elapsed_time, step=learner_count)
+
+                s = time.time()
+
+            if learner_count % 500 == 0:
+                print("Model Saved")
+                learner.save.remote("checkpoints/qnet")
+
+        profiler.step(learner_count)
+
+    profiler.close()
+
+
+def test_play(env_name="BreakoutDeterministic-v4"):
+
+    ray.init()
+    test_actor = RemoteTestActor.remote(env_name=env_name)
+    res = test_actor.play_with_video.remote(
+            checkpoint_path="checkpoints/qnet", monitor_dir="mp4", epsilon=0.01)
+    rewards = ray.get(res)
+    print(rewards)
+
+
+if __name__ == "__main__":
+    start = time.time()
+    main(num_actors=21)
+    print("Finished:", time.time() - start)
+    ray.shutdown()
+    test_play()
@@ -0,0 +1,194 @@
+from pathlib import Path
+import shutil
+
+import ray
+import gym
+import tensorflow as tf
+
+from model import RecurrentDuelingQNetwork
+from buffer import LocalSegmentBuffer
+from util import preprocess_frame
+from evaluator import evaluate, score_stats
+
+
+@ray.remote(num_cpus=1)
+class Actor:
+
+    def __init__(self, pid, env_name, epsilon, gamma, nstep,
+                 burn_in, unroll_length, stride, seqs_per_segment, eta):
+
+        self.pid = pid
+
+        self.env = gym.make(env_name)
+
+        self.epsilon = epsilon
+
+        self.action_space = self.env.action_space.n
+
+        self.local_buffer = LocalSegmentBuffer(
+            gamma=gamma, nstep=nstep, burn_in=burn_in,
+            unroll_length=unroll_length, stride=stride,
+            seqs_per_segment=seqs_per_segment, eta=eta)
+
+        self.local_qnet = RecurrentDuelingQNetwork(action_space=self.action_space)
+
+        self.episode_steps = 0
+
+        self.episode_rewards = 0
+
+        self.lives = 5  #: Breakout only
+
+        self.define_network()
+
+    def define_network(self):
+
+        #: hide GPU from remote actor
+        tf.config.set_visible_devices([], 'GPU')
+
+        self.frame = preprocess_frame(self.env.reset())
+
+        self.lstm_state = self.local_qnet.initial_state(1)
+
+        #: 次のステップがエピソードの最初かどうか
+        self.reset = True
+
+        #: define by run
+        self.local_qnet.sample_action(self.frame, self.lstm_state, epsilon=0.)
+
+    def rollout(self, current_weights):
+        """ segment一つ分のステップを進める. 系列が重なる分は前回から引き継ぐ
+        """
+
+        tf.config.set_visible_devices([], 'GPU')
+
+        self.local_qnet.set_weights(current_weights)
+
+        while not self.local_buffer.ready:
+
+            lstm_state = self.lstm_state
+
+            action, qvalues, self.lstm_state = self.local_qnet.sample_action(
+                self.frame, lstm_state, self.epsilon)
+
+            next_frame, reward, done, info = self.env.step(action)
+
+            self.episode_steps += 1
+
+            self.episode_rewards += reward
+
+            if self.lives != info["ale.lives"]:
+                #: loss of life as episode ends
+                terminal = True
+                self.lives = info["ale.lives"]
+            else:
+                terminal = done
+
+            self.local_buffer.push(
+                self.frame, action, reward, terminal, self.reset,
+                qvalues, lstm_state)
+
+            #: 学習時のunrollと同じく、終端の次のステップでLSTMの状態を0に戻す
+            self.reset = terminal
+            if terminal:
+                self.lstm_state = self.local_qnet.initial_state(1)
+
+            if done:
+                print(self.pid, self.episode_steps, self.episode_rewards, round(self.epsilon, 3))
+                self.episode_steps = 0
+                self.episode_rewards = 0
+                self.lives = 5
+                self.frame = preprocess_frame(self.env.reset())
+            else:
+                self.frame = preprocess_frame(next_frame)
+
+        segment = self.local_buffer.pull()
+
+        return segment, self.pid
+
+
+@ray.remote(num_cpus=1)
+class RemoteTestActor:
+
+    def __init__(self, env_name, epsilon=0.05):
+
+        self.env_name = env_name
+
+        self.env = gym.make(env_name)
+
+        self.action_space = self.env.action_space.n
+
+        self.epsilon = epsilon
+
+        self.qnet = RecurrentDuelingQNetwork(action_space=self.action_space)
+
+        self.n_evaluated = 0
+
+        self.define_network()
+
+    def define_network(self):
+
+        #: hide GPU from remote actor
+        tf.config.set_visible_devices([], 'GPU')
+
+        #: define by run
+        frame = preprocess_frame(self.env.reset())
+        self.qnet.sample_action(frame, self.qnet.initial_state(1), epsilon=0.)
+
+    def play_batched(self, current_weights, n_episodes=8, epsilon=0.01):
+        """ n_episodes個のエピソードをバッチ推論でまとめて評価する
+
+        Returns:
+            dict: スコアの mean, median, iqm など
+        """
+
+        tf.config.set_visible_devices([], 'GPU')
+
+        self.qnet.set_weights(current_weights)
+
+        scores, steps = evaluate(
+            self.qnet, self.env_name, n_episodes=n_episodes, epsilon=epsilon,
+            stall_steps=1000, stall_score=10, seed=self.n_evaluated)
+        self.n_evaluated += n_episodes
+
+        result = score_stats(scores)
+        result.update({"scores": scores, "steps": steps})
+
+        return result
+
+    def play_with_video(self, checkpoint_path, monitor_dir, epsilon=0.01):
+
+        monitor_dir = Path(monitor_dir)
+        if monitor_dir.exists():
+            shutil.rmtree(monitor_dir)
+        monitor_dir.mkdir()
+        env = gym.wrappers.Monitor(
+            gym.make(self.env_name), monitor_dir, force=True,
+            video_callable=(lambda ep: True))
+
+        self.qnet.load_weights(checkpoint_path)
+
+        frame = preprocess_frame(env.reset())
+        lstm_state = self.qnet.initial_state(1)
+        lives = 5
+
+        episode_steps, episode_rewards = 0, 0
+
+        done = False
+        while not done:
+
+            action, _, lstm_state = self.qnet.sample_action(
+                frame, lstm_state, epsilon)
+
+            next_frame, reward, done, info = env.step(action)
+
+            frame = preprocess_frame(next_frame)
+
+            if info["ale.lives"] != lives:
+                lives = info["ale.lives"]
+                lstm_state = self.qnet.initial_state(1)
+
+            episode_steps += 1
+
+            episode_rewards += reward
+
+        return episode_rewards
@@ -6,27 +6,34 @@ import numpy as np
 import pickle
 import zlib
 
+from sampler import UniformSampler
+
 
 def create_replaybuffer(use_priority, use_multistep, max_len, reward_clip,
-                        alpha, beta, total_steps, nstep_return, gamma):
+                        alpha, beta, total_steps, nstep_return, gamma,
+                        target_cache=None):
 
     if use_priority and use_multistep:
         return NstepPrioritizedReplayBuffer(
             max_len=max_len, reward_clip=reward_clip,
             alpha=alpha, beta=beta, total_steps=total_steps,
-            nstep_return=nstep_return, gamma=gamma)
+            nstep_return=nstep_return, gamma=gamma,
+            target_cache=target_cache)
 
     elif use_priority:
         return PrioritizedReplayBuffer(
             max_len=max_len, reward_clip=reward_clip,
-            alpha=alpha, beta=beta, total_steps=total_steps)
+            alpha=alpha, beta=beta, total_steps=total_steps,
+            target_cache=target_cache)
 
     elif use_multistep:
         return NstepReplayBuffer(
             max_len=max_len, reward_clip=reward_clip,
-            nstep_return=nstep_return, gamma=gamma)
+            nstep_return=nstep_return, gamma=gamma,
+            target_cache=target_cache)
     else:
-        return ReplayBuffer(max_len=max_len, reward_clip=reward_clip)
+        return ReplayBuffer(max_len=max_len, reward_clip=reward_clip,
+                            target_cache=target_cache)
 
 
 @dataclass
@@ -45,10 +52,15 @@ class Experience:
 
 class ReplayBuffer:
 
-    def __init__(self, max_len, reward_clip, compress=True):
+    def __init__(self, max_len, reward_clip, compress=True, target_cache=None):
 
         self.max_len = max_len
 
+        #: 上書きしたスロットのtarget出力のメモを無効にする
+        self.target_cache = target_cache
+
+        self.sampler = UniformSampler()
+
         self.buffer = []
 
         self.compress = compress
@@ -75,6 +87,9 @@ class ReplayBuffer:
         if self.count == self.max_len:
             self.count = 0
 
+        if self.target_cache is not None:
+            self.target_cache.invalidate(self.count)
+
         try:
             self.buffer[self.count] = exp
         except IndexError:
@@ -82,12 +97,17 @@ class ReplayBuffer:
 
         self.count += 1
 
-    def get_minibatch(self, batch_size):
+    def push_batch(self, transitions):
+        """ 複数envの遷移をまとめて追加する
+        """
+        for transition in transitions:
+            self.push(transition)
+
+    def get_minibatch(self, batch_size, return_indices=False):
 
         N = len(self.buffer)
 
-        indices = np.random.choice(
-            np.arange(N), replace=False, size=batch_size)
+        indices = self.sampler.sample(N, batch_size)
 
         if self.compress:
             selected_experiences = [
@@ -96,7 +116,7 @@ class ReplayBuffer:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -106,39 +126,48 @@ class ReplayBuffer:
 
         next_states = np.vstack(
             [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            )
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
 
+        if return_indices:
+            return indices, (states, actions, rewards, next_states, dones)
+
         return (states, actions, rewards, next_states, dones)
 
 
 class NstepReplayBuffer(ReplayBuffer):
 
-    def __init__(self, max_len, reward_clip, nstep_return, gamma, compress=True):
+    def __init__(self, max_len, reward_clip, nstep_return, gamma, compress=True,
+                 target_cache=None):
 
-        super().__init__(max_len, reward_clip, compress)
+        super().__init__(max_len, reward_clip, compress, target_cache)
 
         self.nstep_return = nstep_return
 
         self.gamma = gamma
 
-        self.temp_buffer = collections.deque(maxlen=nstep_return)
+        #: n-step遷移はenvごとに組み立てる
+        self.temp_buffers = collections.defaultdict(
+            functools.partial(collections.deque, maxlen=nstep_return))
 
-    def push(self, transition):
+    def push(self, transition, env_id=0):
         """
         Args:
             transition : tuple(state, action, reward, next_state, done)
+            env_id : 遷移を生成したenvの番号
         """
 
-        self.temp_buffer.append(Experience(*transition))
+        temp_buffer = self.temp_buffers[env_id]
 
-        if len(self.temp_buffer) == self.nstep_return:
+        temp_buffer.append(Experience(*transition))
+
+        if len(temp_buffer) == self.nstep_return:
 
             nstep_return = 0
             has_done = False
-            for i, onestep_exp in enumerate(self.temp_buffer):
+            for i, onestep_exp in enumerate(temp_buffer):
                 reward, done = onestep_exp.reward, onestep_exp.done
                 reward = np.clip(reward, -1, 1) if self.reward_clip else reward
                 nstep_return += self.gamma ** i * (1 - done) * reward
@@ -146,17 +175,20 @@ class NstepReplayBuffer(ReplayBuffer):
                     has_done = True
                     break
 
-            nstep_exp = Experience(self.temp_buffer[0].state,
-                                   self.temp_buffer[0].action,
+            nstep_exp = Experience(temp_buffer[0].state,
+                                   temp_buffer[0].action,
                                    nstep_return,
-                                   self.temp_buffer[-1].next_state,
+                                   temp_buffer[-1].next_state,
                                    has_done)
 
             if self.compress:
                 nstep_exp = zlib.compress(pickle.dumps(nstep_exp))
 
             if self.count == self.max_len:
-                self.counter = 0
+                self.count = 0
+
+            if self.target_cache is not None:
+                self.target_cache.invalidate(self.count)
 
             try:
                 self.buffer[self.count] = nstep_exp
@@ -165,14 +197,23 @@ class NstepReplayBuffer(ReplayBuffer):
 
             self.count += 1
 
+    def push_batch(self, transitions):
+        """ 複数envの遷移をまとめて追加する. transitions[i]はi番目のenvの遷移
+        """
+        for env_id, transition in enumerate(transitions):
+            self.push(transition, env_id)
+
 
 class PrioritizedReplayBuffer:
 
     def __init__(self, max_len, reward_clip, alpha=0.6, beta=0.4,
-                 total_steps=2500000, compress=True):
+                 total_steps=2500000, compress=True, target_cache=None):
 
         self.max_len = max_len
 
+        #: 上書きしたスロットのtarget出力のメモを無効にする
+        self.target_cache = target_cache
+
         self.buffer = []
 
         self.priorities = []
@@ -213,6 +254,9 @@ class PrioritizedReplayBuffer:
         if self.count == self.max_len:
             self.count = 0
 
+        if self.target_cache is not None:
+            self.target_cache.invalidate(self.count)
+
         try:
             self.buffer[self.count] = exp
             self.priorities[self.count] = self.max_priority
@@ -222,6 +266,12 @@ class PrioritizedReplayBuffer:
 
         self.count += 1
 
+    def push_batch(self, transitions):
+        """ 複数envの遷移をまとめて追加する
+        """
+        for transition in transitions:
+            self.push(transition)
+
     def get_minibatch(self, batch_size, steps):
 
         N = len(self.buffer)
@@ -245,7 +295,7 @@ class PrioritizedReplayBuffer:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -255,7 +305,7 @@ class PrioritizedReplayBuffer:
 
         next_states = np.vstack(
             [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            )
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
@@ -283,10 +333,13 @@ class NstepPrioritizedReplayBuffer:
 
     def __init__(self, max_len, gamma, reward_clip,
                  nstep_return=3, alpha=0.6, beta=0.4,
-                 total_steps=2500000, compress=True):
+                 total_steps=2500000, compress=True, target_cache=None):
 
         self.max_len = max_len
 
+        #: 上書きしたスロットのtarget出力のメモを無効にする
+        self.target_cache = target_cache
+
         self.gamma = gamma
 
         self.buffer = []
@@ -295,7 +348,9 @@ class NstepPrioritizedReplayBuffer:
 
         self.nstep_return = nstep_return
 
-        self.temp_buffer = collections.deque(maxlen=nstep_return)
+        #: n-step遷移はenvごとに組み立てる
+        self.temp_buffers = collections.defaultdict(
+            functools.partial(collections.deque, maxlen=nstep_return))
 
         self.alpha = alpha
 
@@ -315,21 +370,24 @@ class NstepPrioritizedReplayBuffer:
     def __len__(self):
         return len(self.buffer)
 
-    def push(self, transition):
+    def push(self, transition, env_id=0):
         """
         Args:
             transition : tuple(state, action, reward, next_state, done)
+            env_id : 遷移を生成したenvの番号
         """
 
         assert len(self.buffer) == len(self.priorities)
 
-        self.temp_buffer.append(Experience(*transition))
+        temp_buffer = self.temp_buffers[env_id]
+
+        temp_buffer.append(Experience(*transition))
 
-        if len(self.temp_buffer) == self.nstep_return:
+        if len(temp_buffer) == self.nstep_return:
 
             nstep_return = 0
             has_done = False
-            for i, exp in enumerate(self.temp_buffer):
+            for i, exp in enumerate(temp_buffer):
                 reward, done = exp.reward, exp.done
                 reward = np.clip(reward, -1, 1) if self.reward_clip else reward
                 nstep_return += self.gamma ** i * (1 - done) * reward
@@ -337,10 +395,10 @@ class NstepPrioritizedReplayBuffer:
                     has_done = True
                     break
 
-            nstep_exp = Experience(self.temp_buffer[0].state,
-                                   self.temp_buffer[0].action,
+            nstep_exp = Experience(temp_buffer[0].state,
+                                   temp_buffer[0].action,
                                    nstep_return,
-                                   self.temp_buffer[-1].next_state,
+                                   temp_buffer[-1].next_state,
                                    has_done)
 
             if self.compress:
@@ -349,6 +407,9 @@ class NstepPrioritizedReplayBuffer:
             if self.counter == self.max_len:
                 self.counter = 0
 
+            if self.target_cache is not None:
+                self.target_cache.invalidate(self.counter)
+
             try:
                 self.buffer[self.counter] = nstep_exp
                 self.priorities[self.counter] = self.max_priority
@@ -358,6 +419,12 @@ class NstepPrioritizedReplayBuffer:
 
             self.counter += 1
 
+    def push_batch(self, transitions):
+        """ 複数envの遷移をまとめて追加する. transitions[i]はi番目のenvの遷移
+        """
+        for env_id, transition in enumerate(transitions):
+            self.push(transition, env_id)
+
     def get_minibatch(self, batch_size, steps):
 
         beta = self.beta_scheduler(steps)
@@ -379,7 +446,7 @@ class NstepPrioritizedReplayBuffer:
             selected_experiences = [self.buffer[idx] for idx in indices]
 
         states = np.vstack(
-            [exp.state for exp in selected_experiences]).astype(np.float32)
+            [exp.state for exp in selected_experiences])
 
         actions = np.vstack(
             [exp.action for exp in selected_experiences]).astype(np.float32)
@@ -389,7 +456,7 @@ class NstepPrioritizedReplayBuffer:
 
         next_states = np.vstack(
             [exp.next_state for exp in selected_experiences]
-            ).astype(np.float32)
+            )
 
         dones = np.array(
             [exp.done for exp in selected_experiences]).reshape(-1, 1)
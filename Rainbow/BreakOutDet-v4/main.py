@@ -1,6 +1,7 @@
 import collections
 import shutil
 from pathlib import Path
+import functools
 
 import gym
 import numpy as np
@@ -10,6 +11,13 @@ from tensorflow.keras.optimizers import Adam
 import util
 from buffers import create_replaybuffer
 from models import create_network
+from profiler import Profiler
+from metrics import MetricsLogger
+from evaluator import EvalService
+from target_cache import TargetCache
+from mixed_precision import (
+    enable_mixed_precision, wrap_optimizer, scale_loss, unscale_gradients)
+from vecenv import SubProcVecEnv, epsilon_greedy
 
 
 class RainbowAgent:
@@ -25,7 +33,12 @@ class RainbowAgent:
                  buffer_size=1000000,
                  Vmin=-10, Vmax=10, n_atoms=51,
                  use_noisy=False, use_priority=False, use_dueling=False,
-                 use_multistep=False, use_categorical=False):
+                 use_multistep=False, use_categorical=False,
+                 mixed_precision=False, use_target_cache=False):
+
+        if use_target_cache and use_noisy:
+            #: NoisyNetのtargetは更新ごとにノイズが変わるので出力をメモできない
+            raise ValueError("use_target_cache requires a deterministic target network")
 
         self.use_noisy = use_noisy
 
@@ -68,6 +81,14 @@ class RainbowAgent:
 
         self.action_space = env.action_space.n
 
+        if mixed_precision:
+            enable_mixed_precision()
+
+        #: 評価プロセスでも同じネットワークを作れるようにしておく
+        self.network_fn = functools.partial(
+            create_network, self.action_space, use_dueling, use_categorical,
+            use_noisy, Vmin=self.Vmin, Vmax=self.Vmax, n_atoms=self.n_atoms)
+
         self.qnet = create_network(
             self.action_space, use_dueling, use_categorical, use_noisy,
             Vmin=self.Vmin, Vmax=self.Vmax, n_atoms=self.n_atoms)
@@ -76,7 +97,11 @@ class RainbowAgent:
             self.action_space, use_dueling, use_categorical, use_noisy,
             Vmin=self.Vmin, Vmax=self.Vmax, n_atoms=self.n_atoms)
 
-        self.optimizer = Adam(lr=lr, epsilon=0.01 / self.batch_size)
+        self.optimizer = wrap_optimizer(
+            Adam(lr=lr, epsilon=0.01 / self.batch_size))
+
+        #: target networkの出力をreplayのスロットごとにメモする
+        self.target_cache = TargetCache(buffer_size) if use_target_cache else None
 
         self.replay_buffer = create_replaybuffer(
                 use_priority=self.use_priority,
@@ -84,10 +109,13 @@ class RainbowAgent:
                 max_len=buffer_size,
                 nstep_return=self.nstep_return, gamma=self.gamma,
                 alpha=alpha, beta=beta, total_steps=total_steps,
-                reward_clip=reward_clip)
+                reward_clip=reward_clip, target_cache=self.target_cache)
 
         self.steps = 0
 
+        #: learn()で置き換えられる. それ以外(learn_vectorizedなど)では計測しない
+        self.profiler = Profiler(enabled=False)
+
     @property
     def epsilon(self):
         if self.use_noisy:
@@ -95,13 +123,22 @@ class RainbowAgent:
         else:
             return max(1.0 - 0.9 * self.steps / 1000000, 0.1)
 
-    def learn(self, n_episodes, logdir="log"):
+    def learn(self, n_episodes, logdir="log", profile=True, n_eval_episodes=8):
 
         logdir = Path(__file__).parent / logdir
         if logdir.exists():
             shutil.rmtree(logdir)
         self.summary_writer = tf.summary.create_file_writer(str(logdir))
 
+        self.profiler = profiler = Profiler(
+            logdir=logdir, summary_writer=self.summary_writer, enabled=profile)
+
+        metrics = MetricsLogger(self.summary_writer)
+
+        evaluator = EvalService(
+            self.network_fn, self.env_name, n_episodes=n_eval_episodes,
+            n_frames=self.n_frames, epsilon=0 if self.use_noisy else 0.05)
+
         for episode in range(1, n_episodes+1):
             env = gym.make(self.env_name)
 
@@ -119,15 +156,21 @@ class RainbowAgent:
 
                 state = np.stack(frames, axis=2)[np.newaxis, ...]
 
-                action = self.qnet.sample_action(state, self.epsilon)
+                if self.steps % self.update_period == 0:
+                    self.reset_noise()
 
-                next_frame, reward, done, info = env.step(action)
+                with profiler.span("inference"):
+                    action = self.qnet.sample_action(state, self.epsilon)
 
-                episode_rewards += reward
+                with profiler.span("env_step"):
+                    next_frame, reward, done, info = env.step(action)
+                profiler.count("env_steps")
 
-                frames.append(util.preprocess_frame(next_frame))
+                episode_rewards += reward
 
-                next_state = np.stack(frames, axis=2)[np.newaxis, ...]
+                with profiler.span("preprocess"):
+                    frames.append(util.preprocess_frame(next_frame))
+                    next_state = np.stack(frames, axis=2)[np.newaxis, ...]
 
                 if info["ale.lives"] != lives:
                     lives = info["ale.lives"]
@@ -135,56 +178,188 @@ class RainbowAgent:
                 else:
                     transition = (state, action, reward, next_state, done)
 
-                self.replay_buffer.push(transition)
+                with profiler.span("replay_push"):
+                    self.replay_buffer.push(transition)
 
                 if len(self.replay_buffer) >= 50000:
                     if self.steps % self.update_period == 0:
 
-                        if self.use_categorical:
-                            loss = self.update_categorical_network()
-                        else:
-                            loss = self.update_network()
-
-                        with self.summary_writer.as_default():
-                            tf.summary.scalar(
-                                "loss", loss, step=self.steps)
-                            tf.summary.scalar(
-                                "buffer_size", len(self.replay_buffer), step=self.steps)
-                            tf.summary.scalar(
-                                "epsilon", self.epsilon, step=self.steps)
-                            tf.summary.scalar(
-                                "train_score", episode_rewards, step=self.steps)
-                            tf.summary.scalar(
-                                "train_steps", episode_steps, step=self.steps)
+                        with profiler.span("train_step"):
+                            if self.use_categorical:
+                                loss = self.update_categorical_network()
+                            else:
+                                loss = self.update_network()
+                        profiler.count("updates")
+                        profiler.count("samples", self.batch_size)
+
+                        with profiler.span("summary"):
+                            metrics.scalar("loss", loss, self.steps)
+                            metrics.scalar(
+                                "buffer_size", len(self.replay_buffer), self.steps)
+                            metrics.scalar("epsilon", self.epsilon, self.steps)
+                            metrics.scalar("train_score", episode_rewards, self.steps)
+                            metrics.scalar("train_steps", episode_steps, self.steps)
+                            if self.target_cache is not None:
+                                metrics.scalar("target_cache_hit_rate",
+                                               self.target_cache.stats()["hit_rate"], self.steps)
 
                     if self.steps % self.target_update_period == 0:
-                        self.target_qnet.set_weights(self.qnet.get_weights())
+                        with profiler.span("target_sync"):
+                            self.sync_target_network()
+
+                profiler.step(self.steps)
 
             print(f"Episode: {episode}, score: {episode_rewards}, steps: {episode_steps}")
             if episode % 20 == 0:
-                test_scores, test_steps = self.test_play(n_testplay=1)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar("test_score", test_scores[0], step=self.steps)
-                    tf.summary.scalar("test_step", test_steps[0], step=self.steps)
-                    for layer in self.qnet.layers[-3:]:
-                        for var in layer.variables:
-                            tf.summary.histogram(var.name, var, step=self.steps)
+                evaluator.submit(self.steps, self.qnet.get_weights())
+                for layer in self.qnet.layers[-3:]:
+                    for var in layer.variables:
+                        metrics.histogram(var.name, var, self.steps)
+
+            for result in evaluator.poll():
+                self.log_evaluation(metrics, result)
 
             if episode % 500 == 0:
                 self.qnet.save_weights("checkpoints/qnet")
 
+        for result in evaluator.close(wait=True):
+            self.log_evaluation(metrics, result)
+
+        metrics.close()
+
+        profiler.close()
+
+    @staticmethod
+    def log_evaluation(metrics, result):
+
+        step = result["step"]
+        for key in ("mean", "median", "iqm"):
+            metrics.scalar(f"test_score/{key}", result[key], step)
+        metrics.scalar("test_step", np.mean(result["steps"]), step)
+
+    def learn_vectorized(self, total_steps, n_envs=8, epsilon_alpha=0.,
+                         logdir="log"):
+        """ n_envs個のenvを同時に進め、行動選択は一回のバッチ推論で行う
+
+        Args:
+            epsilon_alpha (float): env iのε = ε(steps) ** (1 + α * i / (n_envs-1)).
+                0ならすべてのenvで同じε, Ape-Xでは7
+        """
+
+        logdir = Path(__file__).parent / logdir
+        if logdir.exists():
+            shutil.rmtree(logdir)
+        self.summary_writer = tf.summary.create_file_writer(str(logdir))
+
+        metrics = MetricsLogger(self.summary_writer)
+
+        vecenv = SubProcVecEnv(self.env_name, n_envs, n_frames=self.n_frames)
+
+        states = vecenv.reset()
+
+        epsilon_exponents = 1 + epsilon_alpha * np.arange(n_envs) / max(n_envs - 1, 1)
+
+        episode = 0
+        while self.steps < total_steps:
+
+            epsilons = self.epsilon ** epsilon_exponents
+
+            self.reset_noise()
+            greedy_actions, _ = self.qnet.sample_actions(states)
+            actions = epsilon_greedy(greedy_actions, epsilons, self.action_space)
+
+            results = vecenv.step(actions)
+
+            #: n-step遷移はbuffer側でenvごとに組み立てられる
+            self.replay_buffer.push_batch(
+                [(states[[i]], actions[i], res.reward,
+                  res.next_state[np.newaxis, ...], res.done)
+                 for i, res in enumerate(results)])
+
+            states = np.stack([res.state for res in results])
+
+            prev_steps, self.steps = self.steps, self.steps + n_envs
+
+            for res in results:
+                if not res.episode_done:
+                    continue
+
+                episode += 1
+                print(f"Episode: {episode}, score: {res.episode_rewards}, steps: {res.episode_steps}")
+                metrics.scalar("train_score", res.episode_rewards, self.steps)
+                metrics.scalar("train_steps", res.episode_steps, self.steps)
+
+                if episode % 500 == 0:
+                    self.qnet.save_weights("checkpoints/qnet")
+
+            if len(self.replay_buffer) >= 50000:
+                n_updates = self.steps // self.update_period - prev_steps // self.update_period
+                for _ in range(n_updates):
+                    if self.use_categorical:
+                        loss = self.update_categorical_network()
+                    else:
+                        loss = self.update_network()
+
+                if n_updates:
+                    metrics.scalar("loss", loss, self.steps)
+                    metrics.scalar("buffer_size", len(self.replay_buffer), self.steps)
+                    metrics.scalar("epsilon", self.epsilon, self.steps)
+                    if self.target_cache is not None:
+                        metrics.scalar("target_cache_hit_rate",
+                                       self.target_cache.stats()["hit_rate"], self.steps)
+
+                if self.steps // self.target_update_period != prev_steps // self.target_update_period:
+                    self.sync_target_network()
+
+        vecenv.close()
+
+        metrics.close()
+
+    def reset_noise(self, target=False):
+        """ NoisyNetのノイズを引き直す.
+            次に呼ぶまでの行動選択・1回の更新の中では同じノイズを使う
+        """
+        if not self.use_noisy:
+            return
+
+        self.qnet.reset_noise()
+
+        if target:
+            self.target_qnet.reset_noise()
+
+    def sync_target_network(self):
+
+        self.target_qnet.set_weights(self.qnet.get_weights())
+
+        if self.target_cache is not None:
+            self.target_cache.sync()
+
+    def target_outputs(self, indices, next_states):
+        """ target networkの出力(Q値 or 確率分布). target_cacheがあればメモを使う
+        """
+        compute = lambda x: self.target_qnet.sample_actions(x)[1]
+
+        if self.target_cache is None:
+            return compute(next_states)
+
+        return self.target_cache.get(indices, next_states, compute)
+
     def update_network(self):
 
         #: ミニバッチの作成
-        if self.use_priority:
-            indices, weights, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, self.steps)
-            weights = tf.convert_to_tensor(weights, dtype=tf.float32)
-        else:
-            states, actions, rewards, next_states, dones = self.replay_buffer.get_minibatch(self.batch_size)
+        with self.profiler.span("replay_sample"):
+            if self.use_priority:
+                indices, weights, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, self.steps)
+                weights = tf.convert_to_tensor(weights, dtype=tf.float32)
+            else:
+                indices, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, return_indices=True)
+
+        self.reset_noise(target=True)
 
         #: Double DQN
         next_actions, _ = self.qnet.sample_actions(next_states)
-        _, next_qvalues = self.target_qnet.sample_actions(next_states)
+        with self.profiler.span("target_forward"):
+            next_qvalues = self.target_outputs(indices, next_states)
 
         next_actions_onehot = tf.one_hot(next_actions, self.action_space)
         max_next_qvalues = tf.reduce_sum(
@@ -205,28 +380,35 @@ class RainbowAgent:
                 loss = tf.reduce_mean(weights * td_loss)
             else:
                 loss = tf.reduce_mean(td_loss)
+            scaled_loss = scale_loss(self.optimizer, loss)
 
-        grads = tape.gradient(loss, self.qnet.trainable_variables)
+        grads = tape.gradient(scaled_loss, self.qnet.trainable_variables)
+        grads = unscale_gradients(self.optimizer, grads)
         self.optimizer.apply_gradients(
             zip(grads, self.qnet.trainable_variables))
 
         #: update priority of experiences
         if self.use_priority:
             td_errors = td_loss.numpy().flatten()
-            self.replay_buffer.update_priority(indices, td_errors)
+            with self.profiler.span("replay_update_priority"):
+                self.replay_buffer.update_priority(indices, td_errors)
 
         return loss
 
     def update_categorical_network(self):
         #: ミニバッチの作成
-        if self.use_priority:
-            indices, weights, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, self.steps)
-            weights = tf.convert_to_tensor(weights, dtype=tf.float32)
-        else:
-            states, actions, rewards, next_states, dones = self.replay_buffer.get_minibatch(self.batch_size)
+        with self.profiler.span("replay_sample"):
+            if self.use_priority:
+                indices, weights, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, self.steps)
+                weights = tf.convert_to_tensor(weights, dtype=tf.float32)
+            else:
+                indices, (states, actions, rewards, next_states, dones) = self.replay_buffer.get_minibatch(self.batch_size, return_indices=True)
+
+        self.reset_noise(target=True)
 
         next_actions, _ = self.qnet.sample_actions(next_states)
-        _, next_probs = self.target_qnet.sample_actions(next_states)
+        with self.profiler.span("target_forward"):
+            next_probs = self.target_outputs(indices, next_states)
 
         #: 選択されたactionの確率分布だけ抽出する
         onehot_mask = self.create_mask(next_actions)
@@ -249,15 +431,18 @@ class RainbowAgent:
                 weighted_loss = weights * td_loss
                 loss = tf.reduce_mean(weighted_loss)
             else:
-                loss = tf.reduce_mean(loss)
+                loss = tf.reduce_mean(td_loss)
+            scaled_loss = scale_loss(self.optimizer, loss)
 
-        grads = tape.gradient(loss, self.qnet.trainable_variables)
+        grads = tape.gradient(scaled_loss, self.qnet.trainable_variables)
+        grads = unscale_gradients(self.optimizer, grads)
         self.optimizer.apply_gradients(
             zip(grads, self.qnet.trainable_variables))
 
         if self.use_priority:
             td_loss = td_loss.numpy().flatten()
-            self.replay_buffer.update_priority(indices, td_loss)
+            with self.profiler.span("replay_update_priority"):
+                self.replay_buffer.update_priority(indices, td_loss)
 
         return loss
 
@@ -347,6 +532,10 @@ class RainbowAgent:
         else:
             env = gym.make(self.env_name)
 
+        #: NoisyNetはノイズなし(μのみ)でテストする
+        if self.use_noisy:
+            self.qnet.eval_mode()
+
         scores = []
         steps = []
         for _ in range(n_testplay):
@@ -375,6 +564,9 @@ class RainbowAgent:
             scores.append(episode_rewards)
             steps.append(episode_steps)
 
+        if self.use_noisy:
+            self.qnet.train_mode()
+
         return scores, steps
 
 
@@ -0,0 +1,89 @@
+import threading
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+
+class MetricsLogger:
+    """ TensorBoardへの書き込みをバッファリングするロガー
+
+        scalar()/histogram()は値をリストに積むだけで、
+        device->hostの同期(tensor.numpy())もファイルI/Oも行わない.
+        バックグラウンドスレッドがflush_interval秒ごとに溜まった値を取り出し、
+        スカラーは区間内の mean (タグ名そのまま) と /min, /max を、
+        ヒストグラムは区間内の最後の値だけを、区間内の最後のstepで書き出す.
+
+        tf.Tensorはそのまま積んでよい. tf.Variableは後で値が変わるので
+        histogram()側でtf.identityによるスナップショットを取る
+
+    Args:
+        summary_writer: tf.summary.create_file_writerの戻り値
+        flush_interval (float): 書き出し間隔(秒)
+    """
+
+    def __init__(self, summary_writer, flush_interval=10.):
+
+        self.summary_writer = summary_writer
+
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+
+        self.scalars = collections.defaultdict(list)
+
+        self.histograms = {}
+
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def scalar(self, name, value, step):
+
+        with self.lock:
+            self.scalars[name].append((step, value))
+
+    def histogram(self, name, value, step):
+
+        if isinstance(value, tf.Variable):
+            value = tf.identity(value)
+
+        with self.lock:
+            self.histograms[name] = (step, value)
+
+    def _run(self):
+
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """ 溜まった値を書き出す. 学習ループからは呼ばなくてよい
+        """
+        with self.lock:
+            scalars, self.scalars = self.scalars, collections.defaultdict(list)
+            histograms, self.histograms = self.histograms, {}
+
+        if not scalars and not histograms:
+            return
+
+        with self.summary_writer.as_default():
+
+            for name, records in scalars.items():
+                step = records[-1][0]
+                values = np.array(
+                    [np.asarray(value) for _, value in records], dtype=np.float64)
+                tf.summary.scalar(name, values.mean(), step=step)
+                tf.summary.scalar(f"{name}/min", values.min(), step=step)
+                tf.summary.scalar(f"{name}/max", values.max(), step=step)
+
+            for name, (step, value) in histograms.items():
+                tf.summary.histogram(name, value, step=step)
+
+        self.summary_writer.flush()
+
+    def close(self):
+
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
@@ -0,0 +1,87 @@
+import tensorflow as tf
+
+
+def bfloat16_supported():
+    """ bfloat16演算を高速に実行できるか
+        CPU: avx512_bf16 / amx_bf16, GPU: compute capability 8.0以上
+    """
+    for gpu in tf.config.list_physical_devices("GPU"):
+        details = tf.config.experimental.get_device_details(gpu)
+        if details.get("compute_capability", (0, 0)) >= (8, 0):
+            return True
+
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+
+    return ("avx512_bf16" in flags) or ("amx_bf16" in flags)
+
+
+def enable_mixed_precision(policy="mixed_bfloat16", force=False):
+    """ kerasのglobal policyを設定する. ネットワークの構築前に呼ぶこと
+
+        演算はbfloat16, 重み(master weights)はfloat32のまま.
+        各ネットワークの出力層はdtype="float32"なので、
+        Q値・softmax・log-probはfloat32で出力される
+
+    Args:
+        force (bool): bfloat16非対応のCPUでも有効にする(遅くなる)
+
+    Returns:
+        bool: 有効にしたかどうか
+    """
+    if policy == "mixed_bfloat16" and not (force or bfloat16_supported()):
+        print("bfloat16 is not supported on this device, keep float32")
+        return False
+
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+    return True
+
+
+def disable_mixed_precision():
+
+    tf.keras.mixed_precision.set_global_policy("float32")
+
+
+def is_mixed_precision():
+
+    policy = tf.keras.mixed_precision.global_policy()
+
+    return policy.compute_dtype != policy.variable_dtype
+
+
+def wrap_optimizer(optimizer, loss_scale=None):
+    """ 既存のoptimizerをLossScaleOptimizerで包む
+
+    Args:
+        loss_scale (bool): Noneならfloat16のときだけ包む.
+            bfloat16はfloat32と指数部の幅が同じなのでloss scalingは必須ではない
+    """
+    if loss_scale is None:
+        policy = tf.keras.mixed_precision.global_policy()
+        loss_scale = policy.compute_dtype == "float16"
+
+    if not loss_scale:
+        return optimizer
+
+    return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+
+def scale_loss(optimizer, loss):
+    """ GradientTapeの中で呼ぶこと
+    """
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+
+    return loss
+
+
+def unscale_gradients(optimizer, grads):
+
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(grads)
+
+    return grads
@@ -29,15 +29,20 @@ def create_network(action_space, use_dueling,
 
 class NoisyDense(tf.keras.layers.Layer):
     """ Factorized Gaussian Noisy Dense Layer
+
+        ノイズε_in, ε_outはreset_noise()を呼ぶまで使いまわす.
+        eval_mode()ではノイズを0にしてμのみで計算する
     """
-    def __init__(self, units, activation=None, trainable=True):
-        super(NoisyDense, self).__init__()
+    def __init__(self, units, activation=None, trainable=True, **kwargs):
+        super(NoisyDense, self).__init__(**kwargs)
         self.units = units
         self.trainable = trainable
         self.activation = tf.keras.activations.get(activation)
 
         self.sigma_0 = 0.5
 
+        self.noisy = True
+
     def build(self, input_shape):
 
         p = input_shape[-1]
@@ -67,21 +72,41 @@ class NoisyDense(tf.keras.layers.Layer):
             initializer=tf.keras.initializers.Constant(self.sigma_0 / np.sqrt(p)),
             trainable=self.trainable)
 
-    def call(self, inputs, noise=True):
+        self.epsilon_in = self.add_weight(
+            name="epsilon_in", shape=(int(input_shape[-1]),),
+            initializer="zeros", trainable=False)
+
+        self.epsilon_out = self.add_weight(
+            name="epsilon_out", shape=(self.units,),
+            initializer="zeros", trainable=False)
+
+        self.built = True
+
+        self.reset_noise()
+
+    def reset_noise(self):
 
-        epsilon_in = self.f(
-            tf.random.normal(shape=(self.w_mu.shape[0], 1), dtype=tf.float32))
+        if not self.built:
+            return
 
-        epsilon_out = self.f(
-            tf.random.normal(shape=(1, self.w_mu.shape[1]), dtype=tf.float32))
+        if not self.noisy:
+            self.epsilon_in.assign(tf.zeros_like(self.epsilon_in))
+            self.epsilon_out.assign(tf.zeros_like(self.epsilon_out))
+            return
 
-        w_epsilon = tf.matmul(epsilon_in, epsilon_out)
-        b_epsilon = epsilon_out
+        self.epsilon_in.assign(
+            self.f(tf.random.normal(shape=self.epsilon_in.shape)))
+        self.epsilon_out.assign(
+            self.f(tf.random.normal(shape=self.epsilon_out.shape)))
 
-        w = self.w_mu + self.w_sigma * w_epsilon
-        b = self.b_mu + self.b_sigma * b_epsilon
+    def call(self, inputs):
 
-        out = tf.matmul(inputs, w) + b
+        #: x @ (w_mu + w_sigma * ε_in ε_out^T) を
+        #: x @ w_mu + ((x * ε_in) @ w_sigma) * ε_out で計算し、ノイズ行列を作らない
+        out = tf.matmul(inputs, self.w_mu) + self.b_mu
+
+        noise = tf.matmul(inputs * self.epsilon_in, self.w_sigma)
+        out += (noise + self.b_sigma) * self.epsilon_out
 
         if self.activation is not None:
             out = self.activation(out)
@@ -94,6 +119,30 @@ class NoisyDense(tf.keras.layers.Layer):
         return x
 
 
+class NoisyMixin:
+    """ NoisyDenseを持つネットワーク用
+    """
+
+    def noisy_layers(self):
+        return [layer for layer in self.layers if isinstance(layer, NoisyDense)]
+
+    def reset_noise(self):
+        for layer in self.noisy_layers():
+            layer.reset_noise()
+
+    def eval_mode(self):
+        """ ノイズを0にしてμのみで決定的に行動する
+        """
+        for layer in self.noisy_layers():
+            layer.noisy = False
+            layer.reset_noise()
+
+    def train_mode(self):
+        for layer in self.noisy_layers():
+            layer.noisy = True
+            layer.reset_noise()
+
+
 class SamplingMixin:
 
     def sample_action(self, x, epsilon=0):
@@ -128,12 +177,16 @@ class QNetwork(tf.keras.Model, SamplingMixin):
         self.flatten1 = kl.Flatten()
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
-        self.qvalues = kl.Dense(self.action_space,
+        #: mixed precisionでも出力はfloat32
+        self.qvalues = kl.Dense(self.action_space, dtype="float32",
                                 kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -163,17 +216,21 @@ class DuelingQNetwork(tf.keras.Model, SamplingMixin):
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.value = kl.Dense(1, kernel_initializer="he_normal")
+        self.value = kl.Dense(1, dtype="float32",
+                              kernel_initializer="he_normal")
 
         self.dense2 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.advantages = kl.Dense(self.action_space,
+        self.advantages = kl.Dense(self.action_space, dtype="float32",
                                    kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -191,7 +248,7 @@ class DuelingQNetwork(tf.keras.Model, SamplingMixin):
         return q_values
 
 
-class NoisyQNetwork(tf.keras.Model, SamplingMixin):
+class NoisyQNetwork(tf.keras.Model, SamplingMixin, NoisyMixin):
 
     def __init__(self, actions_space):
 
@@ -207,10 +264,13 @@ class NoisyQNetwork(tf.keras.Model, SamplingMixin):
                                kernel_initializer="he_normal")
         self.flatten1 = kl.Flatten()
         self.dense1 = NoisyDense(512, activation="relu")
-        self.qvalues = NoisyDense(self.action_space)
+        self.qvalues = NoisyDense(self.action_space, dtype="float32")
 
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
@@ -264,12 +324,17 @@ class CategoricalQNetwork(tf.keras.Model, CategoricalSamplingMixin):
         self.flatten1 = kl.Flatten()
         self.dense1 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
+        #: softmaxはfloat32で計算する
         self.logits = kl.Dense(self.action_space * self.n_atoms,
+                               dtype="float32",
                                kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         batch_size = x.shape[0]
 
         x = self.conv1(x)
@@ -317,15 +382,20 @@ class DuelingCategoricalQNetwork(tf.keras.Model, CategoricalSamplingMixin):
         self.dense2 = kl.Dense(512, activation="relu",
                                kernel_initializer="he_normal")
 
-        self.value = kl.Dense(1 * self.n_atoms,
+        #: softmaxはfloat32で計算する
+        self.value = kl.Dense(1 * self.n_atoms, dtype="float32",
                               kernel_initializer="he_normal")
 
         self.advantages = kl.Dense(self.action_space * self.n_atoms,
+                                   dtype="float32",
                                    kernel_initializer="he_normal")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         batch_size = x.shape[0]
 
         x = self.conv1(x)
@@ -352,7 +422,7 @@ class DuelingCategoricalQNetwork(tf.keras.Model, CategoricalSamplingMixin):
         return probs
 
 
-class RainbowQNetwork(tf.keras.Model, CategoricalSamplingMixin):
+class RainbowQNetwork(tf.keras.Model, CategoricalSamplingMixin, NoisyMixin):
 
     def __init__(self, actions_space, Vmin, Vmax, n_atoms):
 
@@ -379,13 +449,18 @@ class RainbowQNetwork(tf.keras.Model, CategoricalSamplingMixin):
 
         self.dense2 = NoisyDense(512, activation="relu")
 
-        self.value = NoisyDense(1 * self.n_atoms)
+        #: softmaxはfloat32で計算する
+        self.value = NoisyDense(1 * self.n_atoms, dtype="float32")
 
-        self.advantages = NoisyDense(self.action_space * self.n_atoms)
+        self.advantages = NoisyDense(
+            self.action_space * self.n_atoms, dtype="float32")
 
     @tf.function
     def call(self, x):
 
+        #: uint8のフレームを[0, 1]に
+        x = tf.cast(x, tf.float32) / 255.
+
         batch_size = x.shape[0]
 
         x = self.conv1(x)
@@ -2,6 +2,8 @@ from dataclasses import dataclass
 
 import numpy as np
 
+from sampler import UniformSampler
+
 
 @dataclass
 class Experience:
@@ -23,6 +25,8 @@ class ReplayBuffer:
 
         self.max_len = max_len
 
+        self.sampler = UniformSampler()
+
         self.buffer = []
 
         self.count = 0
@@ -46,8 +50,7 @@ class ReplayBuffer:
 
         N = len(self.buffer)
 
-        indices = np.random.choice(
-            np.arange(N), replace=False, size=batch_size)
+        indices = self.sampler.sample(N, batch_size)
 
         selected_experiences = [self.buffer[idx] for idx in indices]
 
@@ -8,6 +8,7 @@ from gym import wrappers
 
 from models import GaussianPolicy, DualQNetwork
 from buffer import ReplayBuffer, Experience
+from profiler import Profiler
 
 
 class SAC:
@@ -51,6 +52,9 @@ class SAC:
 
         self.global_steps = 0
 
+        #: main()でlogdir付きのものに置き換える
+        self.profiler = Profiler(enabled=False)
+
         self._initialize_weights()
 
     def _initialize_weights(self):
@@ -83,15 +87,19 @@ class SAC:
 
         while not done:
 
-            action, _ = self.policy.sample_action(np.atleast_2d(state))
+            with self.profiler.span("inference"):
+                action, _ = self.policy.sample_action(np.atleast_2d(state))
 
-            action = action.numpy()[0]
+                action = action.numpy()[0]
 
-            next_state, reward, done, _ = self.env.step(action)
+            with self.profiler.span("env_step"):
+                next_state, reward, done, _ = self.env.step(action)
+            self.profiler.count("env_steps")
 
             exp = Experience(state, action, reward, next_state, done)
 
-            self.replay_buffer.push(exp)
+            with self.profiler.span("replay_push"):
+                self.replay_buffer.push(exp)
 
             state = next_state
 
@@ -104,14 +112,20 @@ class SAC:
             if (len(self.replay_buffer) >= self.MIN_EXPERIENCES
                and self.global_steps % self.UPDATE_PERIOD == 0):
 
-                self.update_networks()
+                with self.profiler.span("train_step"):
+                    self.update_networks()
+                self.profiler.count("updates")
+                self.profiler.count("samples", self.BATCH_SIZE)
+
+            self.profiler.step(self.global_steps)
 
         return episode_reward, local_steps, tf.exp(self.log_alpha)
 
     def update_networks(self):
 
-        (states, actions, rewards,
-         next_states, dones) = self.replay_buffer.get_minibatch(self.BATCH_SIZE)
+        with self.profiler.span("replay_sample"):
+            (states, actions, rewards,
+             next_states, dones) = self.replay_buffer.get_minibatch(self.BATCH_SIZE)
 
         alpha = tf.math.exp(self.log_alpha)
 
@@ -227,6 +241,8 @@ def main(n_episodes, n_testplay=1, logging_steps=5):
 
     agent = SAC(env_id="Pendulum-v0", action_space=1, action_bound=2)
 
+    agent.profiler = Profiler(logdir=LOGDIR, summary_writer=summary_writer)
+
     episode_rewards = []
 
     for n in range(n_episodes):
@@ -235,7 +251,7 @@ def main(n_episodes, n_testplay=1, logging_steps=5):
 
         episode_rewards.append(episode_reward)
 
-        with summary_writer.as_default():
+        with agent.profiler.span("summary"), summary_writer.as_default():
             tf.summary.scalar("episode_reward", episode_reward, step=n)
             tf.summary.scalar("episode_steps", episode_steps, step=n)
             tf.summary.scalar("alpha", alpha, step=n)
@@ -243,6 +259,8 @@ def main(n_episodes, n_testplay=1, logging_steps=5):
         if n % logging_steps == 0:
             print(f"Episode {n}: {episode_reward}, {episode_steps} steps")
 
+    agent.profiler.close()
+
     agent.save_model()
 
     if n_testplay:
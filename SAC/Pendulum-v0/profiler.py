@@ -0,0 +1,156 @@
+import csv
+import time
+import collections
+import contextlib
+from pathlib import Path
+
+import numpy as np
+import tensorflow as tf
+
+
+class Profiler:
+    """ 学習ループの区間ごとの所要時間とスループットを集計する
+
+        with profiler.span("env_step"):
+            next_frame, reward, done, info = env.step(action)
+        profiler.count("env_steps")
+        profiler.step(steps)
+
+        span()は区間の所要時間をサンプルとして溜め、count()は件数を加算する.
+        spanは入れ子にしてよい(train_step内のreplay_sampleなど)が、
+        shareは区間ごとに独立に計算されるので合計は1を超えうる.
+        step()がexport_interval秒ごとにexport()を呼び、
+        区間ごとのレイテンシ(平均/p50/p90/p99, 経過時間に占める割合)と
+        カウンタごとのスループット(件数/秒)を
+        TensorBoard(profile/以下)とCSV(long format)に書き出す
+
+    Args:
+        logdir (str or Path): profile.csvの出力先. NoneならCSVを書かない
+        summary_writer: tf.summaryのwriter. NoneならTensorBoardに書かない
+        export_interval (float): export間隔(秒)
+        max_samples (int): 区間ごとに保持するサンプル数の上限
+        enabled (bool): Falseならspan/countは何もしない
+    """
+
+    CSV_FIELDS = ["step", "wall_time", "metric", "value"]
+
+    def __init__(self, logdir=None, summary_writer=None,
+                 export_interval=30., max_samples=10000, enabled=True):
+
+        self.summary_writer = summary_writer
+
+        self.export_interval = export_interval
+
+        self.enabled = enabled
+
+        self.samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=max_samples))
+
+        self.totals = collections.defaultdict(float)
+
+        self.counters = collections.defaultdict(int)
+
+        self.last_export = time.perf_counter()
+
+        self.csv_file = None
+        if logdir is not None and enabled:
+            path = Path(logdir) / "profile.csv"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.csv_file = open(path, "w", newline="")
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(self.CSV_FIELDS)
+
+    @contextlib.contextmanager
+    def span(self, name):
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.samples[name].append(elapsed)
+            self.totals[name] += elapsed
+
+    def count(self, name, n=1):
+
+        if self.enabled:
+            self.counters[name] += n
+
+    def step(self, global_step):
+        """ export_interval秒経過していればexportする
+        """
+        if not self.enabled:
+            return
+
+        if time.perf_counter() - self.last_export >= self.export_interval:
+            self.export(global_step)
+
+    def summary(self):
+        """ 前回export以降の統計をdictで返す
+        """
+        wall = max(time.perf_counter() - self.last_export, 1e-9)
+
+        metrics = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            latencies = np.array(samples) * 1000
+            metrics[f"{name}/mean_ms"] = latencies.mean()
+            for q in (50, 90, 99):
+                metrics[f"{name}/p{q}_ms"] = np.percentile(latencies, q)
+            metrics[f"{name}/calls"] = len(latencies)
+            metrics[f"{name}/share"] = self.totals[name] / wall
+
+        for name, n in self.counters.items():
+            metrics[f"{name}/per_sec"] = n / wall
+
+        return metrics
+
+    def export(self, global_step):
+
+        if not self.enabled:
+            return
+
+        metrics = self.summary()
+
+        if self.summary_writer is not None:
+            with self.summary_writer.as_default():
+                for key, value in metrics.items():
+                    tf.summary.scalar(f"profile/{key}", value, step=global_step)
+                for name, samples in self.samples.items():
+                    if samples:
+                        tf.summary.histogram(
+                            f"profile/{name}/latency_ms",
+                            np.array(samples) * 1000, step=global_step)
+
+        if self.csv_file is not None:
+            wall_time = time.time()
+            for key, value in metrics.items():
+                self.csv_writer.writerow(
+                    [global_step, f"{wall_time:.3f}", key, f"{value:.6g}"])
+            self.csv_file.flush()
+
+        self.reset()
+
+        return metrics
+
+    def reset(self):
+
+        for samples in self.samples.values():
+            samples.clear()
+
+        self.totals.clear()
+
+        self.counters.clear()
+
+        self.last_export = time.perf_counter()
+
+    def close(self):
+
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
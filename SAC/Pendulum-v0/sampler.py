@@ -0,0 +1,90 @@
+import collections
+
+import numpy as np
+
+
+class UniformSampler:
+    """ 重複なしの一様サンプリング
+
+        np.random.choice(np.arange(N), replace=False, size=batch_size) は
+        N個すべてを並べ替えるので、N=1Mのbufferでは1回の32件サンプルにO(N)かかる.
+        ここではbatch_size個の整数を引き、重複した分だけ引き直す(rejection)ので
+        batch_size << N ならO(batch_size)で済む
+
+    Args:
+        seed (int): 乱数シード. Noneならnp.randomから引く(np.random.seedで再現できる)
+        prefetch (int): 0より大きければprefetch個分のミニバッチの
+            インデックスをまとめて引いておく. Nが変わったら捨てて引き直す
+    """
+
+    def __init__(self, seed=None, prefetch=0):
+
+        if seed is None:
+            seed = np.random.randint(2**31)
+
+        self.rng = np.random.default_rng(seed)
+
+        self.prefetch = prefetch
+
+        self.blocks = collections.deque()
+
+        self.block_key = None
+
+    def sample(self, N, batch_size):
+        """ [0, N)から重複なしでbatch_size個のインデックスを引く
+        """
+        if batch_size > N:
+            raise ValueError(
+                f"Cannot sample {batch_size} indices from {N} experiences")
+
+        if not self.prefetch:
+            return self._sample(N, batch_size)
+
+        if self.block_key != (N, batch_size):
+            self.blocks.clear()
+            self.block_key = (N, batch_size)
+
+        if not self.blocks:
+            self.blocks.extend(self.sample_blocks(N, batch_size, self.prefetch))
+
+        return self.blocks.popleft()
+
+    def sample_blocks(self, N, batch_size, n_blocks):
+        """ n_blocks個のミニバッチ分のインデックスを一度に引く
+
+        Returns:
+            np.ndarray: shape==(n_blocks, batch_size)
+        """
+        if 2 * batch_size > N:
+            return np.stack(
+                [self._sample(N, batch_size) for _ in range(n_blocks)])
+
+        indices = self.rng.integers(0, N, size=(n_blocks, batch_size))
+
+        #: 行ごとに重複があるかを調べ、重複した行だけ引き直す
+        sorted_indices = np.sort(indices, axis=1)
+        has_duplicates = (sorted_indices[:, 1:] == sorted_indices[:, :-1]).any(axis=1)
+        for i in np.flatnonzero(has_duplicates):
+            indices[i] = self._sample(N, batch_size)
+
+        return indices
+
+    def _sample(self, N, batch_size):
+
+        if 2 * batch_size > N:
+            #: 重複が多くなるのでpermutationのほうが速い
+            return self.rng.permutation(N)[:batch_size]
+
+        indices = self.rng.integers(0, N, size=batch_size)
+        while True:
+            unique_indices = np.unique(indices)
+            n_missing = batch_size - len(unique_indices)
+            if n_missing == 0:
+                break
+            indices = np.concatenate(
+                [unique_indices, self.rng.integers(0, N, size=n_missing)])
+
+        #: np.uniqueはソートするので順番を戻す
+        self.rng.shuffle(indices)
+
+        return indices
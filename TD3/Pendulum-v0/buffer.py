@@ -3,23 +3,65 @@ from dataclasses import dataclass
 
 import numpy as np
 
+from sampler import UniformSampler
+
 
 class ReplayBuffer:
+    """ 固定長のnumpy配列によるリングバッファ
+        配列は最初のadd_experienceで経験のshapeから確保する
+    """
 
     def __init__(self, max_experiences):
 
         self.max_experiences = max_experiences
 
+        self.sampler = UniformSampler()
+
         self.count = 0
 
-        self.experiences = []
+        self.size = 0
+
+        self.states = None
+
+        self.actions = None
+
+        self.rewards = None
+
+        self.next_states = None
+
+        self.dones = None
+
+    def _allocate(self, exp):
+
+        state_shape = np.shape(exp.state)
+
+        action_shape = np.shape(exp.action)
+
+        self.states = np.zeros(
+            (self.max_experiences, *state_shape), dtype=np.float32)
+
+        self.actions = np.zeros(
+            (self.max_experiences, *action_shape), dtype=np.float32)
+
+        self.rewards = np.zeros((self.max_experiences, 1), dtype=np.float32)
+
+        self.next_states = np.zeros(
+            (self.max_experiences, *state_shape), dtype=np.float32)
+
+        self.dones = np.zeros((self.max_experiences, 1), dtype=np.float32)
 
     def add_experience(self, exp):
 
-        if len(self.experiences) == self.max_experiences:
-            self.experiences[self.count] = exp
-        else:
-            self.experiences.append(exp)
+        if self.states is None:
+            self._allocate(exp)
+
+        self.states[self.count] = exp.state
+        self.actions[self.count] = exp.action
+        self.rewards[self.count] = exp.reward
+        self.next_states[self.count] = exp.next_state
+        self.dones[self.count] = exp.done
+
+        self.size = min(self.size + 1, self.max_experiences)
 
         if self.count == self.max_experiences-1:
             self.count = 0
@@ -28,24 +70,21 @@ class ReplayBuffer:
 
     def get_minibatch(self, batch_size):
 
-        N = len(self.experiences)
-
-        indices = np.random.choice(np.arange(N), replace=False,
-                                   size=batch_size)
+        N = self.size
 
-        selected_experiences = [self.experiences[idx] for idx in indices]
+        indices = self.sampler.sample(N, batch_size)
 
-        states = np.vstack([exp.state for exp in selected_experiences]).astype(np.float32)
+        states = self.states[indices]
 
-        actions = [exp.action for exp in selected_experiences]
+        actions = self.actions[indices]
 
-        rewards = [exp.reward for exp in selected_experiences]
+        rewards = self.rewards[indices]
 
-        next_states = np.vstack([exp.next_state for exp in selected_experiences]).astype(np.float32)
+        next_states = self.next_states[indices]
 
-        dones = [exp.done for exp in selected_experiences]
+        dones = self.dones[indices]
 
         return (states, actions, rewards, next_states, dones)
 
     def __len__(self):
-        return len(self.experiences)
+        return self.size
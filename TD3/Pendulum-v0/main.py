@@ -46,6 +46,8 @@ class TD3Agent:
 
     POLICY_UPDATE_PERIOD = 8
 
+    POLICY_DELAY = POLICY_UPDATE_PERIOD // CRITIC_UPDATE_PERIOD
+
     TAU = 0.02
 
     GAMMA = 0.99
@@ -54,6 +56,8 @@ class TD3Agent:
 
     NOISE_STDDEV = 0.2
 
+    POLICY_NOISE = 0.2
+
     def __init__(self):
 
         self.env = gym.make(self.ENV_ID)
@@ -74,6 +78,9 @@ class TD3Agent:
 
         self.global_steps = 0
 
+        #: critic更新回数. policyの遅延更新はこのカウンタでグラフ内で判定する
+        self.update_count = tf.Variable(0, dtype=tf.int64, trainable=False)
+
         self.hiscore = None
 
         self._build_networks()
@@ -155,17 +162,12 @@ class TD3Agent:
 
             self.global_steps += 1
 
-            #: Delayed Policy update
             if self.global_steps % self.CRITIC_UPDATE_PERIOD == 0:
-                if self.global_steps % self.POLICY_UPDATE_PERIOD == 0:
-                    self.update_network(self.BATCH_SIZE, update_policy=True)
-                    self.update_target_network()
-                else:
-                    self.update_network(self.BATCH_SIZE)
+                self.update_network(self.BATCH_SIZE)
 
         return total_reward, steps
 
-    def update_network(self, batch_size, update_policy=False):
+    def update_network(self, batch_size):
 
         if len(self.buffer) < self.MIN_EXPERIENCES:
             return
@@ -173,21 +175,28 @@ class TD3Agent:
         (states, actions, rewards,
          next_states, dones) = self.buffer.get_minibatch(batch_size)
 
-        clipped_noise = np.clip(
-            np.random.normal(0, 0.2, self.ACTION_SPACE), -0.5, 0.5)
+        self._update_network(states, actions, rewards, next_states, dones)
+
+    @tf.function
+    def _update_network(self, states, actions, rewards, next_states, dones):
+
+        self.update_count.assign_add(1)
+
+        #: Target policy smoothing: サンプルごとにクリップしたノイズを加える
+        noise = tf.random.normal(tf.shape(actions), stddev=self.POLICY_NOISE)
+
+        clipped_noise = tf.clip_by_value(noise, -0.5, 0.5) * self.MAX_ACTION
 
-        next_actions = self.target_actor(next_states) + clipped_noise * self.MAX_ACTION
+        next_actions = tf.clip_by_value(
+            self.target_actor(next_states) + clipped_noise,
+            -self.MAX_ACTION, self.MAX_ACTION)
 
+        #: Clipped double Q-learning
         q1, q2 = self.target_critic(next_states, next_actions)
 
-        next_qvalues = [min(q1, q2) for q1, q2
-                        in zip(q1.numpy().flatten(), q2.numpy().flatten())]
+        next_qvalues = tf.minimum(q1, q2)
 
-        #: Compute taeget values and update CriticNetwork
-        target_values = np.vstack(
-            [reward + self.GAMMA * next_qvalue if not done else reward
-             for reward, done, next_qvalue
-             in zip(rewards, dones, next_qvalues)]).astype(np.float32)
+        target_values = rewards + self.GAMMA * (1. - dones) * next_qvalues
 
         #: Update Critic
         with tf.GradientTape() as tape:
@@ -200,8 +209,8 @@ class TD3Agent:
         gradients = tape.gradient(loss, variables)
         self.critic.optimizer.apply_gradients(zip(gradients, variables))
 
-        #: Delayed Update ActorNetwork
-        if update_policy:
+        #: Delayed Update ActorNetwork and target networks
+        if self.update_count % self.POLICY_DELAY == 0:
 
             with tf.GradientTape() as tape:
                 q1, _ = self.critic(states, self.actor(states))
@@ -211,27 +220,20 @@ class TD3Agent:
             gradients = tape.gradient(J, variables)
             self.actor.optimizer.apply_gradients(zip(gradients, variables))
 
-    def update_target_network(self):
-
-        # soft-target update Actor
-        target_actor_weights = self.target_actor.get_weights()
-        actor_weights = self.actor.get_weights()
-
-        assert len(target_actor_weights) == len(actor_weights)
+            self.update_target_network()
 
-        self.target_actor.set_weights(
-            (1 - self.TAU) * np.array(target_actor_weights)
-            + (self.TAU) * np.array(actor_weights))
+        return loss
 
-        # soft-target update Critic
-        target_critic_weights = self.target_critic.get_weights()
-        critic_weights = self.critic.get_weights()
-
-        assert len(target_critic_weights) == len(critic_weights)
+    def update_target_network(self):
+        """ soft-target update. eager/グラフ内どちらからも呼べる
+        """
+        for target_var, var in zip(self.target_actor.weights,
+                                   self.actor.weights):
+            target_var.assign((1 - self.TAU) * target_var + self.TAU * var)
 
-        self.target_critic.set_weights(
-            (1 - self.TAU) * np.array(target_critic_weights)
-            + (self.TAU) * np.array(critic_weights))
+        for target_var, var in zip(self.target_critic.weights,
+                                   self.critic.weights):
+            target_var.assign((1 - self.TAU) * target_var + self.TAU * var)
 
     def save_model(self):
 
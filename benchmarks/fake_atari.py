@@ -0,0 +1,132 @@
+""" ALEのROMなしで動く決定的な疑似Atari環境
+
+    gym.make("fake_atari:FakeBreakout-v0")
+
+    breakoutと同じ (210, 160, 3) uint8のフレーム, Discrete(4)の行動,
+    info["ale.lives"] を返す. 同じseedと行動列なら同じ遷移列になる.
+    step_costでエミュレータのCPUコストを模擬できる(ビジーループ).
+    SubProcVecEnvのワーカーはこのモジュールをimportし直すので、
+    FakeBreakout-v0のstep_costは環境変数FAKE_ATARI_STEP_COSTで渡す
+"""
+import os
+import time
+
+import gym
+import numpy as np
+from gym import spaces
+
+
+class FakeAtariEnv(gym.Env):
+    """
+    Args:
+        n_actions (int): 行動数
+        lives (int): 残機. life_lengthステップごとに1減り、0でエピソード終了
+        life_length (int): 1機あたりのステップ数
+        reward_period (int): reward_periodステップごとに報酬1
+        step_cost (float): 1ステップあたりに消費するCPU時間(秒)
+        pool_size (int): 事前に描画しておくフレーム数
+        seed (int): フレーム描画の乱数シード
+    """
+
+    metadata = {"render.modes": ["rgb_array"]}
+
+    FRAME_SHAPE = (210, 160, 3)
+
+    def __init__(self, n_actions=4, lives=5, life_length=200,
+                 reward_period=25, step_cost=0., pool_size=128, seed=0):
+
+        self.observation_space = spaces.Box(
+            low=0, high=255, shape=self.FRAME_SHAPE, dtype=np.uint8)
+
+        self.action_space = spaces.Discrete(n_actions)
+
+        self.max_lives = lives
+
+        self.life_length = life_length
+
+        self.reward_period = reward_period
+
+        self.step_cost = step_cost
+
+        self.frames = self._render_pool(pool_size, seed)
+
+        self.t = 0
+
+        self.lives = lives
+
+    @classmethod
+    def _render_pool(cls, pool_size, seed):
+        """ breakout風のフレーム: 上部にブロック列, 下部にパドル, ボール
+        """
+        rng = np.random.default_rng(seed)
+
+        base = np.zeros(cls.FRAME_SHAPE, dtype=np.uint8)
+        base[32:36, 8:152] = 142
+        base[:, 0:8] = base[:, 152:160] = 142
+        colors = rng.integers(64, 255, size=(6, 3), dtype=np.uint8)
+        for row, color in enumerate(colors):
+            base[57+6*row:63+6*row, 8:152] = color
+
+        frames = np.repeat(base[np.newaxis, ...], pool_size, axis=0)
+        for i, frame in enumerate(frames):
+            paddle_x = 8 + (i * 3) % 128
+            frame[189:193, paddle_x:paddle_x+16] = 200
+            ball_x, ball_y = rng.integers(8, 150), rng.integers(100, 185)
+            frame[ball_y:ball_y+4, ball_x:ball_x+2] = 200
+            #: 崩れたブロック
+            for _ in range(i % 8):
+                x, row = rng.integers(0, 18) * 8, rng.integers(0, 6)
+                frame[57+6*row:63+6*row, 8+x:16+x] = 0
+
+        return frames
+
+    def seed(self, seed=None):
+        return [seed]
+
+    def _observe(self, action=0):
+
+        idx = (self.t * 7 + int(action)) % len(self.frames)
+
+        return self.frames[idx].copy()
+
+    def reset(self):
+
+        self.t = 0
+
+        self.lives = self.max_lives
+
+        return self._observe()
+
+    def step(self, action):
+
+        if self.step_cost > 0:
+            end = time.perf_counter() + self.step_cost
+            while time.perf_counter() < end:
+                pass
+
+        self.t += 1
+
+        reward = 1.0 if self.t % self.reward_period == 0 else 0.0
+
+        if self.t % self.life_length == 0:
+            self.lives -= 1
+
+        done = self.lives == 0
+
+        return self._observe(action), reward, done, {"ale.lives": self.lives}
+
+    def render(self, mode="rgb_array"):
+        return self._observe()
+
+
+def register(env_id="FakeBreakout-v0", **kwargs):
+
+    registry = gym.envs.registration.registry
+    if env_id in getattr(registry, "env_specs", registry):
+        return
+
+    gym.envs.registration.register(
+        id=env_id, entry_point="fake_atari:FakeAtariEnv", kwargs=kwargs)
+
+
+register(step_cost=float(os.environ.get("FAKE_ATARI_STEP_COST", 0.)))
@@ -0,0 +1,279 @@
+""" Nature-CNN系ネットワークのfloat32 / mixed_bfloat16比較ベンチマーク
+
+    python benchmarks/mixed_precision.py --out mixed_precision.json
+    python benchmarks/mixed_precision.py --networks dqn rainbow --force
+
+    各ネットワークについて次を計測してJSONに書き出す
+      - forward_ms: batch_size=1/32での推論レイテンシ(mean/p50)
+      - train_ms: batch_size=32での1回の勾配更新のレイテンシ(mean/p50)
+      - curve: 同じ初期重み・同じミニバッチ列で固定の教師ネットワークの出力を
+        回帰させたときの損失曲線. 移動平均の相対誤差がtolerance以内かを判定する
+
+    強化学習そのものの学習曲線は乱数と環境に左右されるので、
+    ここでは決定的な回帰タスクを学習曲線の代理にしている.
+    models.pyはディレクトリごとに同名なので1ネットワークごとにspawnした子プロセスで実行する
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+from dataclasses import dataclass
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BATCH_SIZES = (1, 32)
+
+STATE_SHAPE = (84, 84, 4)
+
+
+@dataclass
+class Network:
+    """
+    Args:
+        name (str): ケース名
+        directory (str): models.pyのあるディレクトリ(ROOTからの相対パス)
+        module (str): モジュール名
+        cls (str): クラス名
+        kwargs (dict): コンストラクタ引数
+        output (int): 出力がtupleのときに使う要素. Noneならそのまま
+    """
+
+    name: str
+
+    directory: str
+
+    module: str
+
+    cls: str
+
+    kwargs: dict
+
+    output: int = None
+
+
+NETWORKS = [
+    Network("dqn", "DQN/BreakoutDet-v4", "model", "QNetwork",
+            {"actions_space": 4}),
+    Network("dueling", "Rainbow/BreakOutDet-v4", "models", "DuelingQNetwork",
+            {"actions_space": 4}),
+    Network("rainbow", "Rainbow/BreakOutDet-v4", "models", "RainbowQNetwork",
+            {"actions_space": 4, "Vmin": -10, "Vmax": 10, "n_atoms": 51}),
+    Network("qrdqn", "QR-DQN/BreakOutDet-v4", "model", "QuantileQNetwork",
+            {"actions_space": 4, "N": 200}),
+    Network("fqf", "FQF/BreakOutDet-v4", "models", "FQFNetwork",
+            {"action_space": 4}, output=2),
+    Network("apex", "ApeX-DQN/BreakoutDet-v4", "model", "DuelingQNetwork",
+            {"action_space": 4}),
+    Network("a2c", "A2C/BreakoutDet-v4", "models", "ActorCriticNet",
+            {"action_space": 4}, output=1),
+]
+
+
+def timeit(func, n_iters):
+
+    func()
+
+    times = []
+    for _ in range(n_iters):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+
+    return {"mean": float(np.mean(times)), "p50": float(np.median(times))}
+
+
+def smooth(values, window):
+
+    values = np.asarray(values, dtype=np.float64)
+    window = max(min(window, len(values)), 1)
+    kernel = np.ones(window) / window
+
+    return np.convolve(values, kernel, mode="valid")
+
+
+def run_network(network, n_iters, n_curve_steps, tolerance, force, seed):
+    """ 子プロセスで1ネットワークを計測する
+    """
+    result = {"network": network.name, "directory": network.directory}
+
+    try:
+        sys.path.insert(0, os.path.join(ROOT, network.directory))
+        import importlib
+        import tensorflow as tf
+        import mixed_precision
+        module = importlib.import_module(network.module)
+    except ImportError as e:
+        result["skipped"] = f"{type(e).__name__}: {e}"
+        return result
+
+    result["bfloat16_supported"] = mixed_precision.bfloat16_supported()
+
+    rng = np.random.default_rng(seed)
+    tf.random.set_seed(seed)
+
+    def build():
+        net = getattr(module, network.cls)(**network.kwargs)
+        net(np.zeros((1, *STATE_SHAPE), dtype=np.uint8))
+        return net
+
+    def forward(net, x):
+        out = net(x)
+        if network.output is not None:
+            out = out[network.output]
+        return tf.cast(out, tf.float32)
+
+    #: 全ケースで共通の初期重みと教師
+    mixed_precision.disable_mixed_precision()
+    initial_weights = build().get_weights()
+    teacher = build()
+
+    n_batches = 16
+    curve_states = rng.integers(
+        0, 256, (n_batches, 32, *STATE_SHAPE), dtype=np.uint8)
+    curve_targets = [forward(teacher, x) for x in curve_states]
+
+    results = {}
+    for policy in ("float32", "mixed_bfloat16"):
+
+        if policy == "float32":
+            mixed_precision.disable_mixed_precision()
+        elif not mixed_precision.enable_mixed_precision(policy, force=force):
+            results[policy] = {"skipped": "bfloat16 is not supported"}
+            continue
+
+        net = build()
+        net.set_weights(initial_weights)
+
+        optimizer = mixed_precision.wrap_optimizer(
+            tf.keras.optimizers.Adam(learning_rate=0.0001))
+
+        @tf.function
+        def train_step(x, target):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_mean(tf.square(target - forward(net, x)))
+                scaled_loss = mixed_precision.scale_loss(optimizer, loss)
+            grads = tape.gradient(scaled_loss, net.trainable_variables)
+            grads = mixed_precision.unscale_gradients(optimizer, grads)
+            optimizer.apply_gradients(zip(grads, net.trainable_variables))
+            return loss
+
+        forward_ms = {}
+        for batch_size in BATCH_SIZES:
+            x = tf.constant(curve_states[0][:batch_size])
+            forward_ms[batch_size] = timeit(lambda: forward(net, x), n_iters)
+
+        #: 損失曲線. 初期重みから学習させるのでレイテンシ計測より先に行う
+        curve = []
+        for step in range(n_curve_steps):
+            i = step % n_batches
+            curve.append(float(train_step(curve_states[i], curve_targets[i])))
+
+        x, target = tf.constant(curve_states[0]), curve_targets[0]
+        train_ms = timeit(lambda: train_step(x, target), n_iters)
+
+        results[policy] = {
+            "compute_dtype": net.compute_dtype,
+            "forward_ms": forward_ms, "train_ms": train_ms, "curve": curve}
+
+    mixed_precision.disable_mixed_precision()
+
+    result["results"] = results
+
+    if all("curve" in r for r in results.values()):
+        base = smooth(results["float32"]["curve"], 20)
+        mixed = smooth(results["mixed_bfloat16"]["curve"], 20)
+        rel_err = np.abs(mixed - base) / np.maximum(np.abs(base), 1e-8)
+        result["curve_max_rel_err"] = float(rel_err.max())
+        result["curve_within_tolerance"] = bool(rel_err.max() <= tolerance)
+
+    return result
+
+
+def run_suite(n_iters=50, n_curve_steps=200, tolerance=0.1,
+              force=False, seed=0, networks=None):
+    """
+    Args:
+        networks (list): 計測するケース名. Noneなら全部
+        force (bool): bfloat16非対応のCPUでもmixed_bfloat16を計測する
+    """
+    ctx = multiprocessing.get_context("spawn")
+
+    results = []
+    for network in NETWORKS:
+        if networks and network.name not in networks:
+            continue
+        with ctx.Pool(1) as pool:
+            result = pool.apply(
+                run_network,
+                (network, n_iters, n_curve_steps, tolerance, force, seed))
+        print(format_result(result))
+        results.append(result)
+
+    meta = {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "n_iters": n_iters, "n_curve_steps": n_curve_steps,
+            "tolerance": tolerance, "force": force, "seed": seed,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    return {"meta": meta, "results": results}
+
+
+def format_result(result):
+
+    header = f"{result['network']:<10}"
+
+    if "skipped" in result:
+        return f"{header} skipped ({result['skipped']})"
+
+    lines = []
+    for policy, r in result["results"].items():
+        if "skipped" in r:
+            lines.append(f"{header} {policy:<15} skipped ({r['skipped']})")
+            continue
+        forward = "  ".join(
+            f"fwd[{b}] {r['forward_ms'][b]['mean']:>7.2f}ms" for b in BATCH_SIZES)
+        lines.append(f"{header} {policy:<15} {forward}  "
+                     f"train {r['train_ms']['mean']:>7.2f}ms")
+
+    if "curve_max_rel_err" in result:
+        status = "ok" if result["curve_within_tolerance"] else "NG"
+        lines.append(f"{header} curve rel_err={result['curve_max_rel_err']:.4f} "
+                     f"[{status}]")
+
+    return "\n".join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="mixed_precision.json")
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--curve-steps", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--networks", nargs="*", default=None)
+    args = parser.parse_args()
+
+    report = run_suite(
+        n_iters=args.iters, n_curve_steps=args.curve_steps,
+        tolerance=args.tolerance, force=args.force, seed=args.seed,
+        networks=args.networks)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {args.out}")
+
+    if not all(r.get("curve_within_tolerance", True) for r in report["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+""" 各アルゴリズムディレクトリのreplay bufferの比較ベンチマーク
+
+    python benchmarks/replay_buffers.py --out report.json
+    python benchmarks/replay_buffers.py --baseline report.json
+
+    Atari形状(84x84x4のフレームスタック)とMuJoCo形状(17次元状態, 6次元行動)の
+    合成遷移で各bufferを駆動し、次を計測してJSONに書き出す
+      - push_per_sec: 遷移の追加レート
+      - sample_ms: batch_size=32/256/512でのミニバッチ作成レイテンシ(mean/p50)
+      - priority_updates_per_sec: 優先度更新レート(優先度付きbufferのみ)
+      - rss_mb: fill件数を入れた時点でのRSS増分と、capacity満杯時の推定値
+
+    bufferモジュールはディレクトリごとに同名(buffer.py, util.py)なので、
+    計測は1ケースごとにspawnした子プロセスで行う. RSSの計測もこれで独立する
+"""
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import zlib
+import argparse
+import platform
+import importlib
+import multiprocessing
+from dataclasses import dataclass
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BATCH_SIZES = (32, 256, 512)
+
+MUJOCO_STATE_DIM, MUJOCO_ACTION_DIM = 17, 6
+
+
+@dataclass
+class Experience:
+    """ Experienceを持たないモジュール(TD3/DDPG)用
+    """
+
+    state: np.ndarray
+
+    action: np.ndarray
+
+    reward: float
+
+    next_state: np.ndarray
+
+    done: bool
+
+
+def load_module(directory, name):
+
+    path = os.path.join(ROOT, directory)
+    sys.path.insert(0, path)
+
+    return importlib.import_module(name)
+
+
+def next_pow2(n):
+
+    return 1 << (n - 1).bit_length()
+
+
+class SyntheticTransitions:
+    """ 決定的な合成遷移. 生成コストを計測に含めないようにpoolを使い回す
+
+        Atari形状はbreakoutのフレームに近い疎な画像にする
+        (一様乱数だとzlib圧縮が効かず、実際のメモリ使用量とかけ離れるため)
+    """
+
+    def __init__(self, kind, seed=0, pool_size=256):
+
+        rng = np.random.default_rng(seed)
+
+        self.kind = kind
+
+        if kind == "atari":
+            #: 前処理済みフレームと同じuint8
+            frames = (rng.random((pool_size + 3, 84, 84)) < 0.03) * 128
+            frames = frames.astype(np.uint8)
+            self.states = [
+                np.stack(frames[i:i+4], axis=2)[np.newaxis, ...]
+                for i in range(pool_size)]
+            self.actions = rng.integers(0, 4, size=pool_size)
+        else:
+            self.states = list(rng.standard_normal(
+                (pool_size, MUJOCO_STATE_DIM)).astype(np.float32))
+            self.actions = list(rng.uniform(
+                -1, 1, (pool_size, MUJOCO_ACTION_DIM)).astype(np.float32))
+
+        self.rewards = rng.uniform(-1, 1, size=pool_size)
+
+        self.dones = rng.random(pool_size) < 0.01
+
+        self.pool_size = pool_size
+
+    def __getitem__(self, i):
+
+        i = i % self.pool_size
+        j = (i + 1) % self.pool_size
+
+        return (self.states[i], self.actions[i], float(self.rewards[i]),
+                self.states[j], bool(self.dones[i]))
+
+
+class BufferAdapter:
+    """ bufferごとのAPI差分を吸収する
+
+    Args:
+        directory (str): ROOTからの相対パス
+        module (str): モジュール名
+        cls (str): クラス名
+        kind (str): "atari" or "mujoco"
+        make (callable): make(module, capacity) -> buffer
+        prepare (callable): prepare(module, transition) -> push()に渡すもの
+        push (callable): push(buffer, item)
+        sample (callable): sample(buffer, batch_size) -> indices or None.
+            Falseならsampleを計測しない
+        update (callable): update(buffer, indices, td_errors). Noneなら計測しない
+        copy (callable): push前に要素を複製する. poolの配列を参照で
+            保持するbufferのRSSを過小評価しないため. 複製コストはpushに含まれる
+    """
+
+    def __init__(self, directory, module, cls, kind, make,
+                 prepare=None, push=None, sample=None, update=None, copy=None):
+
+        self.directory = directory
+        self.module = module
+        self.cls = cls
+        self.kind = kind
+        self.make = make
+        self.prepare = prepare or (lambda mod, transition: transition)
+        self.push = push or (lambda buffer, item: buffer.push(item))
+        self.sample = _sample_uniform if sample is None else sample
+        self.update = update
+        self.copy = copy
+
+    @property
+    def name(self):
+        return f"{self.directory}:{self.cls}"
+
+
+def _sample_uniform(buffer, batch_size):
+    buffer.get_minibatch(batch_size)
+    return None
+
+
+def _sample_prioritized(buffer, batch_size):
+    indices, _, _ = buffer.get_minibatch(batch_size, 0)
+    return indices
+
+
+def _as_experience(mod, transition):
+    return getattr(mod, "Experience", Experience)(*transition)
+
+
+def _as_compressed_experience(mod, transition):
+    return zlib.compress(pickle.dumps(mod.Experience(*transition)))
+
+
+def _copy_experience(exp):
+    return type(exp)(exp.state.copy(), np.copy(exp.action), exp.reward,
+                     exp.next_state.copy(), exp.done)
+
+
+def _copy_bytes(item):
+    return bytes(bytearray(item))
+
+
+def _push_global(buffer, item):
+    buffer.push([1.0], [item])
+
+
+def _sample_global(buffer, batch_size):
+    indices, _, _, _ = buffer.sample_batch(batch_size)
+    return indices
+
+
+def _mujoco_replay(directory):
+    return BufferAdapter(
+        directory, "buffer", "ReplayBuffer", "mujoco",
+        make=lambda mod, capacity: mod.ReplayBuffer(max_len=capacity),
+        prepare=_as_experience,
+        copy=_copy_experience)
+
+
+def _mujoco_ndarray_replay(directory):
+    return BufferAdapter(
+        directory, "buffer", "ReplayBuffer", "mujoco",
+        make=lambda mod, capacity: mod.ReplayBuffer(max_experiences=capacity),
+        prepare=_as_experience,
+        push=lambda buffer, item: buffer.add_experience(item))
+
+
+def _atari_exp_replay(directory):
+    """ C51/QR-DQN/FQF: push(Experience)
+    """
+    return BufferAdapter(
+        directory, "buffer", "ReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.ReplayBuffer(max_len=capacity),
+        prepare=_as_experience)
+
+
+RAINBOW = "Rainbow/BreakOutDet-v4"
+
+ADAPTERS = [
+    BufferAdapter(
+        "DQN/BreakoutDet-v4", "buffer", "ReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.ReplayBuffer(max_len=capacity)),
+    BufferAdapter(
+        RAINBOW, "buffers", "ReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.ReplayBuffer(
+            max_len=capacity, reward_clip=True)),
+    BufferAdapter(
+        RAINBOW, "buffers", "NstepReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.NstepReplayBuffer(
+            max_len=capacity, reward_clip=True, nstep_return=3, gamma=0.99)),
+    BufferAdapter(
+        RAINBOW, "buffers", "PrioritizedReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.PrioritizedReplayBuffer(
+            max_len=capacity, reward_clip=True),
+        sample=_sample_prioritized,
+        update=lambda buffer, indices, td: buffer.update_priority(indices, td)),
+    BufferAdapter(
+        RAINBOW, "buffers", "NstepPrioritizedReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.NstepPrioritizedReplayBuffer(
+            max_len=capacity, gamma=0.99, reward_clip=True),
+        sample=_sample_prioritized,
+        update=lambda buffer, indices, td: buffer.update_priority(indices, td)),
+    _atari_exp_replay("C51/BreakOutDet-v4"),
+    _atari_exp_replay("QR-DQN/BreakOutDet-v4"),
+    _atari_exp_replay("FQF/BreakOutDet-v4"),
+    BufferAdapter(
+        "ApeX-DQN/BreakoutDet-v4", "buffer", "LocalReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.LocalReplayBuffer(
+            reward_clip=True, gamma=0.99, nstep=3),
+        sample=False),
+    #: actorが圧縮済みの遷移を送ってくるのでpoolの時点で圧縮しておく
+    BufferAdapter(
+        "ApeX-DQN/BreakoutDet-v4", "buffer", "GlobalReplayBuffer", "atari",
+        make=lambda mod, capacity: mod.GlobalReplayBuffer(
+            capacity=next_pow2(capacity), alpha=0.6, beta=0.4),
+        prepare=_as_compressed_experience,
+        push=_push_global,
+        sample=_sample_global,
+        update=lambda buffer, indices, td: buffer.update_priorities(indices, td),
+        copy=_copy_bytes),
+    _mujoco_replay("SAC/Pendulum-v0"),
+    _mujoco_replay("SAC/BipedalWalker-v3"),
+    _mujoco_ndarray_replay("TD3/Pendulum-v0"),
+    _mujoco_ndarray_replay("TD3/Bipedalwalker-v3"),
+    _mujoco_ndarray_replay("DDPG/Pendulum-v0"),
+    ]
+
+
+def rss_bytes():
+    """ 現在のRSS. /procがなければ(macOSなど)ピークRSSで代用する
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(adapter_idx, capacity, fill, n_sample_iters, seed):
+    """ 子プロセスで1ケースを計測する
+    """
+    adapter = ADAPTERS[adapter_idx]
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    result = {"buffer": adapter.name, "kind": adapter.kind,
+              "capacity": capacity, "fill": fill}
+
+    try:
+        mod = load_module(adapter.directory, adapter.module)
+    except ImportError as e:
+        result["skipped"] = f"{type(e).__name__}: {e}"
+        return result
+
+    transitions = SyntheticTransitions(adapter.kind, seed=seed)
+    items = [adapter.prepare(mod, transitions[i])
+             for i in range(transitions.pool_size)]
+
+    rss_before = rss_bytes()
+
+    buffer = adapter.make(mod, capacity)
+
+    start = time.perf_counter()
+    for i in range(fill):
+        item = items[i % len(items)]
+        if adapter.copy is not None:
+            item = adapter.copy(item)
+        adapter.push(buffer, item)
+    elapsed = time.perf_counter() - start
+
+    rss_delta = max(rss_bytes() - rss_before, 0)
+    n_stored = len(buffer) if hasattr(buffer, "__len__") else fill
+    bytes_per_transition = rss_delta / max(n_stored, 1)
+
+    result["push_per_sec"] = fill / elapsed
+    result["rss_mb"] = rss_delta / 2**20
+    result["bytes_per_transition"] = bytes_per_transition
+    result["est_rss_mb_at_capacity"] = bytes_per_transition * capacity / 2**20
+
+    if not adapter.sample:
+        return result
+
+    result["sample_ms"] = {}
+    indices = None
+    for batch_size in BATCH_SIZES:
+        if n_stored < batch_size:
+            continue
+        latencies = []
+        for _ in range(n_sample_iters):
+            start = time.perf_counter()
+            indices = adapter.sample(buffer, batch_size)
+            latencies.append((time.perf_counter() - start) * 1000)
+        result["sample_ms"][str(batch_size)] = {
+            "mean": float(np.mean(latencies)),
+            "p50": float(np.median(latencies))}
+
+    if adapter.update is not None and indices is not None:
+        rng = np.random.default_rng(seed)
+        n_updates = 0
+        start = time.perf_counter()
+        for _ in range(n_sample_iters):
+            td_errors = rng.standard_normal(len(indices))
+            adapter.update(buffer, indices, td_errors)
+            n_updates += len(indices)
+        result["priority_updates_per_sec"] = n_updates / (time.perf_counter() - start)
+
+    return result
+
+
+def run_suite(capacities=(100000, 1000000), max_fill=None,
+              n_sample_iters=20, seed=0, buffers=None):
+    """
+    Args:
+        max_fill (dict): kindごとのfill件数の上限.
+            Atari形状を1M件入れると圧縮しても数十GBになるので、
+            既定ではatariは2万件まで入れてcapacity満杯時のRSSは外挿する
+        buffers (list): 計測するbuffer名の部分文字列. Noneなら全部
+    """
+    max_fill = max_fill or {"atari": 20000, "mujoco": 1000000}
+
+    ctx = multiprocessing.get_context("spawn")
+
+    results = []
+    for idx, adapter in enumerate(ADAPTERS):
+        if buffers and not any(b in adapter.name for b in buffers):
+            continue
+        for capacity in capacities:
+            fill = min(capacity, max_fill[adapter.kind])
+            with ctx.Pool(1) as pool:
+                result = pool.apply(
+                    run_case, (idx, capacity, fill, n_sample_iters, seed))
+            print(format_result(result))
+            results.append(result)
+
+    return {"meta": environment_info(capacities, max_fill, n_sample_iters, seed),
+            "results": results}
+
+
+def environment_info(capacities, max_fill, n_sample_iters, seed):
+
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "capacities": list(capacities),
+            "max_fill": max_fill,
+            "n_sample_iters": n_sample_iters,
+            "seed": seed,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def format_result(result):
+
+    header = f"{result['buffer']:<55} cap={result['capacity']:>8}"
+
+    if "skipped" in result:
+        return f"{header}  skipped ({result['skipped']})"
+
+    text = (f"{header}  push {result['push_per_sec']:>9.0f}/s  "
+            f"rss {result['rss_mb']:>8.1f}MB "
+            f"(est. {result['est_rss_mb_at_capacity']:.0f}MB full)")
+
+    for batch_size, latency in result.get("sample_ms", {}).items():
+        text += f"  sample[{batch_size}] {latency['mean']:.2f}ms"
+
+    if "priority_updates_per_sec" in result:
+        text += f"  prio {result['priority_updates_per_sec']:.0f}/s"
+
+    return text
+
+
+def compare(report, baseline, tolerance=0.1):
+    """ baselineより悪化した指標を列挙する
+
+    Returns:
+        list of str: "buffer cap metric: baseline -> current"
+    """
+    def key(res):
+        return (res["buffer"], res["capacity"])
+
+    def metrics(res):
+        #: (名前, 値, 大きいほど良いか)
+        yield "push_per_sec", res.get("push_per_sec"), True
+        yield "priority_updates_per_sec", res.get("priority_updates_per_sec"), True
+        yield "rss_mb", res.get("rss_mb"), False
+        for batch_size, latency in res.get("sample_ms", {}).items():
+            yield f"sample_ms[{batch_size}]", latency["mean"], False
+
+    base = {key(res): dict((m, v) for m, v, _ in metrics(res))
+            for res in baseline["results"]}
+
+    regressions = []
+    for res in report["results"]:
+        if key(res) not in base:
+            continue
+        for name, value, higher_is_better in metrics(res):
+            ref = base[key(res)].get(name)
+            if value is None or not ref:
+                continue
+            ratio = value / ref
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            if worse:
+                regressions.append(
+                    f"{res['buffer']} cap={res['capacity']} {name}: "
+                    f"{ref:.4g} -> {value:.4g}")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="replay_buffers.json")
+    parser.add_argument("--capacities", type=int, nargs="+",
+                        default=[100000, 1000000])
+    parser.add_argument("--atari-fill", type=int, default=20000)
+    parser.add_argument("--mujoco-fill", type=int, default=1000000)
+    parser.add_argument("--n-sample-iters", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--buffers", nargs="*", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = run_suite(
+        capacities=args.capacities,
+        max_fill={"atari": args.atari_fill, "mujoco": args.mujoco_fill},
+        n_sample_iters=args.n_sample_iters, seed=args.seed,
+        buffers=args.buffers)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+""" 疑似Atari環境(fake_atari)でのエンドツーエンド学習スループット計測
+
+    python benchmarks/throughput.py --steps 2000 --out throughput.json
+    python benchmarks/throughput.py --cases dqn rainbow[noisy --step-cost 0.0005
+
+    各エージェントのネットワーク/replay buffer/update関数をそのまま使い、
+    learn()と同じ手順(行動選択 -> env.step -> 前処理 -> push -> update_periodごとに更新
+    -> target_update_periodごとに同期)を固定ステップ数だけ回して
+    steps/s と updates/s を報告する. learn()はupdate開始までに5万件の経験を
+    必要とするので直接は呼ばず、warmupステップだけpushしてから計測を始める.
+
+    A2Cは A2CAgent.run_Nsteps + ACNet.update をSubProcVecEnvごと計測する.
+    各ディレクトリのmain.pyは同名なので1ケースごとにspawnした子プロセスで実行する
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import collections
+import multiprocessing
+from dataclasses import dataclass
+
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENV_ID = "fake_atari:FakeBreakout-v0"
+
+RAINBOW_FLAGS = ("use_noisy", "use_priority", "use_dueling",
+                 "use_multistep", "use_categorical")
+
+
+@dataclass
+class Case:
+    """
+    Args:
+        name (str): ケース名
+        directory (str): main.pyのあるディレクトリ(ROOTからの相対パス)
+        kind (str): "offpolicy" or "a2c"
+        kwargs (dict): エージェントのコンストラクタ引数
+    """
+
+    name: str
+
+    directory: str
+
+    kind: str
+
+    kwargs: dict
+
+
+def build_cases():
+
+    cases = [Case("dqn", "DQN/BreakoutDet-v4", "offpolicy", {})]
+
+    for flags in itertools.product([False, True], repeat=len(RAINBOW_FLAGS)):
+        kwargs = dict(zip(RAINBOW_FLAGS, flags))
+        label = ",".join(k[4:] for k, v in kwargs.items() if v)
+        cases.append(Case(f"rainbow[{label}]", "Rainbow/BreakOutDet-v4",
+                          "offpolicy", kwargs))
+
+    cases.append(Case("qrdqn", "QR-DQN/BreakOutDet-v4", "offpolicy", {}))
+    cases.append(Case("fqf", "FQF/BreakOutDet-v4", "offpolicy", {}))
+    cases.append(Case("a2c", "A2C/BreakoutDet-v4", "a2c", {}))
+
+    return cases
+
+
+def load_main(directory):
+
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+    import fake_atari  # noqa: F401 (FakeBreakout-v0の登録)
+    import main
+
+    return main
+
+
+class OffPolicyAdapter:
+    """ DQN系エージェントごとのAPI差分を吸収する
+    """
+
+    def __init__(self, mod, case, buffer_size):
+
+        self.mod = mod
+
+        if case.directory.startswith("DQN"):
+            self.agent = mod.DQNAgent(env_name=ENV_ID, **case.kwargs)
+            self.agent.replay_buffer = mod.ReplayBuffer(max_len=buffer_size)
+            self.net = self.agent.qnet
+            self.preprocess = mod.preprocess_frame
+
+        elif case.directory.startswith("Rainbow"):
+            self.agent = mod.RainbowAgent(
+                env_name=ENV_ID, buffer_size=buffer_size, **case.kwargs)
+            self.net = self.agent.qnet
+            self.preprocess = mod.util.preprocess_frame
+
+        elif case.directory.startswith("QR-DQN"):
+            self.agent = mod.QRDQNAgent(
+                env_name=ENV_ID, buffer_size=buffer_size, **case.kwargs)
+            self.net = self.agent.qnet
+            self.preprocess = mod.frame_preprocess
+
+        elif case.directory.startswith("FQF"):
+            self.agent = mod.FQFAgent(
+                env_name=ENV_ID, buffer_size=buffer_size, **case.kwargs)
+            self.net = self.agent.fqf_network
+            self.preprocess = mod.frame_preprocess
+
+        else:
+            raise NotImplementedError(case.directory)
+
+        #: QR-DQN/FQFはExperienceをpushする
+        self.push_experience = not (case.directory.startswith("DQN")
+                                    or case.directory.startswith("Rainbow"))
+
+        self.use_noisy = case.kwargs.get("use_noisy", False)
+
+        self.use_categorical = case.kwargs.get("use_categorical", False)
+
+    def act(self, state, epsilon):
+
+        epsilon = 0 if self.use_noisy else epsilon
+
+        return self.net.sample_action(state, epsilon=epsilon)
+
+    def push(self, transition):
+
+        if self.push_experience:
+            transition = self.mod.Experience(*transition)
+
+        self.agent.replay_buffer.push(transition)
+
+    def update(self, steps):
+
+        #: Rainbowのbeta schedulerはagent.stepsを参照する
+        self.agent.steps = steps
+
+        if self.use_categorical:
+            return self.agent.update_categorical_network()
+
+        return self.agent.update_network()
+
+    def sync_target(self):
+
+        target = getattr(self.agent, "target_qnet", None)
+        if target is None:
+            target = self.agent.target_fqf_network
+
+        target.set_weights(self.net.get_weights())
+
+
+def run_offpolicy(mod, case, n_steps, warmup, epsilon, buffer_size):
+
+    import gym
+
+    adapter = OffPolicyAdapter(mod, case, buffer_size)
+    agent = adapter.agent
+
+    env = gym.make(ENV_ID)
+
+    n_frames = agent.n_frames
+
+    def reset():
+        frame = adapter.preprocess(env.reset())
+        return collections.deque([frame] * n_frames, maxlen=n_frames), 5
+
+    frames, lives = reset()
+
+    def step(steps, train):
+        nonlocal frames, lives
+
+        state = np.stack(frames, axis=2)[np.newaxis, ...]
+        action = adapter.act(state, epsilon)
+        next_frame, reward, done, info = env.step(action)
+        frames.append(adapter.preprocess(next_frame))
+        next_state = np.stack(frames, axis=2)[np.newaxis, ...]
+
+        life_lost = info["ale.lives"] != lives
+        lives = info["ale.lives"]
+        adapter.push((state, action, reward, next_state, done or life_lost))
+
+        n_updates = 0
+        if train and steps % agent.update_period == 0:
+            adapter.update(steps)
+            n_updates = 1
+
+        if train and steps % agent.target_update_period == 0:
+            adapter.sync_target()
+
+        if done:
+            frames, lives = reset()
+
+        return n_updates
+
+    start = time.perf_counter()
+    for steps in range(1, warmup + 1):
+        step(steps, train=False)
+    warmup_elapsed = time.perf_counter() - start
+
+    #: tf.functionのトレースを計測から外す
+    adapter.update(warmup)
+
+    n_updates = 0
+    start = time.perf_counter()
+    for steps in range(warmup + 1, warmup + n_steps + 1):
+        n_updates += step(steps, train=True)
+    elapsed = time.perf_counter() - start
+
+    return {"steps_per_sec": n_steps / elapsed,
+            "updates_per_sec": n_updates / elapsed,
+            "n_steps": n_steps, "n_updates": n_updates,
+            "elapsed": elapsed,
+            "warmup_steps_per_sec": warmup / warmup_elapsed}
+
+
+def fake_envfunc(env_id):
+
+    import gym
+    import fake_atari  # noqa: F401
+
+    env = gym.make(ENV_ID)
+    env.seed = env_id
+    return env
+
+
+def run_a2c(mod, case, n_steps, n_envs):
+
+    agent = mod.A2CAgent(n_procs=n_envs, envfunc=fake_envfunc, **case.kwargs)
+
+    steps_per_iter = agent.n_procs * agent.TRAJECTORY_SIZE
+
+    def iteration():
+        mb_states, mb_actions, mb_discounted_rewards = agent.run_Nsteps()
+        agent.ACNet.update(
+            mb_states.reshape((agent.batch_size, 84, 84, 4)),
+            mb_actions.reshape(agent.batch_size, -1),
+            mb_discounted_rewards.reshape(agent.batch_size, -1))
+
+    agent.states = agent.vecenv.reset()
+
+    #: トレース
+    iteration()
+
+    n_iters = max(n_steps // steps_per_iter, 1)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        iteration()
+    elapsed = time.perf_counter() - start
+
+    agent.vecenv.close()
+
+    return {"steps_per_sec": n_iters * steps_per_iter / elapsed,
+            "updates_per_sec": n_iters / elapsed,
+            "n_steps": n_iters * steps_per_iter, "n_updates": n_iters,
+            "elapsed": elapsed, "n_envs": n_envs}
+
+
+def run_case(case, n_steps, warmup, epsilon, buffer_size, n_envs, seed):
+    """ 子プロセスで1ケースを計測する
+    """
+    import random
+    random.seed(seed)
+    np.random.seed(seed)
+
+    result = {"case": case.name, "directory": case.directory}
+
+    try:
+        mod = load_main(case.directory)
+        import tensorflow as tf
+        tf.random.set_seed(seed)
+    except ImportError as e:
+        result["skipped"] = f"{type(e).__name__}: {e}"
+        return result
+
+    if case.kind == "a2c":
+        result.update(run_a2c(mod, case, n_steps, n_envs))
+    else:
+        result.update(
+            run_offpolicy(mod, case, n_steps, warmup, epsilon, buffer_size))
+
+    return result
+
+
+def run_suite(n_steps=2000, warmup=1000, epsilon=0.1, buffer_size=100000,
+              n_envs=8, seed=0, cases=None):
+    """
+    Args:
+        cases (list): 計測するケース名の接頭辞. Noneなら全部
+    """
+    ctx = multiprocessing.get_context("spawn")
+
+    results = []
+    for case in build_cases():
+        if cases and not any(case.name.startswith(c) for c in cases):
+            continue
+        with ctx.Pool(1) as pool:
+            result = pool.apply(
+                run_case,
+                (case, n_steps, warmup, epsilon, buffer_size, n_envs, seed))
+        print(format_result(result))
+        results.append(result)
+
+    meta = {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "n_steps": n_steps, "warmup": warmup, "epsilon": epsilon,
+            "buffer_size": buffer_size, "n_envs": n_envs, "seed": seed,
+            "step_cost": float(os.environ.get("FAKE_ATARI_STEP_COST", 0.)),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    return {"meta": meta, "results": results}
+
+
+def format_result(result):
+
+    header = f"{result['case']:<45}"
+
+    if "skipped" in result:
+        return f"{header} skipped ({result['skipped']})"
+
+    return (f"{header} {result['steps_per_sec']:>8.1f} steps/s  "
+            f"{result['updates_per_sec']:>7.1f} updates/s")
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="throughput.json")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--epsilon", type=float, default=0.1)
+    parser.add_argument("--buffer-size", type=int, default=100000)
+    parser.add_argument("--n-envs", type=int, default=8)
+    parser.add_argument("--step-cost", type=float, default=0.)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", nargs="*", default=None)
+    args = parser.parse_args()
+
+    #: SubProcVecEnvのワーカーにも届くように環境変数で渡す
+    os.environ["FAKE_ATARI_STEP_COST"] = str(args.step_cost)
+
+    report = run_suite(
+        n_steps=args.steps, warmup=args.warmup, epsilon=args.epsilon,
+        buffer_size=args.buffer_size, n_envs=args.n_envs, seed=args.seed,
+        cases=args.cases)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()